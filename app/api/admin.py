@@ -0,0 +1,45 @@
+from fastapi import APIRouter, HTTPException, Header, Depends
+from fastapi.responses import FileResponse
+from pydantic import BaseModel
+from rag.profiling import list_profiles, profile_path
+from typing import List, Optional
+import hmac, os
+
+# Admin endpoints (and profiling on request) require it in the X-Admin-Token header; they are
+# disabled while it is unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def is_admin(token):
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+def _check_token(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Admin endpoints are disabled, set ADMIN_TOKEN to enable them.")
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+
+ROUTER = APIRouter(prefix="/admin", tags=["admin"], dependencies=[Depends(_check_token)])
+
+class ProfileInfo(BaseModel):
+    name: str
+    bytes: int
+    created_at: str
+
+@ROUTER.get("/profiles", response_model=List[ProfileInfo])
+def profiles():
+    """
+    Recent query and worker job profiles, newest first
+    """
+    return list_profiles()
+
+@ROUTER.get("/profiles/{name}")
+def download_profile(name: str):
+    """
+    Downloads a profile: `.collapsed` files are collapsed stacks for flamegraph.pl / speedscope,
+    `.pstats` files are cProfile stats
+    """
+    path = profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Profile {name} not found.")
+    media_type = "text/plain" if path.suffix == ".collapsed" else "application/octet-stream"
+    return FileResponse(path, media_type=media_type, filename=path.name)
@@ -0,0 +1,122 @@
+from fastapi import APIRouter, HTTPException, Query, Header
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from rag.db import get_document, get_document_progress, DocumentStatus
+from rag.events import get_event_hub
+from typing import Dict, List, Optional
+import json, os
+
+ROUTER = APIRouter(prefix="/documents", tags=["documents"])
+
+# Longest time a long-poll request is held open, and the interval of SSE keep-alives
+EVENTS_WAIT_SECONDS = float(os.getenv("EVENTS_WAIT_SECONDS", "25"))
+# Nothing happens to a document any more once it reached one of these
+TERMINAL_STATUSES = {DocumentStatus.INDEXED.value, DocumentStatus.FAILED.value}
+
+class Progress(BaseModel):
+    done: Optional[int] = None
+    total: Optional[int] = None
+
+class DocumentState(BaseModel):
+    document_id: str
+    name: str
+    status: str
+    stage: Optional[str] = None
+    pages: Optional[int] = None
+    error: Optional[str] = None
+    searchable: bool
+    progress: Dict[str, Progress]
+    last_event_id: int
+    updated_at: Optional[str] = None
+
+class DocumentEvent(BaseModel):
+    id: int
+    kind: str
+    name: str
+    done: Optional[int] = None
+    total: Optional[int] = None
+    message: Optional[str] = None
+    created_at: Optional[str] = None
+
+class EventsResponse(BaseModel):
+    document_id: str
+    status: str
+    events: List[DocumentEvent]
+    last_event_id: int
+
+async def _require_document(document_id):
+    doc = await run_in_threadpool(get_document, document_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail=f"Document {document_id} not found.")
+    return doc
+
+@ROUTER.get("/{document_id}", response_model=DocumentState)
+async def document_state(document_id: str):
+    """
+    Current status, pipeline stage and progress counters of a document
+    """
+    doc = await _require_document(document_id)
+    progress, last_event_id = await run_in_threadpool(get_document_progress, document_id)
+    return DocumentState(
+        document_id=doc["id"],
+        name=doc["original_name"],
+        status=doc["status"],
+        stage=doc["stage"],
+        pages=doc["pages"],
+        error=doc["error_msg"],
+        searchable=doc["status"] == DocumentStatus.INDEXED.value,
+        progress=progress,
+        last_event_id=last_event_id,
+        updated_at=doc["updated_at"]
+    )
+
+@ROUTER.get("/{document_id}/events", response_model=EventsResponse)
+async def document_events(document_id: str,
+                          after: int = Query(0, ge=0, description="Last event id the client has seen"),
+                          wait: float = Query(EVENTS_WAIT_SECONDS, ge=0, le=60, description="Seconds to wait for new events")):
+    """
+    Long-poll: returns the document's events after `after`, waiting up to `wait` seconds for the
+    next one if there are none yet. Passing the returned `last_event_id` as `after` continues the feed.
+    """
+    doc = await _require_document(document_id)
+    timeout = 0 if doc["status"] in TERMINAL_STATUSES else wait
+    events = await get_event_hub().wait(document_id, after, timeout)
+    if events:
+        doc = await _require_document(document_id)
+    return EventsResponse(
+        document_id=document_id,
+        status=doc["status"],
+        events=events,
+        last_event_id=events[-1]["id"] if events else after
+    )
+
+@ROUTER.get("/{document_id}/stream")
+async def document_stream(document_id: str,
+                          after: int = Query(0, ge=0, description="Last event id the client has seen"),
+                          last_event_id: Optional[int] = Header(None)):
+    """
+    Server-sent events of the document's progress. The stream ends after the document is indexed or
+    failed; reconnecting clients resume through the Last-Event-ID header.
+    """
+    await _require_document(document_id)
+    hub = get_event_hub()
+
+    async def stream():
+        cursor = last_event_id if last_event_id is not None else after
+        while True:
+            doc = await run_in_threadpool(get_document, document_id)
+            finished = doc is None or doc["status"] in TERMINAL_STATUSES
+            events = await hub.wait(document_id, cursor, 0 if finished else EVENTS_WAIT_SECONDS)
+            for e in events:
+                cursor = e["id"]
+                yield f"id: {e['id']}\nevent: {e['kind']}\ndata: {json.dumps(e)}\n\n"
+                if e["kind"] == "status" and e["name"] in TERMINAL_STATUSES:
+                    return
+            if finished and not events:
+                return
+            if not events:
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -1,10 +1,11 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from pathlib import Path
 from pypdf import PdfReader
-from rag.db import init_schema, enqueue_index_job, create_document
+from rag.db import init_schema, enqueue_index_job, create_document, get_document_by_sha
 from typing import List, Optional
-import uuid, hashlib
+import asyncio, os, uuid, hashlib
 
 ROUTER = APIRouter(prefix="/ingest", tags=["ingest"])
 
@@ -13,6 +14,10 @@ UPLOAD_DIR = Path("data/uploads")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 init_schema()
 
+READ_CHUNK_SIZE = 1024 * 1024
+# Number of uploaded files that are hashed/stored at the same time
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))
+
 class IngestResult(BaseModel):
     filename: str
     stored_as: str
@@ -21,17 +26,121 @@ class IngestResult(BaseModel):
     sha256: str
     status: str
     message: Optional[str] = None
+    document_id: Optional[str] = None
+
+def _is_pdf(f: UploadFile):
+    return f.content_type in {"application/pdf", "application/x-pdf", "application/acrobat"} or f.filename.lower().endswith(".pdf")
+
+def _count_pages(fh):
+    fh.seek(0)
+    reader = PdfReader(fh)
+    if getattr(reader, "is_encrypted", False):
+        try:
+            reader.decrypt("")
+        except Exception:
+            pass
+    return len(reader.pages)
+
+def _duplicate_result(filename, existing):
+    return IngestResult(
+        filename=filename,
+        stored_as=existing["storage_path"],
+        bytes=existing["bytes"],
+        pages=existing["pages"] or 0,
+        sha256=existing["sha256"],
+        status="duplicate",
+        message=f"Already ingested as {existing['original_name']} ({existing['status']}).",
+        document_id=existing["id"]
+    )
+
+def _store_pdf(f: UploadFile):
+    """
+    Runs in a worker thread: hashes and writes the upload in a single pass, then short-circuits
+    if the same content was already ingested before anything is queued.
+    """
+    doc_id = uuid.uuid4().hex
+    tmp = UPLOAD_DIR / f".{doc_id}.part"
+    dest = UPLOAD_DIR / f"{doc_id}_{Path(f.filename).name}"
+    sha = hashlib.sha256()
+    nbytes = 0
+
+    try:
+        f.file.seek(0)
+        with tmp.open("wb") as out:
+            while chunk := f.file.read(READ_CHUNK_SIZE):
+                out.write(chunk)
+                sha.update(chunk)
+                nbytes += len(chunk)
+        digest = sha.hexdigest()
+
+        existing = get_document_by_sha(digest)
+        if existing:
+            tmp.unlink(missing_ok=True)
+            return _duplicate_result(f.filename, existing)
+
+        os.replace(tmp, dest)
+
+        pages = 0
+        try:
+            # The upload is still open (spooled), no need to reopen the stored copy
+            pages = _count_pages(f.file)
+        except Exception as e:
+            message = f"Stored but could not parse PDF: {str(e)}"
+        else:
+            message = "Stored PDF for indexing."
+
+        created = create_document(
+            id=doc_id,
+            original_name=f.filename,
+            storage_path=str(dest),
+            sha256=digest,
+            bytes=nbytes,
+            pages=pages
+        )
+        if not created:
+            # An identical file was stored concurrently
+            dest.unlink(missing_ok=True)
+            return _duplicate_result(f.filename, get_document_by_sha(digest))
+
+        enqueue_index_job(doc_id, digest)
+
+        return IngestResult(
+            filename=f.filename,
+            stored_as=str(dest),
+            bytes=nbytes,
+            pages=pages,
+            sha256=digest,
+            status="ok",
+            message=message,
+            document_id=doc_id
+        )
+
+    except Exception as e:
+        tmp.unlink(missing_ok=True)
+        dest.unlink(missing_ok=True)
+        return IngestResult(
+            filename = f.filename,
+            stored_as="",
+            bytes=nbytes,
+            pages=0,
+            sha256="",
+            status="error",
+            message=str(e)
+        )
 
 @ROUTER.post("/pdf_documents", response_model=List[IngestResult])
 async def ingest_pdf_documents(files: List[UploadFile] = File(..., description="Single or more PDF files")):
     """
     Accepts one or more PDF files to be used as a source for RAG
     """
-    results: List[IngestResult] = []
-    
-    for f in files:
-        if f.content_type not in {"application/pdf", "application/x-pdf", "application/acrobat"} and not f.filename.lower().endswith(".pdf"):
-            results.append(IngestResult(
+    if not files:
+        raise HTTPException(status_code=400, detail="No files uploaded.")
+
+    semaphore = asyncio.Semaphore(INGEST_CONCURRENCY)
+
+    async def _ingest(f: UploadFile):
+        if not _is_pdf(f):
+            return IngestResult(
                 filename=f.filename,
                 stored_as="",
                 bytes=0,
@@ -39,75 +148,12 @@ async def ingest_pdf_documents(files: List[UploadFile] = File(..., description="
                 sha256="",
                 status="error",
                 message="File format is not PDF."
-            ))
-            continue
-    
-        doc_id = uuid.uuid4().hex
-        dest = UPLOAD_DIR / f"{doc_id}_{Path(f.filename).name}"
-        sha = hashlib.sha256()
-        nbytes = 0
-
-        try:
-            with dest.open("wb") as out:
-                while True:
-                    chunk = await f.read(1024 * 1024)
-                    if not chunk:
-                        break
-                    out.write(chunk)
-                    sha.update(chunk)
-                    nbytes += len(chunk)
-
-            pages = 0
-            try:
-                with dest.open("rb") as fh:
-                    reader = PdfReader(fh)
-                    if getattr(reader, "is_encrypted", False):
-                        try:
-                            reader.decrypt("")
-                        except Exception:
-                            pass
-                    pages = len(reader.pages)
-            except Exception as e:
-                message = f"Stored but could not parse PDF: {str(e)}"
-            else:
-                message = "Stored PDF for indexing."
-
-            create_document(
-                id=doc_id,
-                original_name=f.filename,
-                storage_path=str(dest),
-                sha256=sha.hexdigest(),
-                bytes=nbytes,
-                pages=pages
             )
-            enqueue_index_job(doc_id, sha.hexdigest())
-
-            results.append(IngestResult(
-                filename=f.filename,
-                stored_as=str(dest),
-                bytes=nbytes,
-                pages=pages,
-                sha256=sha.hexdigest(),
-                status="ok",
-                message=message
-            ))
-
-        except Exception as e:
-            if dest.exists():
-                dest.unlink(missing_ok=True)
-            results.append(IngestResult(
-                filename = f.filename,
-                stored_as="",
-                bytes=nbytes,
-                pages=0,
-                sha256="",
-                status="error",
-                message=str(e)
-            ))
+        try:
+            async with semaphore:
+                # Blocking file and SQLite work stays off the event loop
+                return await run_in_threadpool(_store_pdf, f)
         finally:
             await f.close()
 
-    if not results:
-        raise HTTPException(status_code=400, detail="No files uploaded.")
-
-    return results
\ No newline at end of file
+    return list(await asyncio.gather(*(_ingest(f) for f in files)))
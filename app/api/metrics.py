@@ -0,0 +1,25 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from rag.db import count_jobs_by_status, get_total_chunks
+from rag.active_index import read_manifest
+from rag.indexer import index_paths, ivf_data_path
+from rag.metrics import REGISTRY, JOBS, INDEX_SIZE
+
+ROUTER = APIRouter(tags=["metrics"])
+
+def _refresh_gauges():
+    # Cheap values read at scrape time; vector counts are reported by the worker
+    for status, n in count_jobs_by_status().items():
+        JOBS.set(n, status=status)
+    INDEX_SIZE.set(get_total_chunks(), kind="chunks")
+    for name, path in zip(("flat", "ivfpq", "ivfdata"), (*index_paths(), ivf_data_path())):
+        INDEX_SIZE.set(path.stat().st_size if path.exists() else 0, kind="bytes", index=name)
+    INDEX_SIZE.set(read_manifest()["generation"], kind="generation")
+
+@ROUTER.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    Prometheus text format metrics of the API process
+    """
+    _refresh_gauges()
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
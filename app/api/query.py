@@ -1,18 +1,37 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Header
 from rag.intent_service import get_intent_service
+from rag.embedders import get_embedder
 from rag.retriever import get_retriever
 from rag.query_refiner import get_refiner
+from rag.query_understanding import get_query_understanding, resolve_pipeline
 from rag.chat_assitant import get_chat_assistant
+from rag.answer_cache import get_answer_cache
+from rag.context_packer import pack_context
+from rag.db import get_session
+from rag.sessions import get_session_summarizer, new_session, session_context
+from rag.metrics import span, collect_timings, timings_ms, CACHE_REQUESTS
+from rag.profiling import profile, should_profile
+from app.api.admin import is_admin
 from pydantic import BaseModel, Field
 from typing import Dict, Optional, List, Any, Literal
+from concurrent.futures import ThreadPoolExecutor
+
+import os
 
 RETRIEVER = get_retriever()
 REFINER = get_refiner()
 INTENT_SERVICE = get_intent_service()
+UNDERSTANDING = get_query_understanding()
 CHAT_ASSISTANT = get_chat_assistant()
+ANSWER_CACHE = get_answer_cache()
+SUMMARIZER = get_session_summarizer()
 
 ROUTER = APIRouter(prefix="/query", tags=["query"])
 
+# Number of queries of a batch that are refined / analyzed / answered at the same time
+BATCH_CONCURRENCY = int(os.getenv("BATCH_QUERY_CONCURRENCY", "8"))
+MAX_SOURCE_CHARS = 1200
+
 class Message(BaseModel):
     role: Literal["user", "assistant"]
     content: str
@@ -22,6 +41,16 @@ class QueryRequest(BaseModel):
     top_k: int = Field(8, ge=1, le=50)
     rrf_k: int = Field(60, ge=1, le=200, description="RRF smoothing constant")
     history: List[Message] = []
+    session_id: Optional[str] = Field(None, description="Server-side conversation to continue, replaces `history`")
+    session: bool = Field(False, description="Start a server-side conversation, its id is returned as session_id")
+    debug_timings: bool = Field(False, description="Attach per-stage timings to query_debug")
+    profile: bool = Field(False, description="Profile this query (needs X-Admin-Token), the profile's name is returned in query_debug")
+    pipeline: Optional[Literal["two_call", "combined"]] = Field(None, description="Query understanding pipeline, QUERY_PIPELINE by default")
+
+class Location(BaseModel):
+    document_id: str
+    document_name: str
+    page_num: int
 
 class Source(BaseModel):
     rank: int
@@ -29,53 +58,232 @@ class Source(BaseModel):
     document_id: str
     document_name: str
     page_num: int
+    page_span: int = Field(1, description="Pages the text covers from page_num on")
     text: str
     scores: Dict[str, Optional[float]] = {}
+    also_in: List[Location] = Field([], description="Other pages with (nearly) the same text, at most ALSO_IN_LIMIT")
+    also_in_count: int = Field(0, description="Number of other pages with (nearly) the same text")
 
 class Response(BaseModel):
     trigger: bool
     query_debug: Dict[str,Any]
     results: List[Source]
     answer: str
+    session_id: Optional[str] = None
+
+class BatchQueryItem(BaseModel):
+    query: str = Field(..., description="User query")
+    history: List[Message] = []
+
+class BatchQueryRequest(BaseModel):
+    queries: List[BatchQueryItem] = Field(..., min_length=1, max_length=1000)
+    top_k: int = Field(8, ge=1, le=50)
+    rrf_k: int = Field(60, ge=1, le=200, description="RRF smoothing constant")
+    rerank: bool = True
+    pipeline: Optional[Literal["two_call", "combined"]] = Field(None, description="Query understanding pipeline, QUERY_PIPELINE by default")
+
+class BatchResponse(BaseModel):
+    responses: List[Response]
+
+
+def _refine(query, history, pipeline, summary=""):
+    """
+    (refined query, intent response or None). The combined pipeline refines and analyzes a query
+    with history in one LLM call; without history there is nothing to refine and the intent is
+    left to INTENT_SERVICE, fast path included.
+    """
+    if pipeline == "combined" and (history or summary):
+        with span("understand"):
+            return UNDERSTANDING.understand(query, history, summary)
+    with span("refine"):
+        return REFINER.refine(query, history, summary), None
+
+def _embed_refined(refined_queries):
+    """{refined query: embedding} of a batch in one call, for the intent fast path and retrieval."""
+    texts = list(dict.fromkeys(refined_queries))
+    if not texts:
+        return {}
+    try:
+        with span("embed_query"):
+            vecs = get_embedder().embed(texts).astype("float32")
+    except Exception as e:
+        print("Batch query embedding failed:", e)
+        return {}
+    return {text: vecs[i:i + 1] for i, text in enumerate(texts)}
+
+def _analyze(refined_query, response, query_vec=None):
+    if response is None:
+        with span("intent"):
+            response = INTENT_SERVICE.analyze(refined_query, query_vec)
+    return refined_query, response
+
+def _to_sources(match):
+    results = []
+    for i, r in enumerate(match, start=1):
+        text = r.get("text", "")
+        results.append(Source(
+            rank=i,
+            chunk_id=r["chunk_id"],
+            document_id = r["document_id"],
+            document_name = r["document_name"],
+            page_num = r["page_num"],
+            page_span = r.get("page_span", 1),
+            text=(text[:MAX_SOURCE_CHARS] + "…") if len(text) > MAX_SOURCE_CHARS else text,
+            scores=r.get("scores", {}),
+            also_in=r.get("also_in", []),
+            also_in_count=r.get("also_in_count", 0)
+        ))
+    return results
+
+
+def _open_session(request: QueryRequest):
+    """
+    (session id, summary, history) of the request's conversation, server-side or sent along. A new
+    session is only created once the query succeeded, see `query`.
+    """
+    if request.session_id is not None:
+        if request.history:
+            raise HTTPException(status_code=400, detail="Send either session_id or history, not both")
+        session = get_session(request.session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail=f"Unknown or expired session {request.session_id}")
+        return (request.session_id, *session_context(session))
+    history = [m.model_dump() for m in request.history]
+    return None, "", history
 
 
 @ROUTER.post("", response_model=Response)
-def query(request: QueryRequest):
+def query(request: QueryRequest, background: BackgroundTasks, x_profile: Optional[str] = Header(None),
+          x_admin_token: Optional[str] = Header(None)):
+    session_id, summary, history = _open_session(request)
+    # profiling costs the API time, so only admins may ask for it
+    requested = (request.profile or (x_profile or "").lower() in ("1", "true", "yes")) and is_admin(x_admin_token)
+    with profile("query", should_profile(requested)) as prof:
+        with collect_timings() as timings, span("query"):
+            response = _query(request, history, summary)
+    if session_id is None and request.session:
+        session_id = new_session()
+    if session_id is not None:
+        # the turn is stored now, folding the previous one into the summary waits for the response
+        SUMMARIZER.record_turn(session_id, request.query, response.answer)
+        background.add_task(SUMMARIZER.fold, session_id)
+        response.session_id = session_id
+    if request.debug_timings:
+        response.query_debug["timings_ms"] = timings_ms(timings)
+    if prof.name:
+        response.query_debug["profile"] = prof.name
+    return response
+
+def _query(request: QueryRequest, history, summary=""):
     try:
-        history = [m.model_dump() for m in request.history]
-        refined_query = REFINER.refine(request.query, history)
+        pipeline = resolve_pipeline(request.pipeline)
+        refined_query, response = _refine(request.query, history, pipeline, summary)
 
-        response = INTENT_SERVICE.analyze(refined_query)
+        # Similar enough questions are answered straight from the cache, if they were asked with
+        # the same retrieval parameters
+        cache_vec = None
+        cache_params = {"top_k": request.top_k, "rrf_k": request.rrf_k, "pipeline": pipeline}
+        if ANSWER_CACHE is not None:
+            with span("answer_cache"):
+                cache_vec = ANSWER_CACHE.embed(refined_query)
+                cached, similarity = ANSWER_CACHE.get(cache_vec, cache_params)
+            CACHE_REQUESTS.inc(result="hit" if cached is not None else "miss")
+            if cached is not None:
+                hit = Response.model_validate(cached)
+                hit.query_debug = {
+                    **hit.query_debug,
+                    "original": request.query,
+                    "refined": refined_query,
+                    "pipeline": pipeline,
+                    "cache": {"hit": True, "similarity": similarity, "cached_query": cached["query_debug"].get("refined")},
+                }
+                return hit
+
+        if response is None:
+            with span("intent"):
+                response = INTENT_SERVICE.analyze(refined_query, cache_vec)
         rag_trigger = bool(response.get("trigger", False))
 
         query_debug = {
             "original": request.query,
             "refined": refined_query,
+            "pipeline": pipeline,
             "meta": response,
         }
 
-        results = []
+        results, passages = [], []
         if rag_trigger:
-            retrieved = RETRIEVER.search(
-                refined_query,
-                response,
-                rerank=True,
+            with span("retrieve"):
+                retrieved = RETRIEVER.search(
+                    refined_query,
+                    response,
+                    rerank=True,
+                    top_k=request.top_k,
+                    rrf_k=request.rrf_k,
+                    # the answer cache embedded the refined query already
+                    query_vecs={refined_query: cache_vec} if cache_vec is not None else None)
+            results = _to_sources(retrieved.get("results", []))
+            # the full chunk texts, overlaps merged, within the token budget
+            with span("pack_context"):
+                packed = pack_context(retrieved.get("results", []))
+            passages = packed.passages
+            query_debug["context"] = packed.debug()
+
+        with span("answer"):
+            answer = CHAT_ASSISTANT.answer(rag_trigger, passages, refined_query, temperature=0.3)
+        out = Response(trigger=rag_trigger, query_debug=query_debug, results=results, answer=answer)
+        if ANSWER_CACHE is not None:
+            ANSWER_CACHE.put(cache_vec, out.model_dump(), cache_params)
+        return out
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@ROUTER.post("/batch", response_model=BatchResponse)
+def query_batch(request: BatchQueryRequest):
+    """
+    Answers many queries in one call. Refinement, intent analysis and answers run concurrently,
+    while retrieval for all triggered queries is done with a single `search_many` call.
+    """
+    try:
+        items = request.queries
+        pipeline = resolve_pipeline(request.pipeline)
+        with ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY) as pool:
+            refined = list(pool.map(
+                lambda item: _refine(item.query, [m.model_dump() for m in item.history], pipeline), items))
+            # one embedding call for the whole batch, reused by the intent fast path and the search
+            query_vecs = _embed_refined([refined_query for refined_query, _ in refined])
+            understood = list(pool.map(
+                lambda r: _analyze(*r, query_vecs.get(r[0])), refined))
+
+            triggered = [i for i, (_, meta) in enumerate(understood) if bool(meta.get("trigger", False))]
+            retrieved = RETRIEVER.search_many(
+                [understood[i][0] for i in triggered],
+                [understood[i][1] for i in triggered],
+                rerank=request.rerank,
                 top_k=request.top_k,
-                rrf_k=request.rrf_k)
-            match = retrieved.get("results", [])
-            for i, r in enumerate(match, start=1):
-                text = r.get("text", "")
-                results.append(Source(
-                    rank=i,
-                    chunk_id=r["chunk_id"],
-                    document_id = r["document_id"],
-                    document_name = r["document_name"],
-                    page_num = r["page_num"],
-                    text=(text[:1200] + "…") if len(text) > 1200 else text,
-                    scores=r.get("scores", {})
-                ))
-
-        answer = CHAT_ASSISTANT.answer(rag_trigger, results, refined_query, temperature=0.3)
-        return Response(trigger=rag_trigger, query_debug=query_debug, results=results, answer=answer)
+                rrf_k=request.rrf_k,
+                query_vecs=query_vecs)
+
+            results = [[] for _ in items]
+            passages = [[] for _ in items]
+            for i, r in zip(triggered, retrieved):
+                results[i] = _to_sources(r.get("results", []))
+                passages[i] = pack_context(r.get("results", [])).passages
+
+            answers = list(pool.map(
+                lambda i: CHAT_ASSISTANT.answer(
+                    bool(understood[i][1].get("trigger", False)), passages[i], understood[i][0], temperature=0.3),
+                range(len(items))))
+
+        responses = []
+        for i, item in enumerate(items):
+            refined_query, meta = understood[i]
+            responses.append(Response(
+                trigger=bool(meta.get("trigger", False)),
+                query_debug={"original": item.query, "refined": refined_query, "pipeline": pipeline, "meta": meta},
+                results=results[i],
+                answer=answers[i]))
+        return BatchResponse(responses=responses)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
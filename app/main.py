@@ -1,10 +1,16 @@
 from fastapi import FastAPI
 from app.api.ingest import ROUTER as ingest_router
 from app.api.query import ROUTER as query_router
+from app.api.metrics import ROUTER as metrics_router
+from app.api.documents import ROUTER as documents_router
+from app.api.admin import ROUTER as admin_router
 from dotenv import load_dotenv, find_dotenv
 
 load_dotenv(find_dotenv(), override=True)
 
 app = FastAPI(title="Custom RAG")
 app.include_router(ingest_router)
-app.include_router(query_router)
\ No newline at end of file
+app.include_router(query_router)
+app.include_router(metrics_router)
+app.include_router(documents_router)
+app.include_router(admin_router)
\ No newline at end of file
@@ -0,0 +1,49 @@
+"""
+Compares two benchmark result files produced by `benchmarks.run`.
+
+    python -m benchmarks.compare base.json head.json --max-regression 0.2
+
+Exits with status 1 if any stage's p95 latency grew by more than `--max-regression`.
+"""
+import argparse, json, sys
+
+
+def _ratio(new, old):
+    if not old or new is None:
+        return None
+    return new / old - 1.0
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("base")
+    p.add_argument("head")
+    p.add_argument("--max-regression", type=float, default=0.2)
+    args = p.parse_args(argv)
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+
+    regressions = []
+    print(f"{'stage':<22}{'p50 base':>10}{'p50 head':>10}{'p95 base':>10}{'p95 head':>10}{'p95 Δ':>9}{'thr Δ':>9}")
+    for stage, h in head["stages"].items():
+        b = base["stages"].get(stage)
+        if b is None:
+            print(f"{stage:<22}{'-':>10}{h['p50_ms']:>10.2f}{'-':>10}{h['p95_ms']:>10.2f}")
+            continue
+        p95 = _ratio(h["p95_ms"], b["p95_ms"])
+        thr = _ratio(h["throughput_per_s"], b["throughput_per_s"])
+        print(f"{stage:<22}{b['p50_ms']:>10.2f}{h['p50_ms']:>10.2f}{b['p95_ms']:>10.2f}{h['p95_ms']:>10.2f}"
+              f"{(p95 or 0) * 100:>8.1f}%{(thr or 0) * 100:>8.1f}%")
+        if p95 is not None and p95 > args.max_regression:
+            regressions.append(stage)
+
+    if regressions:
+        print(f"\np95 regressions above {args.max_regression:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Synthetic text, PDFs and chunk streams for the benchmarks."""
+import numpy as np
+
+_VOCAB_SIZE = 20000
+
+
+class TextGenerator:
+    """Zipf-distributed made-up words grouped into sentences, so that FTS/BM25 sees a realistic skew."""
+    def __init__(self, seed: int = 0, vocab_seed: int = None):
+        # `vocab_seed`: draw different text from the vocabulary of the generator with that seed
+        self.rng = np.random.default_rng(seed)
+        vocab_rng = self.rng if vocab_seed is None else np.random.default_rng(vocab_seed)
+        letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+        lengths = vocab_rng.integers(3, 10, size=_VOCAB_SIZE)
+        self.vocab = np.array(["".join(vocab_rng.choice(letters, size=n)) for n in lengths])
+
+    def words(self, n):
+        ranks = np.minimum(self.rng.zipf(1.2, size=n), _VOCAB_SIZE) - 1
+        return self.vocab[ranks]
+
+    def sentence(self):
+        words = self.words(int(self.rng.integers(6, 20)))
+        return " ".join(words).capitalize() + "."
+
+    def text(self, chars):
+        out, n = [], 0
+        while n < chars:
+            s = self.sentence()
+            out.append(s)
+            n += len(s) + 1
+        return " ".join(out)
+
+    def query(self, n_words=4):
+        return " ".join(self.words(n_words))
+
+
+def make_pdf(path, n_pages, chars_per_page=2500, seed=0):
+    import fitz
+
+    gen = TextGenerator(seed)
+    doc = fitz.open()
+    for _ in range(n_pages):
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(36, 36, 576, 806), gen.text(chars_per_page), fontsize=7)
+    doc.save(str(path))
+    doc.close()
+    return path
+
+
+def iter_chunk_batches(n_chunks, batch_size, chunk_chars=350, seed=0):
+    """Yields lists of chunk dicts in the shape produced by `rag.chunker.iter_chunks`."""
+    gen = TextGenerator(seed)
+    ordinal = 0
+    while ordinal < n_chunks:
+        batch = []
+        for _ in range(min(batch_size, n_chunks - ordinal)):
+            text = gen.text(chunk_chars)
+            batch.append({
+                "text": text,
+                "ordinal": ordinal,
+                "page_num": ordinal // 8 + 1,
+                "page_span": 1,
+                "start": 0,
+                "end": len(text),
+                "embed_model": "stub"
+            })
+            ordinal += 1
+        yield batch
@@ -0,0 +1,140 @@
+"""
+Local stand-in for the Mistral HTTP API, for load tests of the running app without a key or quota.
+
+    python -m benchmarks.fake_mistral --port 8900 --chat-latency-ms 400 --embed-latency-ms 60
+    MISTRAL_SERVER_URL=http://127.0.0.1:8900 MISTRAL_API_KEY=fake make run
+
+Serves `/v1/embeddings` (deterministic vectors, see `StubEmbedder`) and `/v1/chat/completions`
+(structured calls get an all-defaults object of the requested JSON schema, free-text calls get the
+refiner's current query back). Latency, jitter and the share of 429 responses can be injected.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import argparse, json, random, threading, time, uuid
+
+from benchmarks.stubs import StubEmbedder
+
+CANNED_ANSWER = "This is a canned answer from the fake Mistral server [S1]."
+
+
+def _default_for(schema, defs):
+    if "$ref" in schema:
+        schema = defs.get(schema["$ref"].rsplit("/", 1)[-1], {})
+    if "anyOf" in schema:
+        return _default_for(schema["anyOf"][0], defs)
+    typ = schema.get("type")
+    if typ == "object":
+        return {k: _default_for(v, defs) for k, v in schema.get("properties", {}).items()}
+    return {"boolean": True, "integer": 0, "number": 0, "array": []}.get(typ, "")
+
+
+class FakeMistral:
+    def __init__(self, dim=1024, chat_latency=0.3, embed_latency=0.05, jitter=0.2, error_rate=0.0):
+        self.embedder = StubEmbedder(dim)
+        self.chat_latency = chat_latency
+        self.embed_latency = embed_latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.counts = {"chat": 0, "embeddings": 0, "throttled": 0}
+        self.lock = threading.Lock()
+
+    def _sleep(self, latency):
+        time.sleep(max(0.0, latency * (1 + random.uniform(-self.jitter, self.jitter))))
+
+    def _usage(self, n):
+        return {"prompt_tokens": n, "completion_tokens": 0, "total_tokens": n}
+
+    def embeddings(self, body):
+        texts = body.get("input") or []
+        if isinstance(texts, str):
+            texts = [texts]
+        self._sleep(self.embed_latency)
+        vecs = self.embedder.embed(texts)
+        return {
+            "id": uuid.uuid4().hex, "object": "list", "model": body.get("model", "mistral-embed"),
+            "data": [{"object": "embedding", "index": i, "embedding": v.tolist()} for i, v in enumerate(vecs)],
+            "usage": self._usage(sum(len(t) for t in texts) // 4),
+        }
+
+    def chat(self, body):
+        messages = body.get("messages") or []
+        fmt = body.get("response_format") or {}
+        if fmt.get("type") == "json_schema":
+            schema = fmt["json_schema"]["schema"]
+            content = json.dumps(_default_for(schema, schema.get("$defs", {})))
+        else:
+            content = CANNED_ANSWER
+            try:
+                # the refiner sends {"recent_dialogue": ..., "current_query": ...}
+                content = json.loads(messages[-1]["content"])["current_query"]
+            except (ValueError, KeyError, TypeError, IndexError):
+                pass
+        self._sleep(self.chat_latency)
+        return {
+            "id": uuid.uuid4().hex, "object": "chat.completion", "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": self._usage(sum(len(str(m.get("content", ""))) for m in messages) // 4),
+        }
+
+    def handle(self, path, body):
+        """Returns (status, payload)."""
+        route = {"/v1/embeddings": ("embeddings", self.embeddings), "/v1/chat/completions": ("chat", self.chat)}.get(path)
+        if route is None:
+            return 404, {"message": f"Unknown path {path}"}
+        name, fn = route
+        with self.lock:
+            if random.random() < self.error_rate:
+                self.counts["throttled"] += 1
+                return 429, {"message": "Requests rate limit exceeded"}
+            self.counts[name] += 1
+        return 200, fn(body)
+
+
+def serve(fake, host="127.0.0.1", port=8900):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            status, payload = fake.handle(self.path.split("?", 1)[0], body)
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Fake Mistral API for load tests")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8900)
+    p.add_argument("--dim", type=int, default=1024, help="embedding dimension")
+    p.add_argument("--chat-latency-ms", type=float, default=300)
+    p.add_argument("--embed-latency-ms", type=float, default=50)
+    p.add_argument("--jitter", type=float, default=0.2, help="relative +/- latency jitter")
+    p.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 429")
+    args = p.parse_args(argv)
+
+    fake = FakeMistral(args.dim, args.chat_latency_ms / 1000, args.embed_latency_ms / 1000, args.jitter, args.error_rate)
+    server = serve(fake, args.host, args.port)
+    print(f"Fake Mistral API on http://{args.host}:{args.port}")
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(fake.counts))
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
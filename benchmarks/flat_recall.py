@@ -0,0 +1,95 @@
+"""
+Memory, search latency and recall of the compressed flat index types against float32.
+
+    python -m benchmarks.flat_recall --vectors 100000 --dim 1024
+    python -m benchmarks.flat_recall --npy embeddings.npy      # real embeddings, e.g. dumped from an index
+
+Synthetic vectors are clustered and anisotropic (closer to real embeddings than white noise);
+queries are perturbed corpus vectors. Recall@k is the overlap of a type's top k with the exact
+float32 top k, the ids RRF gets to see.
+"""
+from pathlib import Path
+
+import argparse, json, os, sys, tempfile, time
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def _synthetic(n, dim, seed):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, n // 400), dim), dtype="float32")
+    scale = rng.uniform(0.2, 1.5, dim).astype("float32")
+    vecs = centers[rng.integers(0, len(centers), n)] * 0.6 + rng.standard_normal((n, dim), dtype="float32") * scale
+    return vecs
+
+
+def _normalized(vecs):
+    vecs = np.ascontiguousarray(vecs, dtype="float32")
+    return vecs / np.clip(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12, None)
+
+
+def run(args):
+    from rag import indexer
+    faiss = indexer.faiss
+
+    vecs = _normalized(np.load(args.npy) if args.npy else _synthetic(args.vectors, args.dim, args.seed))
+    n, dim = vecs.shape
+    ids = np.arange(1, n + 1, dtype="int64")
+    rng = np.random.default_rng(args.seed + 1)
+    queries = vecs[rng.choice(n, args.queries)]
+    queries = _normalized(queries + rng.standard_normal(queries.shape, dtype="float32") * args.noise)
+
+    out, truth = {}, None
+    for kind in indexer.FLAT_INDEX_TYPES:
+        t0 = time.perf_counter()
+        index = indexer._new_flat_index(dim, kind, vecs)
+        index.add_with_ids(vecs, ids)
+        build = time.perf_counter() - t0
+
+        path = Path(f"flat_{kind}.index")
+        faiss.write_index(index, str(path))
+        t0 = time.perf_counter()
+        _, labels = index.search(queries, args.top_k)
+        search = time.perf_counter() - t0
+        if truth is None:
+            truth = labels
+        recall = np.mean([len(set(a) & set(b)) / args.top_k for a, b in zip(labels, truth)])
+        out[kind] = {
+            "bytes_per_vector": index.index.sa_code_size() if kind != "float32" else dim * 4,
+            "file_mb": round(path.stat().st_size / 2**20, 2),
+            "build_s": round(build, 3),
+            "search_ms_per_query": round(search * 1000 / len(queries), 3),
+            f"recall@{args.top_k}": round(float(recall), 4),
+        }
+    return {"meta": {"vectors": n, "dim": dim, "queries": len(queries), "noise": args.noise}, "types": out}
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--vectors", type=int, default=50000)
+    p.add_argument("--dim", type=int, default=1024)
+    p.add_argument("--npy", default=None, help="float32 matrix of real embeddings instead of synthetic ones")
+    p.add_argument("--queries", type=int, default=500)
+    p.add_argument("--noise", type=float, default=0.02, help="perturbation of the query vectors")
+    p.add_argument("--top-k", type=int, default=8)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--out", default=None, help="write the JSON results here (stdout otherwise)")
+    args = p.parse_args(argv)
+
+    if args.npy:
+        args.npy = str(Path(args.npy).resolve())
+    out_path = Path(args.out).resolve() if args.out else None
+    sys.path.insert(0, str(REPO_ROOT))
+    os.chdir(tempfile.mkdtemp(prefix="rag-flat-"))
+
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    if out_path:
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        out_path.write_text(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+End-to-end HTTP load generator for the running API.
+
+    python -m benchmarks.fake_mistral --port 8900 &
+    MISTRAL_SERVER_URL=http://127.0.0.1:8900 MISTRAL_API_KEY=fake make run
+    python -m benchmarks.loadgen --queries traffic.jsonl --concurrency 32 --rate 20 --duration 60
+    python -m benchmarks.loadgen --sweep 1,4,16,64,128 --duration 30 --upload-ratio 0.05
+
+Replays a JSONL query log (one `{"query": ..., "history": [...]}` object or plain string per line,
+synthetic queries without one) against `/query`, mixed with synthetic PDF uploads to
+`/ingest/pdf_documents`. Without `--rate` every one of the `--concurrency` clients sends its next
+request as soon as the previous one returns (closed loop); with `--rate` requests arrive as a Poisson
+process and latency is measured from the planned arrival, so queueing in front of a saturated
+server is counted. `--sweep` repeats the run for several concurrency levels and reports the first
+one that breaks the error-rate or p95 limits.
+"""
+from pathlib import Path
+
+import argparse, asyncio, itertools, json, random, sys, tempfile, time
+import numpy as np
+
+
+def load_queries(path, n_synthetic=200, seed=0):
+    if path:
+        out = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                item = json.loads(line)
+                out.append({"query": item} if isinstance(item, str) else item)
+        return [q for q in out if q.get("query")]
+
+    from benchmarks.data import TextGenerator
+    gen = TextGenerator(seed)
+    return [{"query": gen.query()} for _ in range(n_synthetic)]
+
+
+class UploadPool:
+    """Distinct synthetic PDFs (new seeds every run) so that uploads are not deduplicated."""
+    def __init__(self, pages=3, workdir=None):
+        self.pages = pages
+        self.dir = Path(workdir or tempfile.mkdtemp(prefix="loadgen_"))
+        self.seeds = itertools.count(int(time.time() * 1000) % 10**9)
+
+    def next(self):
+        from benchmarks.data import make_pdf
+        seed = next(self.seeds)
+        path = make_pdf(self.dir / f"load_{seed}.pdf", self.pages, seed=seed)
+        data = path.read_bytes()
+        path.unlink()
+        return f"load_{seed}.pdf", data
+
+
+class Results:
+    def __init__(self):
+        self.rows = {}
+
+    def add(self, kind, latency, error=None):
+        self.rows.setdefault(kind, []).append((latency, error))
+
+    def summary(self, elapsed):
+        out = {}
+        for kind, rows in self.rows.items():
+            lat = np.asarray([r[0] for r in rows]) * 1000.0
+            errors = {}
+            for _, e in rows:
+                if e is not None:
+                    errors[e] = errors.get(e, 0) + 1
+            n_err = sum(errors.values())
+            out[kind] = {
+                "requests": len(rows),
+                "ok": len(rows) - n_err,
+                "error_rate": round(n_err / len(rows), 4),
+                "errors": errors,
+                "throughput_per_s": round((len(rows) - n_err) / elapsed, 2) if elapsed > 0 else None,
+                "p50_ms": round(float(np.percentile(lat, 50)), 1),
+                "p95_ms": round(float(np.percentile(lat, 95)), 1),
+                "p99_ms": round(float(np.percentile(lat, 99)), 1),
+                "max_ms": round(float(lat.max()), 1),
+            }
+        return out
+
+
+async def _send(client, args, queries, uploads, results, planned):
+    if uploads is not None and random.random() < args.upload_ratio:
+        kind = "ingest"
+        name, data = await asyncio.to_thread(uploads.next)
+        request = client.post("/ingest/pdf_documents", files=[("files", (name, data, "application/pdf"))])
+    else:
+        kind = "query"
+        item = random.choice(queries)
+        payload = {"query": item["query"], "history": item.get("history", []), "top_k": item.get("top_k", args.top_k)}
+        request = client.post("/query", json=payload)
+    try:
+        response = await request
+        error = None if response.status_code < 400 else f"http_{response.status_code}"
+    except Exception as e:
+        error = type(e).__name__
+    results.add(kind, time.perf_counter() - planned, error)
+
+
+async def run_level(args, queries, uploads, concurrency):
+    import httpx
+
+    results = Results()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        t0 = time.perf_counter()
+        deadline = t0 + args.duration
+
+        if args.rate:
+            # Open loop: arrivals do not wait for responses, at most `concurrency` are in flight
+            sem = asyncio.Semaphore(concurrency)
+            tasks = []
+
+            async def one(planned):
+                async with sem:
+                    await _send(client, args, queries, uploads, results, planned)
+
+            next_at = t0
+            while next_at < deadline:
+                await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+                tasks.append(asyncio.create_task(one(next_at)))
+                next_at += random.expovariate(args.rate)
+            await asyncio.gather(*tasks)
+        else:
+            async def client_loop():
+                while time.perf_counter() < deadline:
+                    await _send(client, args, queries, uploads, results, time.perf_counter())
+
+            await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+
+        elapsed = time.perf_counter() - t0
+    return {"concurrency": concurrency, "rate": args.rate, "elapsed_s": round(elapsed, 2), "endpoints": results.summary(elapsed)}
+
+
+def _breaks(level, args):
+    for stats in level["endpoints"].values():
+        if stats["error_rate"] > args.max_error_rate or (args.max_p95_ms and stats["p95_ms"] > args.max_p95_ms):
+            return True
+    return False
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Replay query traffic and uploads against the running API")
+    p.add_argument("--base-url", default="http://127.0.0.1:8000")
+    p.add_argument("--queries", default=None, help="JSONL query log; synthetic queries if omitted")
+    p.add_argument("--concurrency", type=int, default=8, help="clients / requests in flight")
+    p.add_argument("--sweep", default=None, help="comma separated concurrency levels, overrides --concurrency")
+    p.add_argument("--rate", type=float, default=None, help="arrivals per second (open loop); closed loop if omitted")
+    p.add_argument("--duration", type=float, default=30.0, help="seconds per concurrency level")
+    p.add_argument("--upload-ratio", type=float, default=0.0, help="share of requests that upload a synthetic PDF")
+    p.add_argument("--upload-pages", type=int, default=3)
+    p.add_argument("--top-k", type=int, default=8)
+    p.add_argument("--timeout", type=float, default=60.0, help="per request timeout in seconds")
+    p.add_argument("--max-error-rate", type=float, default=0.01, help="sweep: error rate that counts as broken")
+    p.add_argument("--max-p95-ms", type=float, default=None, help="sweep: p95 latency that counts as broken")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--out", default=None, help="write the JSON report here (stdout otherwise)")
+    args = p.parse_args(argv)
+
+    random.seed(args.seed)
+    queries = load_queries(args.queries, seed=args.seed)
+    if not queries:
+        sys.exit("No queries to replay.")
+    uploads = UploadPool(args.upload_pages) if args.upload_ratio > 0 else None
+    levels = [int(c) for c in args.sweep.split(",")] if args.sweep else [args.concurrency]
+
+    report = {"base_url": args.base_url, "queries": len(queries), "upload_ratio": args.upload_ratio,
+              "levels": [], "breaking_concurrency": None}
+    for concurrency in levels:
+        level = asyncio.run(run_level(args, queries, uploads, concurrency))
+        report["levels"].append(level)
+        print(json.dumps(level), file=sys.stderr)
+        if _breaks(level, args) and report["breaking_concurrency"] is None:
+            report["breaking_concurrency"] = concurrency
+            if args.sweep:
+                break
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
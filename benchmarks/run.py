@@ -0,0 +1,151 @@
+"""
+Offline per-stage benchmarks for the ingestion and retrieval pipeline.
+
+    python -m benchmarks.run --scale 1k --out benchmarks/results/1k.json
+    python -m benchmarks.compare old.json new.json
+
+Everything runs in a throwaway working directory (the `rag` modules use paths relative to the cwd)
+with the stub embedder / LLM client from `benchmarks.stubs`, so no API key or network is needed.
+"""
+from pathlib import Path
+
+import argparse, json, os, platform, subprocess, sys, tempfile, time
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+SCALES = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+
+
+class Recorder:
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, stage, fn, *args, items=1, **kwargs):
+        t0 = time.perf_counter()
+        out = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - t0
+        s = self.stages.setdefault(stage, {"latencies": [], "items": 0})
+        s["latencies"].append(elapsed)
+        s["items"] += items if not callable(items) else items(out)
+        return out
+
+    def summary(self):
+        out = {}
+        for stage, s in self.stages.items():
+            lat = np.asarray(s["latencies"]) * 1000.0
+            total = float(lat.sum()) / 1000.0
+            out[stage] = {
+                "calls": int(lat.size),
+                "items": int(s["items"]),
+                "total_s": round(total, 4),
+                "throughput_per_s": round(s["items"] / total, 2) if total > 0 else None,
+                "p50_ms": round(float(np.percentile(lat, 50)), 3),
+                "p95_ms": round(float(np.percentile(lat, 95)), 3),
+                "p99_ms": round(float(np.percentile(lat, 99)), 3),
+            }
+        return out
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    n_chunks = SCALES[args.scale]
+    rec = Recorder()
+
+    from benchmarks.stubs import install_stubs
+    install_stubs(args.dim)
+
+    from benchmarks.data import make_pdf, iter_chunk_batches, TextGenerator
+    from rag import active_index, chunker, db, indexer
+    from rag.retriever import get_retriever
+
+    db.init_schema()
+
+    # Extraction + chunking over synthetic PDFs
+    pdf_dir = Path("bench_pdfs")
+    pdf_dir.mkdir(exist_ok=True)
+    for i in range(args.pdfs):
+        path = make_pdf(pdf_dir / f"doc_{i}.pdf", args.pdf_pages, seed=i)
+        pages = rec.time("extract_text_pages", chunker.extract_text_pages, str(path), items=args.pdf_pages)
+        rec.time("make_chunks", chunker.make_chunks, pages, items=len)
+
+    # Storage + indexing, in worker-sized batches
+    db.create_document(id="bench", original_name="bench.pdf", storage_path="", sha256="bench", bytes=0, pages=0)
+    rng = np.random.default_rng(0)
+    for batch in iter_chunk_batches(n_chunks, args.batch_size):
+        ids = rec.time("insert_chunks", db.insert_chunks, "bench", batch, items=len(batch))
+        ids = np.asarray(ids, dtype="int64")
+        vecs = rng.standard_normal((len(batch), args.dim), dtype="float32")
+        vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+        rec.time("add_to_flat_index", indexer.add_to_flat_index, vecs, ids, args.dim, items=len(batch))
+        rec.time("add_to_ivfpq_index", indexer.add_to_ivfpq_index, args.dim, ids, vecs, items=len(batch))
+        rec.time("publish", active_index.publish, chunk_hwm=int(ids.max()), items=len(batch))
+    # keyword search only matches documents whose vectors were published, as the worker marks them
+    db.set_document_stage("bench", db.DocumentStage.INDEXED)
+    db.update_document_status("bench", db.DocumentStatus.INDEXED.value)
+
+    # Query side
+    # queries in the words of the indexed chunks (iter_chunk_batches uses seed 0)
+    gen = TextGenerator(seed=1, vocab_seed=0)
+    retriever = get_retriever()
+    keyword_hits = 0
+    for _ in range(args.queries):
+        q = gen.query()
+        meta = {"semantic_query": q, "keyword_query": q, "must_terms": [], "should_terms": []}
+        rec.time("Retriever.search", retriever.search, q, meta, rerank=False, top_k=args.top_k)
+        fts_query = retriever._get_fts_query(q, [], [])
+        rows = rec.time("match_fts_query", db.match_fts_query, fts_query, args.top_k * 2)
+        keyword_hits += bool(rows)
+    # otherwise both query stages time an empty keyword search
+    assert keyword_hits, "keyword search returned no hits on the bench corpus"
+
+    return {
+        "meta": {
+            "scale": args.scale,
+            "chunks": n_chunks,
+            "dim": args.dim,
+            "batch_size": args.batch_size,
+            "queries": args.queries,
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "stages": rec.summary(),
+    }
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--scale", choices=list(SCALES), default="1k")
+    p.add_argument("--dim", type=int, default=256, help="stub embedding dimension")
+    p.add_argument("--batch-size", type=int, default=512, help="chunks per insert/index call")
+    p.add_argument("--pdfs", type=int, default=3)
+    p.add_argument("--pdf-pages", type=int, default=20)
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--top-k", type=int, default=8)
+    p.add_argument("--workdir", default=None, help="keep the generated data here instead of a temp dir")
+    p.add_argument("--out", default=None, help="write the JSON results here (stdout otherwise)")
+    args = p.parse_args(argv)
+
+    out_path = Path(args.out).resolve() if args.out else None
+    sys.path.insert(0, str(REPO_ROOT))
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="rag-bench-")).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    os.chdir(workdir)
+
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    if out_path:
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        out_path.write_text(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Runs interactive and background callers against `FakeProvider` through the upstream scheduler and
+reports per-priority throughput/latency and how many 429s reached the provider.
+
+    python -m benchmarks.scheduler_sim --rps 5 --seconds 10
+"""
+from pathlib import Path
+
+import argparse, tempfile, threading, time
+import numpy as np
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--rps", type=float, default=5, help="provider limit and scheduler budget")
+    p.add_argument("--latency", type=float, default=0.05)
+    p.add_argument("--seconds", type=float, default=10)
+    p.add_argument("--background-threads", type=int, default=8)
+    p.add_argument("--interactive-every", type=float, default=0.5, help="seconds between interactive calls")
+    args = p.parse_args(argv)
+
+    from benchmarks.stubs import FakeProvider
+    from rag.scheduler import Scheduler, SQLiteTokenBuckets, Priority, priority
+
+    provider = FakeProvider(requests_per_second=int(args.rps), latency=args.latency)
+    buckets = SQLiteTokenBuckets(Path(tempfile.mkdtemp()) / "ratelimit.sqlite3")
+    scheduler = Scheduler(provider="fake", buckets=buckets, requests_per_second=args.rps)
+    latencies = {Priority.INTERACTIVE: [], Priority.BACKGROUND: []}
+    deadline = time.monotonic() + args.seconds
+
+    def caller(prio, pause):
+        with priority(prio):
+            while time.monotonic() < deadline:
+                t0 = time.perf_counter()
+                try:
+                    scheduler.call(provider.complete, tokens=100)
+                    latencies[prio].append(time.perf_counter() - t0)
+                except Exception:
+                    pass
+                time.sleep(pause)
+
+    threads = [threading.Thread(target=caller, args=(Priority.BACKGROUND, 0)) for _ in range(args.background_threads)]
+    threads.append(threading.Thread(target=caller, args=(Priority.INTERACTIVE, args.interactive_every)))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for prio, lat in latencies.items():
+        lat = np.asarray(lat) * 1000 if lat else np.zeros(1)
+        print(f"{prio.name.lower():<12} calls={len(latencies[prio]):<5} "
+              f"p50={np.percentile(lat, 50):8.1f}ms p95={np.percentile(lat, 95):8.1f}ms")
+    print(f"429s seen by the provider: {provider.throttled}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Deterministic local stand-ins for the Mistral embedder and chat client so that the pipeline can be
+benchmarked offline. `install_stubs` registers them as the shared clients in `rag.registry`.
+"""
+from typing import List, get_origin
+
+import hashlib, json
+import numpy as np
+
+STUB_DIM = 256
+
+
+class StubEmbedder:
+    """Random unit vectors seeded by the text hash: same text -> same vector, no network."""
+    def __init__(self, dim: int = STUB_DIM):
+        self.dim = dim
+        self.model = f"stub-{dim}"
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        out = np.empty((len(texts), self.dim), dtype="float32")
+        for i, t in enumerate(texts):
+            seed = int.from_bytes(hashlib.blake2b(t.encode("utf-8"), digest_size=8).digest(), "little")
+            out[i] = np.random.default_rng(seed).standard_normal(self.dim, dtype="float32")
+        out /= np.clip(np.linalg.norm(out, axis=1, keepdims=True), 1e-12, None)
+        return out
+
+
+def _default_for(annotation):
+    origin = get_origin(annotation)
+    if annotation is bool:
+        return True
+    if annotation in (int, float):
+        return 0
+    if origin in (list, List):
+        return []
+    return ""
+
+
+class StubLLMClient:
+    """Returns the query back for free-text calls and an all-defaults object for structured calls."""
+    def chat_query(self, messages, structured=False, **kwargs) -> str:
+        response_format = kwargs.get("response_format")
+        if structured and response_format is not None:
+            fields = {name: _default_for(f.annotation) for name, f in response_format.model_fields.items()}
+            return json.dumps(fields)
+        content = messages[-1]["content"] if messages else ""
+        try:
+            # the refiner sends {"recent_dialogue": ..., "current_query": ...}
+            return json.loads(content)["current_query"]
+        except (ValueError, KeyError, TypeError):
+            return content
+
+    async def achat_query(self, messages, structured=False, **kwargs) -> str:
+        return self.chat_query(messages, structured=structured, **kwargs)
+
+
+def install_stubs(dim: int = STUB_DIM):
+    from rag import registry
+    from rag.embedders import get_embed_model_name
+
+    embedder, client = StubEmbedder(dim), StubLLMClient()
+    registry.override(f"embedder:{get_embed_model_name()}", embedder)
+    registry.override("llm_client", client)
+    return embedder, client
+
+
+class FakeRateLimitError(Exception):
+    status_code = 429
+
+
+class FakeProvider:
+    """
+    Local stand-in for a rate limited provider endpoint: answers after `latency` seconds and raises a
+    429 when more than `requests_per_second` calls arrive within one second.
+    """
+    def __init__(self, requests_per_second=5, latency=0.05):
+        import threading
+
+        self.rps = requests_per_second
+        self.latency = latency
+        self.calls = []
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def complete(self, **kwargs):
+        import time
+
+        now = time.monotonic()
+        with self.lock:
+            self.calls = [t for t in self.calls if now - t < 1.0]
+            if len(self.calls) >= self.rps:
+                self.throttled += 1
+                raise FakeRateLimitError("429 Too Many Requests")
+            self.calls.append(now)
+        time.sleep(self.latency)
+        return kwargs
@@ -0,0 +1,206 @@
+"""
+Which index files queries read, in two levels:
+
+- ACTIVE.json points to the index set that queries and new documents use: its directory and the
+  embedding model its vectors come from. Re-embedding migrations build a new set next to the active
+  one and switch this pointer atomically once it is complete.
+- MANIFEST.json inside every set names the files of its current generation. Writers never modify a
+  published file: they stage new files for the next generation (temp file, fsync, rename) and then
+  publish them by replacing the manifest, which also records the highest chunk id the generation
+  contains. Readers load one manifest and the files it names, so they always see a consistent
+  generation without taking locks. Files of old generations are removed after INDEX_KEEP_GENERATIONS
+  newer ones were published. The one exception are the on-disk IVF posting lists (ivfdata), which
+  are appended to in place; a generation that removes entries writes a new copy (rag/indexer.py).
+"""
+from datetime import datetime, timezone
+from pathlib import Path
+
+import json, os, re, threading
+
+INDEX_DIR = Path("./data/index")
+INDEX_DIR.mkdir(parents=True, exist_ok=True)
+
+ACTIVE_PATH = INDEX_DIR / "ACTIVE.json"
+MANIFEST_NAME = "MANIFEST.json"
+
+# Base names of the versioned files of an index set; generation N of "faiss_flat.index" is
+# "faiss_flat.g<N>.index". Files published before manifests existed keep their base name.
+INDEX_FILES = {
+    "flat": "faiss_flat.index",
+    "ivfpq": "faiss_ivfpq.index",
+    "docs": "faiss_docs.index",
+    # posting lists of the IVFPQ index with IVF_STORAGE=ondisk, named in the ivfpq file
+    "ivfdata": "faiss_ivfpq.ivfdata",
+}
+# Older generations kept for readers that loaded their manifest just before a publish
+INDEX_KEEP_GENERATIONS = int(os.getenv("INDEX_KEEP_GENERATIONS", "2"))
+
+_cache = {"mtime": None, "value": None}
+_lock = threading.Lock()
+_manifests = {}
+_staged = {}
+_GENERATION_RE = re.compile(r"^faiss_(flat|ivfpq|docs)(\.g\d+)?\.(index|ivfdata)$")
+
+
+def read_active():
+    """Returns {"dir": Path, "embed_model": str | None}; cheap enough to call on every query."""
+    try:
+        mtime = ACTIVE_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        # Before the first migration the indexes live directly in INDEX_DIR
+        return {"dir": INDEX_DIR, "embed_model": None}
+
+    with _lock:
+        if _cache["mtime"] != mtime:
+            data = json.loads(ACTIVE_PATH.read_text())
+            _cache["value"] = {"dir": Path(data["dir"]), "embed_model": data.get("embed_model")}
+            _cache["mtime"] = mtime
+        return _cache["value"]
+
+
+def write_active(index_dir, embed_model):
+    tmp = ACTIVE_PATH.with_name(ACTIVE_PATH.name + ".tmp")
+    with tmp.open("w") as f:
+        json.dump({"dir": str(index_dir), "embed_model": embed_model}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, ACTIVE_PATH)
+    _fsync_dir(ACTIVE_PATH.parent)
+
+
+def _fsync_dir(path):
+    # makes the rename itself durable
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _resolve(index_dir):
+    return Path(index_dir) if index_dir is not None else read_active()["dir"]
+
+
+def read_manifest(index_dir=None):
+    """
+    The current generation of an index set: {"dir", "generation", "files", "chunk_hwm",
+    "embed_model", ...}. Generation 0 stands for a set without manifest (legacy file names,
+    no high-water mark).
+    """
+    index_dir = _resolve(index_dir)
+    path = index_dir / MANIFEST_NAME
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return {"dir": index_dir, "generation": 0, "files": dict(INDEX_FILES), "chunk_hwm": None,
+                "embed_model": None, "history": []}
+
+    with _lock:
+        cached = _manifests.get(path)
+        if cached is None or cached[0] != mtime:
+            data = json.loads(path.read_text())
+            data["dir"] = index_dir
+            _manifests[path] = cached = (mtime, data)
+        return cached[1]
+
+
+def index_file(kind, index_dir=None):
+    """Path of `kind` for this process: its staged, unpublished file if any, else the published one."""
+    index_dir = _resolve(index_dir)
+    staged = _staged.get(index_dir.resolve(), {})
+    if kind in staged:
+        return index_dir / staged[kind]
+    return index_dir / read_manifest(index_dir)["files"].get(kind, INDEX_FILES[kind])
+
+
+def _next_name(kind, index_dir):
+    generation = read_manifest(index_dir)["generation"] + 1
+    base, ext = INDEX_FILES[kind].rsplit(".", 1)
+    return f"{base}.g{generation:06d}.{ext}"
+
+
+def stage_path(kind, index_dir=None):
+    """
+    Path of the next generation's `kind` file for writers that create it in place rather than
+    through `stage_file`, e.g. on-disk inverted lists, whose file name is recorded in the index.
+    It is published like a staged file, so it has to be complete before `publish`.
+    """
+    index_dir = _resolve(index_dir)
+    name = _next_name(kind, index_dir)
+    with _lock:
+        _staged.setdefault(index_dir.resolve(), {})[kind] = name
+    return index_dir / name
+
+
+def stage_file(kind, write, index_dir=None):
+    """
+    Writes the next generation's `kind` file with `write(path)` through a temp file, fsync and
+    rename. It stays invisible to readers until `publish`.
+    """
+    index_dir = _resolve(index_dir)
+    name = _next_name(kind, index_dir)
+    tmp = index_dir / f".{name}.tmp"
+    write(tmp)
+    with tmp.open("rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, index_dir / name)
+    with _lock:
+        _staged.setdefault(index_dir.resolve(), {})[kind] = name
+    return index_dir / name
+
+
+def publish(index_dir=None, chunk_hwm=None, embed_model=None):
+    """Makes the staged files (plus the unchanged ones) the next generation. Returns the manifest."""
+    index_dir = _resolve(index_dir)
+    with _lock:
+        staged = _staged.pop(index_dir.resolve(), {})
+    current = read_manifest(index_dir)
+    if not staged and chunk_hwm in (None, current["chunk_hwm"]):
+        return current
+
+    marks = [h for h in (current["chunk_hwm"], chunk_hwm) if h is not None]
+    manifest = {
+        "generation": current["generation"] + 1,
+        "files": {**current["files"], **staged},
+        "chunk_hwm": max(marks) if marks else None,
+        "embed_model": embed_model or current.get("embed_model"),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        # file sets of the previous generations, newest first, still protected from collection
+        "history": ([current["files"]] + current.get("history", []))[:INDEX_KEEP_GENERATIONS],
+    }
+    path = index_dir / MANIFEST_NAME
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(index_dir)
+
+    collect_generations(index_dir, manifest)
+    return read_manifest(index_dir)
+
+
+def collect_generations(index_dir, manifest=None):
+    """Removes index files that neither the current nor the kept generations reference."""
+    manifest = manifest or read_manifest(index_dir)
+    keep = set()
+    for files in [manifest["files"]] + manifest.get("history", []):
+        # manifests written before ivfdata was versioned still use the shared file
+        keep.update({"ivfdata": INDEX_FILES["ivfdata"], **files}.values())
+    with _lock:
+        keep.update(_staged.get(Path(index_dir).resolve(), {}).values())
+    for path in Path(index_dir).iterdir():
+        if path.is_file() and _GENERATION_RE.match(path.name) and path.name not in keep:
+            path.unlink(missing_ok=True)
+
+
+def remove_index_files(index_dir):
+    """Removes every generation and the manifest of an index set, e.g. once it was replaced."""
+    index_dir = Path(index_dir)
+    with _lock:
+        _staged.pop(index_dir.resolve(), None)
+    for path in index_dir.iterdir():
+        if path.is_file() and _GENERATION_RE.match(path.name):
+            path.unlink(missing_ok=True)
+    (index_dir / MANIFEST_NAME).unlink(missing_ok=True)
@@ -0,0 +1,107 @@
+from rag.embedders import get_embedder
+from rag.db import get_document_versions, get_corpus_version
+from dotenv import load_dotenv, find_dotenv
+from rag.registry import lazy_module
+from collections import OrderedDict
+
+import os, threading
+import numpy as np
+
+faiss = lazy_module("faiss")
+
+load_dotenv(find_dotenv(), override=True)
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "True") == "True"
+# Cosine similarity between refined queries above which a cached answer is reused
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+# Nearest entries checked for one with matching request parameters
+_CANDIDATES = 8
+
+
+class AnswerCache:
+    """
+    Caches final answers keyed by the embedding of the refined query. A query that is close enough
+    (cosine similarity) to an already answered one gets the stored answer back instead of going
+    through intent -> retrieve -> rerank -> answer again.
+
+    Entries are dropped as soon as one of the documents they cite changes. Entries that searched the
+    knowledge base but found nothing are tied to the whole corpus instead, so that they are dropped
+    once new documents are indexed.
+
+    `params` are the request parameters the answer depends on (top_k, rrf_k, pipeline, ...); an
+    entry is only reused for a request with the same ones.
+    """
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.index = None
+        self.entries = OrderedDict()
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def embed(self, query):
+        return get_embedder().embed([query]).astype("float32")
+
+    def _remove(self, entry_id):
+        self.entries.pop(entry_id, None)
+        self.index.remove_ids(np.array([entry_id], dtype="int64"))
+
+    def _is_valid(self, entry):
+        if entry["documents"]:
+            return get_document_versions(list(entry["documents"])) == entry["documents"]
+        if entry["corpus_version"] is not None:
+            return get_corpus_version() == entry["corpus_version"]
+        return True
+
+    def get(self, vec, params=None):
+        with self.lock:
+            if self.index is None or self.index.ntotal == 0 or self.index.d != vec.shape[1]:
+                return None, 0.0
+            scores, labels = self.index.search(vec, min(_CANDIDATES, self.index.ntotal))
+            entry_id, score, entry = -1, float(scores[0][0]), None
+            for i, s in zip(labels[0], scores[0]):
+                if i == -1 or s < self.threshold:
+                    break
+                candidate = self.entries.get(int(i))
+                if candidate is not None and candidate["params"] == params:
+                    entry_id, score, entry = int(i), float(s), candidate
+                    break
+
+        if entry is None:
+            return None, score
+        if not self._is_valid(entry):
+            with self.lock:
+                if entry_id in self.entries:
+                    self._remove(entry_id)
+            return None, score
+        return entry["response"], score
+
+    def put(self, vec, response, params=None):
+        cited = sorted({r["document_id"] for r in response.get("results", [])})
+        entry = {
+            "response": response,
+            "params": params,
+            "documents": get_document_versions(cited),
+            # only searches that came back empty depend on the rest of the corpus
+            "corpus_version": get_corpus_version() if response.get("trigger") and not cited else None,
+        }
+        with self.lock:
+            if self.index is None or self.index.d != vec.shape[1]:
+                self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(vec.shape[1]))
+                self.entries.clear()
+
+            entry_id = self.next_id
+            self.next_id += 1
+            self.index.add_with_ids(vec, np.array([entry_id], dtype="int64"))
+            self.entries[entry_id] = entry
+
+            while len(self.entries) > self.max_entries:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+
+
+def get_answer_cache():
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    return AnswerCache()
@@ -1,8 +1,8 @@
 from rag.llm_client import get_llm_client
-from rag.retriever import get_retriever
+from rag.registry import shared
 
-LLM_CLIENT = get_llm_client()
-RETRIEVER = get_retriever()
+# Other pages with a passage's text named in the prompt, the rest only counted
+ANSWER_ALSO_IN = 3
 
 SYSTEM_WITH_RAG = """You are a helpful assistant that is triggered to answer queries that it is RAG
 based. Hence, use ONLY the provided context to answer and do not use any outside information at all.
@@ -17,16 +17,24 @@ only answer based off of your knowledge base, which are uploaded documents."""
 
 
 class ChatAssitant:
-    def __init__(self):
-        self.llm_client = LLM_CLIENT
-        self.retriever = RETRIEVER
+    @property
+    def llm_client(self):
+        return get_llm_client()
 
-    def answer(self, rag_trigger, rag_vectors, query, **kwargs):
-        if rag_trigger and rag_vectors:
+    def answer(self, rag_trigger, passages, query, **kwargs):
+        """`passages` are the packed context (rag/context_packer.py), best ranked first."""
+        if rag_trigger and passages:
             contexts = []
-            for r in rag_vectors:
-                contexts.append(f"Rank=[S{r.rank}] Document_Name={r.document_name} Page_Num={r.page_num}")
-                contexts.append(r.text.strip())
+            for p in passages:
+                ranks = "".join(f"[S{r}]" for r in p.ranks)
+                pages = p.page_num if p.page_span == 1 else f"{p.page_num}-{p.page_num + p.page_span - 1}"
+                contexts.append(f"Rank={ranks} Document_Name={p.document_name} Page_Num={pages}")
+                if p.also_in:
+                    # near-duplicate text on other pages, citable as well
+                    also_in = "; ".join(f"{l['document_name']}, {l['page_num']}" for l in p.also_in[:ANSWER_ALSO_IN])
+                    more = max(p.also_in_count, len(p.also_in)) - min(len(p.also_in), ANSWER_ALSO_IN)
+                    contexts.append("Also_In=" + also_in + (f" (+{more} more pages)" if more else ""))
+                contexts.append(p.text.strip())
                 contexts.append("")
             ctx = "\n".join(contexts).strip()
             messages = [
@@ -42,4 +50,4 @@ class ChatAssitant:
         return response
     
 def get_chat_assistant():
-    return ChatAssitant()
\ No newline at end of file
+    return shared("chat_assistant", ChatAssitant)
\ No newline at end of file
@@ -1,12 +1,28 @@
-import os, fitz
+import os, re
+from bisect import bisect_right
+from itertools import accumulate
 from dotenv import load_dotenv, find_dotenv
+from rag.embedders import get_embed_model_name
+from rag.registry import lazy_module
+
+fitz = lazy_module("fitz")
 
 load_dotenv(find_dotenv(), override=True)
 
-CHUNK_SIZE=400
-OVERLAP = 200
+# Budget of a chunk in characters, or in tokens when CHUNK_MAX_TOKENS is set
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "400"))
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "0"))
+# Characters of trailing context repeated at the start of the next chunk (whole sentences only)
+OVERLAP = int(os.getenv("CHUNK_OVERLAP", "50"))
 RETRIES = 5
-EMBED_MODEL = os.getenv("MISTRAL_EMBED_MODEL", "")
+# Joins the pages of a document into the text that is chunked, must be whitespace
+PAGE_BREAK = "\n"
+
+# A sentence ends at ./!/? followed by whitespace, a paragraph at a blank line
+_SENTENCE_END_RE = re.compile(r"[.!?][\"')\]]*\s+|\n\s*\n")
+_WORD_END_RE = re.compile(r"\s+")
+# Rough stand-in for a subword tokenizer: words and individual punctuation marks
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
 
 def extract_text_pages(pdf_path: str):
     pages = []
@@ -17,26 +33,119 @@ def extract_text_pages(pdf_path: str):
 
     return pages
 
-def make_chunks(pages, size=CHUNK_SIZE, overlap = OVERLAP):
-    chunks, ordinal = [], 0
+def count_tokens(text):
+    return len(_TOKEN_RE.findall(text))
 
-    for page_num, page in enumerate(pages, start=1):
-        start = 0
-        while start < len(page):
-            end = min(len(page), start + size)
-            chunk_text = page[start:end]
-            chunks.append({
-                "text": chunk_text,
-                "ordinal": ordinal,
-                "page_num": page_num,
-                "start": start,
-                "end": end,
-                "embed_model": EMBED_MODEL
-            })
+def truncate_tokens(text, max_tokens):
+    """The longest prefix of `text` with at most `max_tokens` tokens."""
+    if max_tokens <= 0:
+        return ""
+    for i, m in enumerate(_TOKEN_RE.finditer(text), start=1):
+        if i == max_tokens:
+            return text[:m.end()]
+    return text
+
+def _split_points(text, regex):
+    return [m.end() for m in regex.finditer(text)]
+
+def _segments(page, size):
+    """Split a page into (start, end) spans at sentence/paragraph ends; overly long sentences are
+    split further at word boundaries, and only as a last resort in the middle of a word."""
+    spans, start = [], 0
+    for end in _split_points(page, _SENTENCE_END_RE) + [len(page)]:
+        if end <= start:
+            continue
+        while end - start > size:
+            cut = max((p for p in _split_points(page[start:start + size], _WORD_END_RE) if p > 0), default=size)
+            spans.append((start, start + cut))
+            start += cut
+        spans.append((start, end))
+        start = end
+    return spans
+
+def _split_tokens(page, spans, max_tokens):
+    """Splits the spans with more than `max_tokens` tokens at token starts into spans that fit."""
+    out = []
+    for start, end in spans:
+        starts = [m.start() for m in _TOKEN_RE.finditer(page, start, end)]
+        if len(starts) <= max_tokens:
+            out.append((start, end))
+            continue
+        cuts = [start] + starts[max_tokens::max_tokens] + [end]
+        out.extend(zip(cuts[:-1], cuts[1:]))
+    return out
+
+def _trimmed(page, start, end):
+    # keep the offsets pointing at the actual (whitespace stripped) text
+    while start < end and page[start].isspace():
+        start += 1
+    while end > start and page[end - 1].isspace():
+        end -= 1
+    return start, end
+
+def iter_chunks(pages, size=CHUNK_SIZE, overlap=OVERLAP, max_tokens=CHUNK_MAX_TOKENS):
+    """
+    Yields chunks one at a time, packing whole sentences until the budget (characters, or tokens
+    if `max_tokens` is set) is reached. The next chunk starts with the last sentences of the previous
+    one as long as they fit in `overlap` characters.
 
+    The pages are chunked as one text joined with PAGE_BREAK, so a chunk can continue onto the next
+    page instead of ending with whatever is left of a page. `page_num` and `start` locate the chunk's first character, `page_span` is the
+    number of pages it covers and `end` is the offset in its last page: the text of a chunk within a
+    page is page[start:end], one spanning pages is the rest of the first page, PAGE_BREAK and the
+    following pages up to `end` in the last one.
+    """
+    def fits(text):
+        if max_tokens:
+            return count_tokens(text) <= max_tokens
+        return len(text) <= size
+
+    text = PAGE_BREAK.join(pages)
+    page_starts = list(accumulate((len(p) + len(PAGE_BREAK) for p in pages[:-1]), initial=0))
+
+    def locate(offset):
+        # (0 based page, offset in that page) of a character of `text`
+        page = bisect_right(page_starts, offset) - 1
+        return page, offset - page_starts[page]
+
+    # with a token budget, a segment of `size` characters is only a starting point
+    spans = _segments(text, size if not max_tokens else max(size, max_tokens * 4))
+    if max_tokens:
+        # a single sentence may still be over the budget
+        spans = _split_tokens(text, spans, max_tokens)
+
+    ordinal = 0
+    embed_model = get_embed_model_name()
+    i = 0
+    while i < len(spans):
+        j = i
+        while j + 1 < len(spans) and fits(text[spans[i][0]:spans[j + 1][1]]):
+            j += 1
+
+        start, end = _trimmed(text, spans[i][0], spans[j][1])
+        if end > start:
+            # trimmed, so neither the first nor the last character is part of a PAGE_BREAK
+            first_page, page_start = locate(start)
+            last_page, page_end = locate(end - 1)
+            yield {
+                "text": text[start:end],
+                "ordinal": ordinal,
+                "page_num": first_page + 1,
+                "page_span": last_page - first_page + 1,
+                "start": page_start,
+                "end": page_end + 1,
+                "embed_model": embed_model
+            }
             ordinal += 1
-            if end == len(page):
-                break
 
-            start = end - overlap
-    return chunks
\ No newline at end of file
+        if j + 1 == len(spans):
+            # the rest would only repeat the overlap
+            break
+        # step back over the trailing sentences that fit in the overlap, but always move forward
+        nxt = j + 1
+        while nxt - 1 > i and spans[j][1] - spans[nxt - 1][0] <= overlap:
+            nxt -= 1
+        i = nxt
+
+def make_chunks(pages, size=CHUNK_SIZE, overlap=OVERLAP, max_tokens=CHUNK_MAX_TOKENS):
+    return list(iter_chunks(pages, size=size, overlap=overlap, max_tokens=max_tokens))
@@ -0,0 +1,120 @@
+"""
+Assembles the context of an answer from the ranked search results.
+
+Neighbouring chunks overlap (CHUNK_OVERLAP), and the top results often include several chunks of the
+same page, so sending every chunk as is repeats text. Chunks of the same document and page whose
+`start_char`/`end_char` spans overlap or touch are merged back into one contiguous passage, and the
+passages are then added in order of their best rank until CONTEXT_TOKEN_BUDGET is used up. A chunk
+continuing onto the next page(s) is kept as a passage of its own.
+"""
+from dataclasses import dataclass, field
+from typing import List
+
+import os
+
+from rag.chunker import count_tokens, truncate_tokens
+from rag.db import ALSO_IN_LIMIT
+
+# Tokens of retrieved text sent to the answering LLM
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Spans at most this many characters apart (the whitespace trimmed off chunks) count as touching
+CONTEXT_MERGE_GAP = int(os.getenv("CONTEXT_MERGE_GAP", "2"))
+
+
+@dataclass
+class Passage:
+    ranks: List[int]
+    document_id: str
+    document_name: str
+    page_num: int
+    page_span: int      # pages covered from page_num on
+    start_char: int
+    end_char: int
+    text: str
+    also_in: List[dict] = field(default_factory=list)
+    also_in_count: int = 0      # other pages with this text, also_in lists at most ALSO_IN_LIMIT
+
+
+@dataclass
+class PackedContext:
+    passages: List[Passage]
+    tokens: int
+    chunks: int         # results the passages were built from
+    dropped: int        # passages left out for lack of budget
+
+    def debug(self):
+        return {"passages": len(self.passages), "tokens": self.tokens, "chunks": self.chunks, "dropped": self.dropped}
+
+
+def _get(r, key, default=None):
+    # search result dicts and `Source` models alike
+    return r.get(key, default) if isinstance(r, dict) else getattr(r, key, default)
+
+
+def _exact(r):
+    # merging relies on the text being exactly page[start_char:end_char]
+    start, end = _get(r, "start_char"), _get(r, "end_char")
+    return (start is not None and end is not None and (_get(r, "page_span") or 1) == 1
+            and len(_get(r, "text", "")) == end - start)
+
+
+def merge_passages(results):
+    """Passages of the ranked `results`, ordered by their best rank."""
+    groups = {}
+    for rank, r in enumerate(results, start=1):
+        groups.setdefault((_get(r, "document_id"), _get(r, "page_num")), []).append((rank, r))
+
+    passages = []
+    for (document_id, page_num), members in groups.items():
+        current = None
+        for rank, r in sorted(members, key=lambda m: (_get(m[1], "start_char") or 0, m[0])):
+            text = _get(r, "text", "") or ""
+            if (current is not None and _exact(r) and current.end_char >= 0
+                    and _get(r, "start_char") <= current.end_char + CONTEXT_MERGE_GAP):
+                start, end = _get(r, "start_char"), _get(r, "end_char")
+                if end > current.end_char:
+                    if start >= current.end_char:
+                        current.text += " " + text
+                    else:
+                        current.text += text[current.end_char - start:]
+                    current.end_char = end
+                current.ranks.append(rank)
+            else:
+                current = Passage(
+                    ranks=[rank], document_id=document_id, document_name=_get(r, "document_name"),
+                    page_num=page_num, page_span=_get(r, "page_span") or 1, start_char=_get(r, "start_char") or 0,
+                    end_char=_get(r, "end_char") if _exact(r) else -1, text=text)
+                passages.append(current)
+            seen = {(l["document_id"], l["page_num"]) for l in current.also_in}
+            for loc in _get(r, "also_in") or []:
+                loc = loc if isinstance(loc, dict) else loc.model_dump()
+                if len(current.also_in) < ALSO_IN_LIMIT and (loc["document_id"], loc["page_num"]) not in seen:
+                    seen.add((loc["document_id"], loc["page_num"]))
+                    current.also_in.append(loc)
+            current.also_in_count = max(current.also_in_count, _get(r, "also_in_count") or 0, len(current.also_in))
+
+    for p in passages:
+        p.ranks.sort()
+    passages.sort(key=lambda p: p.ranks[0])
+    return passages
+
+
+def pack_context(results, budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Greedily fills `budget` tokens with the merged passages, best ranked first; a passage that does
+    not fit is skipped in favour of smaller, lower ranked ones. The best passage is truncated rather
+    than dropped if it alone exceeds the budget.
+    """
+    passages = merge_passages(results)
+    packed, used, dropped = [], 0, 0
+    for p in passages:
+        n = count_tokens(p.text)
+        if used + n > budget:
+            if packed or budget <= 0:
+                dropped += 1
+                continue
+            p.text = truncate_tokens(p.text, budget)
+            n = count_tokens(p.text)
+        packed.append(p)
+        used += n
+    return PackedContext(packed, used, len(results), dropped)
@@ -1,12 +1,33 @@
-import sqlite3, os
+import sqlite3, os, threading, json
+from collections import OrderedDict
 from enum import Enum
 
+from rag.dedup import DEDUP_ENABLED, DEDUP_THRESHOLD, sketch, shingles, jaccard
+from rag.metrics import FTS_CACHE_REQUESTS
+
 class DocumentStatus(Enum):
     UPLOADED = "UPLOADED"
     PROCESSING = "PROCESSING"
     INDEXED = "INDEXED"
     FAILED = "FAILED"
 
+class DocumentStage(Enum):
+    # Last completed step of the indexing pipeline, in order
+    EXTRACTED = "EXTRACTED"
+    CHUNKED = "CHUNKED"
+    EMBEDDED = "EMBEDDED"
+    INDEXED = "INDEXED"
+
+_STAGE_ORDER = [None] + [s.value for s in DocumentStage]
+
+def stage_reached(current, stage):
+    return _STAGE_ORDER.index(current) >= _STAGE_ORDER.index(stage.value)
+
+class MigrationStatus(Enum):
+    RUNNING = "RUNNING"
+    DONE = "DONE"
+    CANCELLED = "CANCELLED"
+
 class JobStatus(Enum):
     QUEUED = "QUEUED"
     RUNNING = "RUNNING"
@@ -16,6 +37,18 @@ class JobStatus(Enum):
 # hard coded for now for simple control but could be taken in using env
 DB_PATH = "data/db.sqlite3"
 
+# FTS5 merges segments on its own once this many of the same level exist; higher values make writes
+# cheaper and leave more segments for queries to visit until the next optimize
+FTS_AUTOMERGE = int(os.getenv("FTS_AUTOMERGE", "8"))
+# Segments on one level before a writer is forced to merge them inline
+FTS_CRISISMERGE = int(os.getenv("FTS_CRISISMERGE", "16"))
+# Pages merged per optimize step; each step is a short write transaction
+FTS_MERGE_PAGES = int(os.getenv("FTS_MERGE_PAGES", "500"))
+# Number of MATCH results kept in memory per process, 0 disables the cache
+FTS_CACHE_SIZE = int(os.getenv("FTS_CACHE_SIZE", "2048"))
+# Other locations of a chunk's text listed per search result; the rest are only counted
+ALSO_IN_LIMIT = int(os.getenv("ALSO_IN_LIMIT", "20"))
+
 # could live in a separate file, but left here for now
 SCHEMA = """
 -- Table to store the pdf documents
@@ -27,6 +60,7 @@ CREATE TABLE IF NOT EXISTS documents(
           bytes INTEGER NOT NULL,
           pages INTEGER,
           status TEXT NOT NULL,        -- UPLOADED|PROCESSING|INDEXED|FAILED
+          stage TEXT,                  -- EXTRACTED|CHUNKED|EMBEDDED|INDEXED, last completed indexing step
           error_msg TEXT,
           created_at TEXT DEFAULT CURRENT_TIMESTAMP,
           updated_at TEXT DEFAULT CURRENT_TIMESTAMP
@@ -44,6 +78,8 @@ CREATE TABLE IF NOT EXISTS documents(
           status TEXT NOT NULL,        -- QUEUED|RUNNING|DONE|FAILED
           created_at TEXT DEFAULT CURRENT_TIMESTAMP,
           updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+          attempts INTEGER NOT NULL DEFAULT 0,
+          not_before TEXT,             -- a retried job waits until then (backoff)
           error_msg TEXT
         );
 
@@ -57,14 +93,87 @@ CREATE TABLE IF NOT EXISTS documents(
           page_num INT,
           start_char INT,
           end_char INT,
-          embed_model TEXT
+          embed_model TEXT,
+          canonical_id INTEGER,        -- set for near-duplicates: the chunk whose text and vector they share
+          page_span INT                -- pages covered from page_num on, end_char is in the last one
+        );
+
+        CREATE INDEX IF NOT EXISTS ix_chunk_doc ON chunk_meta(document_id);
+        CREATE INDEX IF NOT EXISTS ix_chunk_canonical ON chunk_meta(canonical_id);
+
+        -- MinHash LSH bands of canonical chunks, to find near-duplicates of new chunks (rag/dedup.py)
+        CREATE TABLE IF NOT EXISTS chunk_lsh(
+          band_key INTEGER NOT NULL,
+          chunk_id INTEGER NOT NULL
+        );
+
+        CREATE INDEX IF NOT EXISTS ix_lsh_band ON chunk_lsh(band_key);
+        CREATE INDEX IF NOT EXISTS ix_lsh_chunk ON chunk_lsh(chunk_id);
+
+        -- Re-embedding migrations: the corpus is embedded with a new model into a separate index set
+        -- while the active one keeps serving queries
+        CREATE TABLE IF NOT EXISTS migrations(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          target_model TEXT NOT NULL,
+          index_dir TEXT NOT NULL,
+          status TEXT NOT NULL,        -- RUNNING|DONE|CANCELLED
+          cursor INTEGER NOT NULL DEFAULT 0,     -- highest chunk id already re-embedded
+          migrated INTEGER NOT NULL DEFAULT 0,
+          created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+          updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+
+        -- Progress of documents through the pipeline, written by the worker and pushed to API clients
+        CREATE TABLE IF NOT EXISTS document_events(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          document_id TEXT NOT NULL,
+          kind TEXT NOT NULL,          -- status|stage|progress|retry
+          name TEXT NOT NULL,          -- the new status or stage, or what a progress event counts
+          done INTEGER,
+          total INTEGER,
+          message TEXT,
+          created_at TEXT DEFAULT CURRENT_TIMESTAMP
         );
 
+        CREATE INDEX IF NOT EXISTS ix_events_doc ON document_events(document_id, id);
+
+        -- Server-side conversations (rag/sessions.py): a rolling summary, the turns not summarized yet
+        -- and the last turn verbatim
+        CREATE TABLE IF NOT EXISTS sessions(
+          id TEXT PRIMARY KEY,
+          summary TEXT NOT NULL DEFAULT '',
+          pending TEXT NOT NULL DEFAULT '[]',   -- JSON list of earlier turns waiting to be summarized
+          last_user TEXT,
+          last_assistant TEXT,
+          turns INTEGER NOT NULL DEFAULT 0,
+          created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+          updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE INDEX IF NOT EXISTS ix_sessions_updated ON sessions(updated_at);
+
         -- Table to store the actual text chunks so that we can also performm keyword search
         -- Uses SQLite's built-in full-text index and English Porter stemmer to find keywords
+        -- Prefix indexes keep `term*` queries from scanning every term sharing the prefix; FTS5 options
+        -- cannot be changed on an existing table, so older databases keep serving without them
         CREATE VIRTUAL TABLE IF NOT EXISTS chunk_fts USING fts5(
-          text, tokenize='porter'
+          text, tokenize='porter', prefix='2 3'
         );
+
+        -- Document-level keyword stats for query routing: the most frequent terms of every document,
+        -- rowid is the document's rowid in `documents`
+        CREATE VIRTUAL TABLE IF NOT EXISTS doc_fts USING fts5(
+          terms, tokenize='porter'
+        );
+
+        -- Small named counters: fts_version changes whenever chunk_fts content changes (invalidates
+        -- cached MATCH results), fts_pending counts chunks written since the last optimize
+        CREATE TABLE IF NOT EXISTS counters(
+          key TEXT PRIMARY KEY,
+          value INTEGER NOT NULL DEFAULT 0
+        );
+
+        INSERT OR IGNORE INTO counters(key, value) VALUES('fts_version', 0), ('fts_pending', 0);
 """
 os.makedirs("./data", exist_ok=True)
 
@@ -75,27 +184,56 @@ def _connect():
     con.execute("PRAGMA synchronous=NORMAL;")
     return con
 
+# Columns added after the first release; CREATE TABLE IF NOT EXISTS does not add them to old databases
+_ADDED_COLUMNS = [
+    ("documents", "stage", "TEXT"),
+    ("jobs", "attempts", "INTEGER NOT NULL DEFAULT 0"),
+    ("jobs", "not_before", "TEXT"),
+    ("chunk_meta", "canonical_id", "INTEGER"),
+    ("chunk_meta", "page_span", "INT"),
+]
+
+def _add_missing_columns(con):
+    for table, column, decl in _ADDED_COLUMNS:
+        existing = {r["name"] for r in con.execute(f"PRAGMA table_info({table})")}
+        if column not in existing:
+            con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
 def init_schema():
     with _connect() as con:
+        # old databases first get their new columns, then the rest of the schema is applied
+        if con.execute("SELECT 1 FROM sqlite_master WHERE name='documents'").fetchone():
+            _add_missing_columns(con)
         con.executescript(SCHEMA)
+        # Stored in the index itself, so this also retunes existing databases
+        con.execute("INSERT INTO chunk_fts(chunk_fts, rank) VALUES('automerge', ?)", (FTS_AUTOMERGE,))
+        con.execute("INSERT INTO chunk_fts(chunk_fts, rank) VALUES('crisismerge', ?)", (FTS_CRISISMERGE,))
     return True
 
 def create_document(*, id, original_name, storage_path, sha256, bytes, pages):
+    # Returns False if a document with the same content already exists
     with _connect() as con:
-        con.execute(
+        created = con.execute(
             """INSERT OR IGNORE INTO documents
             (id, original_name, storage_path, sha256, bytes, pages, status)
             VALUES(?,?,?,?,?,?,?)""",
-            (id, original_name, storage_path, sha256, bytes, pages, DocumentStatus.UPLOADED.value))
+            (id, original_name, storage_path, sha256, bytes, pages, DocumentStatus.UPLOADED.value)).rowcount > 0
+        if created:
+            _add_event(con, id, "status", DocumentStatus.UPLOADED.value)
+        return created
         
 def get_document(document_id):
     with _connect() as con:
         return con.execute("SELECT * FROM documents WHERE id=?", (document_id, )).fetchone()
+
+def get_document_by_sha(sha256):
+    with _connect() as con:
+        return con.execute("SELECT * FROM documents WHERE sha256=?", (sha256, )).fetchone()
         
 def enqueue_index_job(document_id, document_sha):
     with _connect() as con:
         con.execute(
-            """INSERT INTO jobs
+            """INSERT OR IGNORE INTO jobs
             (document_id, document_sha, status, type)
             VALUES(?,?,?, 'INDEX_DOCUMENT')""",
             (document_id, document_sha, JobStatus.QUEUED.value, )
@@ -109,11 +247,81 @@ def update_document_status(document_id, status, pages=None, error=None):
             WHERE id=?""",
             (status, pages, error, document_id)
         )
+        _add_event(con, document_id, "status", status, message=error)
+
+def set_document_stage(document_id, stage):
+    with _connect() as con:
+        row = con.execute("SELECT stage FROM documents WHERE id=?", (document_id,)).fetchone()
+        if DocumentStage.INDEXED.value in (row and row[0], stage and stage.value):
+            # the document's chunks enter or leave the keyword results
+            _fts_changed(con, 0)
+        con.execute(
+            "UPDATE documents SET stage=?, updated_at=CURRENT_TIMESTAMP WHERE id=?",
+            (stage.value if stage else None, document_id)
+        )
+        if stage:
+            _add_event(con, document_id, "stage", stage.value)
+
+def _add_event(con, document_id, kind, name, done=None, total=None, message=None):
+    con.execute(
+        "INSERT INTO document_events(document_id, kind, name, done, total, message) VALUES(?,?,?,?,?,?)",
+        (document_id, kind, name, done, total, message)
+    )
+
+def add_document_event(document_id, kind, name, done=None, total=None, message=None):
+    with _connect() as con:
+        _add_event(con, document_id, kind, name, done, total, message)
+
+def get_document_events(document_id, after_id=0, limit=500):
+    with _connect() as con:
+        cur = con.execute(
+            """SELECT id, kind, name, done, total, message, created_at FROM document_events
+            WHERE document_id=? AND id>? ORDER BY id LIMIT ?""",
+            (document_id, int(after_id), int(limit))
+        )
+        return [dict(r) for r in cur]
+
+def get_document_progress(document_id):
+    # Latest value of every progress counter of the document, and its last event id
+    with _connect() as con:
+        cur = con.execute(
+            """SELECT name, done, total FROM document_events WHERE id IN (
+                SELECT MAX(id) FROM document_events WHERE document_id=? AND kind='progress' GROUP BY name
+            )""",
+            (document_id,)
+        )
+        progress = {r["name"]: {"done": r["done"], "total": r["total"]} for r in cur}
+        last = con.execute("SELECT MAX(id) FROM document_events WHERE document_id=?", (document_id,)).fetchone()[0]
+        return progress, last or 0
+
+def prune_document_events(keep_hours):
+    # Progress, stage and retry events of documents that reached INDEXED/FAILED more than
+    # `keep_hours` ago; their status events stay, so the final state remains readable
+    with _connect() as con:
+        return con.execute(
+            """DELETE FROM document_events WHERE kind != 'status' AND document_id IN (
+                SELECT id FROM documents WHERE status IN (?, ?) AND updated_at < datetime('now', ?)
+            )""",
+            (DocumentStatus.INDEXED.value, DocumentStatus.FAILED.value, f"-{int(keep_hours)} hours")
+        ).rowcount
+
+def get_events_cursor():
+    with _connect() as con:
+        return con.execute("SELECT COALESCE(MAX(id), 0) FROM document_events").fetchone()[0]
+
+def get_evented_documents(after_id):
+    # The documents that got events after `after_id`, and the new cursor
+    with _connect() as con:
+        rows = con.execute("SELECT id, document_id FROM document_events WHERE id>? ORDER BY id", (int(after_id),)).fetchall()
+        if not rows:
+            return after_id, set()
+        return rows[-1]["id"], {r["document_id"] for r in rows}
 
 def get_job():
     with _connect() as con:
         row = con.execute(
             """SELECT id FROM jobs WHERE status=?
+                AND (not_before IS NULL OR not_before <= CURRENT_TIMESTAMP)
                 ORDER BY created_at LIMIT 1""",
                 (JobStatus.QUEUED.value,)
         ).fetchone()
@@ -124,7 +332,7 @@ def get_job():
         job_id = row["id"]
         current = con.execute(
             """UPDATE jobs
-                SET status=?, updated_at=CURRENT_TIMESTAMP
+                SET status=?, attempts=attempts+1, updated_at=CURRENT_TIMESTAMP
                 WHERE id=? AND status=?""",
             (JobStatus.RUNNING.value, job_id, JobStatus.QUEUED.value)
         )
@@ -142,32 +350,77 @@ def mark_job_done(job_id):
             (JobStatus.DONE.value, job_id)
         )
 
-def mark_job_failed(job_id, error_msg):
+def mark_job_failed(job_id, error_msg, retry=False, delay=0):
+    # A retried job goes back to the queue, is picked up again after `delay` seconds and resumes
+    # from its document's last completed stage
     with _connect() as con:
         con.execute(
-            """UPDATE jobs SET status=?, 
+            """UPDATE jobs SET status=?, not_before=datetime('now', ?),
                 error_msg=?, updated_at=CURRENT_TIMESTAMP WHERE id=?""",
-            (JobStatus.FAILED.value, error_msg[:2000], job_id)
+            (JobStatus.QUEUED.value if retry else JobStatus.FAILED.value, f"+{int(delay)} seconds",
+             error_msg[:2000], job_id)
         )
 
-def insert_chunks(doc_id, chunks):
+def requeue_running_jobs():
+    # Jobs left RUNNING by a worker that died; only safe to call while no other worker is running
+    with _connect() as con:
+        return con.execute(
+            "UPDATE jobs SET status=?, updated_at=CURRENT_TIMESTAMP WHERE status=?",
+            (JobStatus.QUEUED.value, JobStatus.RUNNING.value)
+        ).rowcount
+
+def _find_canonical(con, doc_id, grams, keys):
+    # Candidates are canonical chunks of indexed documents, whose chunks are never rewritten, or of
+    # this document, whose chunks are only ever deleted together with their duplicates
+    placeholders = ",".join("?" for _ in keys)
+    cur = con.execute(
+        f"""SELECT DISTINCT l.chunk_id, t.text FROM chunk_lsh l
+        JOIN chunk_meta m ON m.id = l.chunk_id
+        JOIN documents d ON d.id = m.document_id
+        JOIN chunk_fts t ON t.rowid = l.chunk_id
+        WHERE l.band_key IN ({placeholders}) AND (m.document_id = ? OR d.status = ?)""",
+        (*keys, doc_id, DocumentStatus.INDEXED.value)
+    )
+    best, best_sim = None, DEDUP_THRESHOLD
+    for chunk_id, text in cur:
+        sim = jaccard(grams, shingles(text))
+        if sim >= best_sim:
+            best, best_sim = chunk_id, sim
+    return best
+
+def insert_chunks(doc_id, chunks, dedup=DEDUP_ENABLED):
+    """
+    Stores the chunks, returns their ids. With `dedup`, a near-duplicate of a stored chunk only gets
+    a `chunk_meta` row and its `canonical_id` is set on the chunk dict.
+    """
     ids = []
     with _connect() as con:
         # Ensure that the insertion is atomic
         con.execute("BEGIN")
         try:
+            n_text = 0
             for c in chunks:
+                sk = sketch(c["text"]) if dedup else None
+                c["canonical_id"] = _find_canonical(con, doc_id, *sk) if sk else None
                 # Meta Data
                 row_id = con.execute(
                     """INSERT INTO chunk_meta
-                    (document_id, ordinal, page_num, start_char, end_char, embed_model)
-                    VALUES(?,?,?,?,?,?) RETURNING id""",
-                    (doc_id, c["ordinal"], c["page_num"], c["start"], c["end"], c["embed_model"])
+                    (document_id, ordinal, page_num, page_span, start_char, end_char, embed_model, canonical_id)
+                    VALUES(?,?,?,?,?,?,?,?) RETURNING id""",
+                    (doc_id, c["ordinal"], c["page_num"], c["page_span"], c["start"], c["end"], c["embed_model"],
+                     c["canonical_id"])
                 ).fetchone()[0]
                 ids.append(row_id)
+                if c["canonical_id"] is not None:
+                    continue
 
                 # Actual text
                 con.execute("INSERT INTO chunk_fts(rowid, text) VALUES(?,?)", (row_id, c["text"]))
+                n_text += 1
+                if sk:
+                    con.executemany("INSERT INTO chunk_lsh(band_key, chunk_id) VALUES(?,?)",
+                                    [(k, row_id) for k in sk[1]])
+            _fts_changed(con, n_text)
             con.execute("COMMIT")
         except Exception:
             con.execute("ROLLBACK")
@@ -176,19 +429,167 @@ def insert_chunks(doc_id, chunks):
     return ids
 
 
+def delete_chunks(doc_id):
+    with _connect() as con:
+        con.execute("BEGIN")
+        try:
+            con.execute("DELETE FROM chunk_fts WHERE rowid IN (SELECT id FROM chunk_meta WHERE document_id=?)", (doc_id,))
+            con.execute("DELETE FROM chunk_lsh WHERE chunk_id IN (SELECT id FROM chunk_meta WHERE document_id=?)", (doc_id,))
+            con.execute("DELETE FROM chunk_meta WHERE document_id=?", (doc_id,))
+            _fts_changed(con, 0)
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+
+def get_document_chunks(doc_id):
+    with _connect() as con:
+        cur = con.execute(
+            """SELECT m.id, t.text FROM chunk_meta m
+            JOIN chunk_fts t ON t.rowid = m.id
+            WHERE m.document_id=? ORDER BY m.id""",
+            (doc_id,)
+        )
+        return [(int(r[0]), r[1]) for r in cur]
+
+def create_migration(target_model, index_dir):
+    with _connect() as con:
+        return con.execute(
+            "INSERT INTO migrations(target_model, index_dir, status) VALUES(?,?,?) RETURNING id",
+            (target_model, index_dir, MigrationStatus.RUNNING.value)
+        ).fetchone()[0]
+
+def get_running_migration():
+    with _connect() as con:
+        return con.execute(
+            "SELECT * FROM migrations WHERE status=? ORDER BY id LIMIT 1",
+            (MigrationStatus.RUNNING.value,)
+        ).fetchone()
+
+def get_last_migration():
+    with _connect() as con:
+        return con.execute("SELECT * FROM migrations ORDER BY id DESC LIMIT 1").fetchone()
+
+def advance_migration(migration_id, cursor, n):
+    with _connect() as con:
+        con.execute(
+            """UPDATE migrations SET cursor=?, migrated=migrated+?, updated_at=CURRENT_TIMESTAMP
+            WHERE id=?""",
+            (cursor, n, migration_id)
+        )
+
+def finish_migration(migration_id, status):
+    with _connect() as con:
+        con.execute(
+            "UPDATE migrations SET status=?, updated_at=CURRENT_TIMESTAMP WHERE id=?",
+            (status.value, migration_id)
+        )
+
+def get_chunks_after(chunk_id, limit):
+    with _connect() as con:
+        cur = con.execute(
+            """SELECT m.id, t.text FROM chunk_meta m
+            JOIN chunk_fts t ON t.rowid = m.id
+            WHERE m.id > ? ORDER BY m.id LIMIT ?""",
+            (chunk_id, int(limit))
+        )
+        return [(int(r[0]), r[1]) for r in cur]
+
+def set_chunks_embed_model(embed_model):
+    with _connect() as con:
+        con.execute("UPDATE chunk_meta SET embed_model=?", (embed_model,))
+
+def count_jobs_by_status():
+    with _connect() as con:
+        return {r[0]: r[1] for r in con.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")}
+
 def get_total_chunks():
     with _connect() as con:
         return con.execute("SELECT COUNT(*) FROM chunk_meta").fetchone()[0]
     
-def match_fts_query(fts_query, top_k):
+def _fts_changed(con, n_chunks):
+    # Called inside the writing transaction so readers never see new content with an old version
+    con.execute("UPDATE counters SET value = value + 1 WHERE key='fts_version'")
+    if n_chunks:
+        con.execute("UPDATE counters SET value = value + ? WHERE key='fts_pending'", (n_chunks,))
+
+def get_fts_pending():
+    with _connect() as con:
+        row = con.execute("SELECT value FROM counters WHERE key='fts_pending'").fetchone()
+        return row[0] if row else 0
+
+def optimize_fts_step(pages=None):
+    # One incremental step of merging chunk_fts down to a single b-tree, which is what a full
+    # 'optimize' produces without holding the write lock for minutes on a large index.
+    # Returns True once there is nothing left to merge.
+    pages = pages or FTS_MERGE_PAGES
+    with _connect() as con:
+        before = con.total_changes
+        # a negative page count merges segments regardless of level, like 'optimize'
+        con.execute("INSERT INTO chunk_fts(chunk_fts, rank) VALUES('merge', ?)", (-pages,))
+        done = con.total_changes - before < 2
+        if done:
+            con.execute("UPDATE counters SET value = 0 WHERE key='fts_pending'")
+        return done
+
+class _MatchCache:
+    # LRU of MATCH results; emptied as soon as the fts_version counter moves
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.version = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, version, key):
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+                return None
+            res = self.entries.get(key)
+            if res is not None:
+                self.entries.move_to_end(key)
+            return res
+
+    def put(self, version, key, res):
+        with self.lock:
+            if version != self.version:
+                return
+            self.entries[key] = res
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+_MATCH_CACHE = _MatchCache(FTS_CACHE_SIZE)
+
+def match_fts_query(fts_query, top_k, document_ids=None):
+    # Only chunks of documents whose vectors were published (stage INDEXED) are matched, so a
+    # document being indexed, or retried after a failure, shows up in both searches at once.
+    # `document_ids` restricts the search to the chunks of these documents (routed queries)
+    restrict, params = "", (DocumentStage.INDEXED.value,)
+    if document_ids is not None:
+        document_ids = tuple(sorted(document_ids))
+        restrict = (" AND rowid IN (SELECT COALESCE(canonical_id, id) FROM chunk_meta WHERE document_id IN ("
+                    + ",".join("?" for _ in document_ids) + "))")
+        params += document_ids
     with _connect() as con:
+        key = (fts_query, int(top_k), document_ids)
+        if FTS_CACHE_SIZE > 0:
+            version = con.execute("SELECT value FROM counters WHERE key='fts_version'").fetchone()[0]
+            cached = _MATCH_CACHE.get(version, key)
+            FTS_CACHE_REQUESTS.inc(result="hit" if cached is not None else "miss")
+            if cached is not None:
+                return list(cached)
         cur = con.execute(
             "SELECT rowid, bm25(chunk_fts) AS s "
-            "FROM chunk_fts WHERE chunk_fts MATCH ? "
-            "ORDER BY s LIMIT ?",
-            (fts_query, int(top_k))
+            "FROM chunk_fts WHERE chunk_fts MATCH ?"
+            " AND EXISTS (SELECT 1 FROM chunk_meta c JOIN documents d ON d.id = c.document_id"
+            " WHERE c.id = chunk_fts.rowid AND d.stage = ?)" + restrict +
+            " ORDER BY s LIMIT ?",
+            (fts_query, *params, int(top_k))
         )
         res = [(int(r[0]), float(r[1])) for r in cur.fetchall()] 
+        if FTS_CACHE_SIZE > 0:
+            _MATCH_CACHE.put(version, key, tuple(res))
         return res
     
 def get_chunk_meta(ids):
@@ -196,7 +597,7 @@ def get_chunk_meta(ids):
     with _connect() as con:
         cur = con.execute(
             f""" SELECT m.id, m.document_id, m.page_num, m.start_char, m.end_char,
-            d.original_name, t.text
+            d.original_name, t.text, COALESCE(m.page_span, 1)
             FROM chunk_meta m
             JOIN documents d ON d.id = m.document_id
             JOIN chunk_fts t  ON t.rowid = m.id
@@ -207,9 +608,178 @@ def get_chunk_meta(ids):
                 "chunk_id": r[0],
                 "document_id": r[1],
                 "page_num": r[2],
+                "page_span": r[7],
                 "start_char": r[3],
                 "end_char": r[4],
                 "document_name": r[5],
                 "text": r[6],
+                "also_in": [],
+                "also_in_count": 0,
             })
-        return res
\ No newline at end of file
+        # the other pages the text of a chunk appears on, for citations: the first ALSO_IN_LIMIT
+        # of them and their number (boilerplate can repeat on thousands of pages)
+        by_id = {r["chunk_id"]: r for r in res}
+        cur = con.execute(
+            f"""SELECT canonical_id, document_id, original_name, page_num, n FROM (
+              SELECT m.canonical_id, m.document_id, d.original_name, m.page_num,
+                ROW_NUMBER() OVER (PARTITION BY m.canonical_id ORDER BY MIN(m.id)) AS k,
+                COUNT(*) OVER (PARTITION BY m.canonical_id) AS n
+              FROM chunk_meta m
+              JOIN chunk_meta c ON c.id = m.canonical_id
+              JOIN documents d ON d.id = m.document_id
+              WHERE m.canonical_id IN ({ids})
+                AND NOT (m.document_id = c.document_id AND m.page_num = c.page_num)
+              GROUP BY m.canonical_id, m.document_id, m.page_num
+            ) WHERE k <= ? ORDER BY canonical_id, k""",
+            (ALSO_IN_LIMIT,)
+        )
+        for r in cur:
+            canonical = by_id.get(r[0])
+            if canonical is not None:
+                canonical["also_in"].append({"document_id": r[1], "document_name": r[2], "page_num": r[3]})
+                canonical["also_in_count"] = r[4]
+        return res
+
+
+def get_document_versions(document_ids):
+    if not document_ids:
+        return {}
+    placeholders = ",".join("?" for _ in document_ids)
+    with _connect() as con:
+        cur = con.execute(
+            f"SELECT id, status, updated_at FROM documents WHERE id IN ({placeholders})",
+            tuple(document_ids)
+        )
+        return {r["id"]: f'{r["status"]}@{r["updated_at"]}' for r in cur}
+
+def get_corpus_version():
+    # Changes whenever a document is added or changes status
+    with _connect() as con:
+        r = con.execute("SELECT COUNT(*), MAX(updated_at) FROM documents").fetchone()
+        return f"{r[0]}@{r[1]}"
+
+def get_document_rowid(document_id):
+    with _connect() as con:
+        row = con.execute("SELECT rowid FROM documents WHERE id=?", (document_id,)).fetchone()
+        return row[0] if row else None
+
+def get_document_ids_by_rowid(rowids):
+    if not rowids:
+        return []
+    placeholders = ",".join("?" for _ in rowids)
+    with _connect() as con:
+        cur = con.execute(f"SELECT rowid, id FROM documents WHERE rowid IN ({placeholders})", tuple(int(r) for r in rowids))
+        by_rowid = {r[0]: r[1] for r in cur}
+        return [by_rowid[int(r)] for r in rowids if int(r) in by_rowid]
+
+def get_document_chunk_ids(document_ids):
+    if not document_ids:
+        return []
+    placeholders = ",".join("?" for _ in document_ids)
+    with _connect() as con:
+        # duplicates are searched through their canonical chunk
+        cur = con.execute(f"SELECT DISTINCT COALESCE(canonical_id, id) FROM chunk_meta WHERE document_id IN ({placeholders})",
+                          tuple(document_ids))
+        return [r[0] for r in cur]
+
+def get_chunk_document_rowids():
+    # (chunk id, document rowid) of every chunk, for rebuilding the document routing index
+    with _connect() as con:
+        return con.execute(
+            "SELECT m.id, d.rowid FROM chunk_meta m JOIN documents d ON d.id = m.document_id"
+        ).fetchall()
+
+def count_routable_documents():
+    # INDEXED documents with at least one chunk of their own (not a duplicate) in the vector
+    # index, i.e. the documents the routing tier must have a centroid for
+    with _connect() as con:
+        return con.execute(
+            """SELECT COUNT(*) FROM documents d WHERE d.status=? AND EXISTS (
+                SELECT 1 FROM chunk_meta m WHERE m.document_id = d.id AND m.canonical_id IS NULL)""",
+            (DocumentStatus.INDEXED.value,)
+        ).fetchone()[0]
+
+def get_documents_without_terms(limit):
+    # (rowid, id) of INDEXED documents that have no row in doc_fts yet
+    with _connect() as con:
+        return con.execute(
+            "SELECT rowid, id FROM documents WHERE status=? AND rowid NOT IN (SELECT rowid FROM doc_fts) LIMIT ?",
+            (DocumentStatus.INDEXED.value, int(limit))
+        ).fetchall()
+
+def set_document_terms(rowid, terms):
+    with _connect() as con:
+        con.execute("BEGIN")
+        try:
+            con.execute("DELETE FROM doc_fts WHERE rowid=?", (rowid,))
+            con.execute("INSERT INTO doc_fts(rowid, terms) VALUES(?,?)", (rowid, terms))
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+
+def match_document_terms(fts_query, top_k):
+    with _connect() as con:
+        cur = con.execute(
+            "SELECT rowid, bm25(doc_fts) AS s FROM doc_fts WHERE doc_fts MATCH ? ORDER BY s LIMIT ?",
+            (fts_query, int(top_k))
+        )
+        return [(int(r[0]), float(r[1])) for r in cur]
+
+def create_session(session_id, expire_days=None):
+    with _connect() as con:
+        if expire_days:
+            # sessions nobody came back to are dropped whenever a new one starts
+            con.execute("DELETE FROM sessions WHERE updated_at < datetime('now', ?)", (f"-{int(expire_days)} days",))
+        con.execute("INSERT INTO sessions(id) VALUES(?)", (session_id,))
+
+def get_session(session_id):
+    with _connect() as con:
+        row = con.execute("SELECT * FROM sessions WHERE id=?", (session_id,)).fetchone()
+        if not row:
+            return None
+        session = dict(row)
+        session["pending"] = json.loads(session["pending"])
+        return session
+
+def push_session_turn(session_id, user, assistant):
+    # The new turn becomes the last one, the previous last turn waits for the summarizer
+    with _connect() as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            row = con.execute("SELECT pending, last_user, last_assistant FROM sessions WHERE id=?", (session_id,)).fetchone()
+            if not row:
+                con.execute("ROLLBACK")
+                return False
+            pending = json.loads(row["pending"])
+            if row["last_user"] is not None:
+                pending.append({"user": row["last_user"], "assistant": row["last_assistant"] or ""})
+            con.execute(
+                """UPDATE sessions SET pending=?, last_user=?, last_assistant=?, turns=turns+1,
+                    updated_at=CURRENT_TIMESTAMP WHERE id=?""",
+                (json.dumps(pending, ensure_ascii=False), user, assistant, session_id)
+            )
+            con.execute("COMMIT")
+            return True
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+
+def fold_session_summary(session_id, old_summary, n_folded, summary):
+    # Replaces the summary and drops the first `n_folded` pending turns, unless another summarizer
+    # got there first (the summary changed in the meantime)
+    with _connect() as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            row = con.execute("SELECT summary, pending FROM sessions WHERE id=?", (session_id,)).fetchone()
+            if not row or row["summary"] != old_summary:
+                con.execute("ROLLBACK")
+                return False
+            pending = json.loads(row["pending"])[n_folded:]
+            con.execute("UPDATE sessions SET summary=?, pending=? WHERE id=?",
+                        (summary, json.dumps(pending, ensure_ascii=False), session_id))
+            con.execute("COMMIT")
+            return True
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
@@ -0,0 +1,66 @@
+"""
+Near-duplicate detection of chunks at ingest (repeated boilerplate pages, headers, revisions of the
+same document).
+
+Every chunk is reduced to the set of its word 3-grams and a MinHash signature of that set. The
+signature is cut into DEDUP_BANDS bands; chunks sharing a band are candidates (LSH), and a candidate
+whose 3-gram set has a Jaccard similarity of at least DEDUP_THRESHOLD is a duplicate. Duplicates
+keep their own `chunk_meta` row (document, page, offsets) pointing to the canonical chunk, but are
+neither embedded nor added to the keyword and vector indexes.
+"""
+import hashlib, os, re, zlib
+import numpy as np
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "True") == "True"
+# Jaccard similarity of the word 3-gram sets from which a chunk counts as a duplicate
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.9"))
+# Signature length = bands x rows; 8 x 8 finds ~99% of pairs at 0.9 and few below 0.6
+DEDUP_BANDS = int(os.getenv("DEDUP_BANDS", "8"))
+DEDUP_ROWS = int(os.getenv("DEDUP_ROWS", "8"))
+
+SHINGLE_WORDS = 3
+_WORD_RE = re.compile(r"\w+")
+_PRIME = (1 << 31) - 1
+_rng = np.random.default_rng(20240501)
+# (a * x + b) mod p, one pair per signature row; fixed seed, signatures must stay comparable
+_A = _rng.integers(1, _PRIME, DEDUP_BANDS * DEDUP_ROWS, dtype=np.uint64)
+_B = _rng.integers(0, _PRIME, DEDUP_BANDS * DEDUP_ROWS, dtype=np.uint64)
+
+
+def shingles(text):
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < SHINGLE_WORDS:
+        grams = [" ".join(words)] if words else []
+    else:
+        grams = [" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)]
+    return {zlib.crc32(g.encode("utf-8")) % _PRIME for g in grams}
+
+
+def signature(shingle_set):
+    x = np.fromiter(shingle_set, dtype=np.uint64, count=len(shingle_set))
+    # a < 2^31 and x < 2^31, so a * x + b never overflows 64 bits
+    return ((_A[:, None] * x[None, :] + _B[:, None]) % _PRIME).min(axis=1).astype(np.uint32)
+
+
+def band_keys(sig):
+    """One signed 64-bit key per band, the band number is part of the key."""
+    keys = []
+    for band in range(DEDUP_BANDS):
+        rows = sig[band * DEDUP_ROWS:(band + 1) * DEDUP_ROWS].tobytes()
+        digest = hashlib.blake2b(bytes([band]) + rows, digest_size=8).digest()
+        keys.append(int.from_bytes(digest, "big", signed=True))
+    return keys
+
+
+def sketch(text):
+    """(3-gram set, LSH band keys) of a chunk text, None for texts without words."""
+    s = shingles(text)
+    if not s:
+        return None
+    return s, band_keys(signature(s))
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
@@ -1,34 +1,52 @@
 from typing import Protocol, List
-from mistralai import Mistral
+from rag.metrics import span
+from rag.registry import shared
+from rag.scheduler import get_scheduler, estimate_tokens
+from rag.active_index import read_active
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import os
+import os, re, zlib
 from dotenv import load_dotenv, find_dotenv
 
 load_dotenv(find_dotenv(), override=True)
 
 EMBED_MODEL = os.getenv("MISTRAL_EMBED_MODEL")
 API_KEY = os.getenv("MISTRAL_API_KEY")
+# Alternative API endpoint, e.g. the local stand-in used by load tests (benchmarks/fake_mistral.py)
+SERVER_URL = os.getenv("MISTRAL_SERVER_URL") or None
+
+# mistral | hashing
+EMBEDDER_BACKEND = os.getenv("EMBEDDER_BACKEND", "mistral")
+LOCAL_EMBED_DIM = int(os.getenv("LOCAL_EMBED_DIM", "1024"))
+LOCAL_EMBED_WORKERS = int(os.getenv("LOCAL_EMBED_WORKERS", str(os.cpu_count() or 1)))
+
+_WORD_RE = re.compile(r"\w+")
 
 class Embedder(Protocol):
     def embed(self, texts: List[str]) -> np.ndarray: ...
 
 class MistralEmbedder:
-    def __init__(self, batch_size: int = 128):
-        if not EMBED_MODEL:
+    def __init__(self, batch_size: int = 128, model: str = None):
+        model = model or EMBED_MODEL
+        if not model:
             raise RuntimeError("MISTRAL_EMBED_MODEL not set; cannot use Mistral embeddings.")
         if not API_KEY:
             raise RuntimeError("MISTRAL_API_KEY not set; cannot use Mistral embeddings.")
         
-        self.client = Mistral(api_key=API_KEY)
-        self.model = EMBED_MODEL
+        from mistralai import Mistral
+
+        self.client = Mistral(api_key=API_KEY, server_url=SERVER_URL)
+        self.model = model
         self.batch_size = batch_size
 
     def embed(self, texts) -> np.ndarray:
         out = []
         for i in range(0, len(texts), self.batch_size):
             batch = texts[i:i+self.batch_size]
-            result = self.client.embeddings.create(model=self.model, inputs=batch)
+            with span("embed_api"):
+                result = get_scheduler().call(
+                    self.client.embeddings.create, model=self.model, inputs=batch, tokens=estimate_tokens(batch))
             out.extend([d.embedding for d in result.data])
 
         arr = np.asarray(out, dtype="float32")
@@ -39,5 +57,73 @@ class MistralEmbedder:
         return arr
     
 
-def get_embedder() -> Embedder:
-    return MistralEmbedder()
\ No newline at end of file
+def _hash_features(texts, dim):
+    """
+    Signed feature hashing of word unigrams + bigrams with sublinear term frequency. Hashing every
+    feature to one of `dim` buckets with a random sign is a sparse random projection of the (huge)
+    bag-of-words vector, so inner products are preserved in expectation.
+    """
+    rows, hashes = [], []
+    for i, t in enumerate(texts):
+        words = _WORD_RE.findall((t or "").lower())
+        feats = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        hashes.extend(zlib.crc32(f.encode("utf-8")) for f in feats)
+        rows.extend([i] * len(feats))
+
+    out = np.zeros((len(texts), dim), dtype="float32")
+    if not hashes:
+        return out
+    h = np.asarray(hashes, dtype="uint32")
+    signs = np.where((h >> 31) & 1, -1.0, 1.0).astype("float32")
+    np.add.at(out, (np.asarray(rows), (h & 0x7FFFFFFF) % dim), signs)
+
+    out = np.sign(out) * np.log1p(np.abs(out))
+    norms = np.linalg.norm(out, axis=1, keepdims=True)
+    return out / np.clip(norms, 1e-12, None)
+
+
+class HashingEmbedder:
+    """
+    Local embedder that needs no network or API key. Much weaker than a trained model semantically
+    but very fast, which makes it useful for air-gapped setups, throughput testing and as a cheap
+    first pass over very large archives.
+    """
+    def __init__(self, dim: int = LOCAL_EMBED_DIM, batch_size: int = 2048, workers: int = LOCAL_EMBED_WORKERS):
+        self.dim = dim
+        self.model = f"hashing-{dim}"
+        self.batch_size = batch_size
+        self.workers = workers
+        self._pool = None
+
+    def embed(self, texts) -> np.ndarray:
+        texts = list(texts)
+        if len(texts) <= self.batch_size or self.workers <= 1:
+            return _hash_features(texts, self.dim)
+
+        # Tokenizing is pure Python, so large inputs are spread over processes instead of threads
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        batches = [texts[i:i+self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        return np.vstack(list(self._pool.map(_hash_features, batches, [self.dim] * len(batches))))
+
+
+def _default_model_name():
+    if EMBEDDER_BACKEND == "hashing":
+        return f"hashing-{LOCAL_EMBED_DIM}"
+    if EMBEDDER_BACKEND != "mistral":
+        raise RuntimeError(f"Unknown EMBEDDER_BACKEND: {EMBEDDER_BACKEND}")
+    return EMBED_MODEL or ""
+
+def get_embed_model_name():
+    """Model of the active index set; the environment only decides it until the first migration."""
+    return read_active()["embed_model"] or _default_model_name()
+
+def build_embedder(model: str) -> Embedder:
+    # "hashing-<dim>" is the local embedder, anything else a Mistral embedding model
+    if model.startswith("hashing-"):
+        return HashingEmbedder(dim=int(model.split("-", 1)[1]))
+    return MistralEmbedder(model=model)
+
+def get_embedder(model: str = None) -> Embedder:
+    model = model or get_embed_model_name()
+    return shared(f"embedder:{model}", lambda: build_embedder(model))
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""
+Fan-out of document progress events to waiting API clients.
+
+The worker only writes rows to `document_events`. Instead of every long-poll or SSE client querying
+SQLite in a loop, one poller per API process looks for new rows while anybody is waiting and wakes
+up the clients of the documents that got events. Those then read their own events once.
+"""
+import asyncio, os
+from collections import defaultdict
+
+from rag.db import get_events_cursor, get_evented_documents, get_document_events
+from rag.registry import shared
+
+# Seconds between two looks at the event table while clients are waiting
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", "0.5"))
+
+
+class EventHub:
+    def __init__(self, poll_interval=EVENTS_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.cursor = None
+        self.waiters = defaultdict(set)
+        self._poller = None
+
+    async def wait(self, document_id, after_id=0, timeout=25.0):
+        """
+        Events of the document after `after_id`. Returns right away if there are some, otherwise
+        waits up to `timeout` seconds for the next ones (an empty list on timeout).
+        """
+        wake = asyncio.Event()
+        # Registered before reading, so an event written in between still wakes this waiter
+        self.waiters[document_id].add(wake)
+        try:
+            if self.cursor is None:
+                cursor = await asyncio.to_thread(get_events_cursor)
+                if self.cursor is None:
+                    self.cursor = cursor
+            self._ensure_poller()
+
+            events = await asyncio.to_thread(get_document_events, document_id, after_id)
+            if events or timeout <= 0:
+                return events
+            try:
+                await asyncio.wait_for(wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+            return await asyncio.to_thread(get_document_events, document_id, after_id)
+        finally:
+            waiters = self.waiters.get(document_id)
+            if waiters is not None:
+                waiters.discard(wake)
+                if not waiters:
+                    del self.waiters[document_id]
+
+    def _ensure_poller(self):
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.get_running_loop().create_task(self._poll())
+
+    async def _poll(self):
+        # Stops once nobody waits; the cursor is kept, so the next poller catches up from there
+        while self.waiters:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                self.cursor, documents = await asyncio.to_thread(get_evented_documents, self.cursor)
+            except Exception as e:
+                print("Polling document events failed:", e)
+                continue
+            for document_id in documents:
+                for wake in self.waiters.get(document_id, ()):
+                    wake.set()
+
+
+def get_event_hub():
+    return shared("event_hub", EventHub)
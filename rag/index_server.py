@@ -0,0 +1,380 @@
+"""
+Optional index server: one process per host owns the FAISS indexes and serves the vector and keyword
+searches of every API worker, so the index memory and its reloads are paid once.
+
+    python -m rag.index_server --addr unix:data/index.sock      # or 127.0.0.1:8765
+    INDEX_SERVER_ADDR=unix:data/index.sock uvicorn app.main:app --workers 4
+
+Unrouted searches that arrive within INDEX_SERVER_BATCH_MS of each other are coalesced into one
+matrix search. The server follows the published index generations like an in-process retriever
+(see rag/active_index.py), keyword searches share one FTS match cache.
+
+Wire format, all integers big-endian, vectors and scores little-endian:
+
+    request   op:u8 length:u32 payload      response  status:u8 length:u32 payload
+    SEARCH    n:u32 dim:u32 top_k:u32 queries:f32[n*dim], per query count:i32 (-1 = all) ids:i64[count]
+              -> type:u8, per query count:u32 ids:i64[count] scores:f32[count]
+    KEYWORD   top_k:u32 query:str n_docs:i32 (-1 = all) document_ids:str[n_docs]
+              -> count:u32 ids:i64[count] bm25:f64[count]
+
+where str is length:u32 followed by UTF-8 bytes. A failed request gets status 1 and the error message.
+"""
+from dotenv import load_dotenv, find_dotenv
+
+import argparse, asyncio, logging, os, socket, struct, threading, time
+import numpy as np
+
+from rag.db import match_fts_query
+from rag.registry import shared
+
+load_dotenv(find_dotenv(), override=True)
+
+logger = logging.getLogger(__name__)
+
+# unix:<path> or <host>:<port>; unset means every process searches its own copy of the indexes
+INDEX_SERVER_ADDR = os.getenv("INDEX_SERVER_ADDR")
+# How long the server waits for more searches to put into the same matrix search
+INDEX_SERVER_BATCH_MS = float(os.getenv("INDEX_SERVER_BATCH_MS", "2"))
+# Query vectors of one coalesced search
+INDEX_SERVER_MAX_BATCH = int(os.getenv("INDEX_SERVER_MAX_BATCH", "64"))
+INDEX_SERVER_TIMEOUT = float(os.getenv("INDEX_SERVER_TIMEOUT", "10"))
+# After a failed connection, calls fail fast for this many seconds before the server is tried again
+INDEX_SERVER_RETRY_S = float(os.getenv("INDEX_SERVER_RETRY_S", "5"))
+# While the server is unreachable, API processes load and search their own copy of the indexes;
+# False fails vector searches instead (keyword searches always fall back to SQLite)
+INDEX_SERVER_FALLBACK = os.getenv("INDEX_SERVER_FALLBACK", "True") == "True"
+
+OP_SEARCH, OP_KEYWORD = 1, 2
+STATUS_OK, STATUS_ERROR = 0, 1
+INDEX_TYPES = ["", "flat", "ivfpq"]
+
+_FRAME = struct.Struct("!BI")
+_SEARCH = struct.Struct("!III")
+_SEARCH_RESULT = struct.Struct("!B")
+_KEYWORD = struct.Struct("!I")
+_U32 = struct.Struct("!I")
+_I32 = struct.Struct("!i")
+
+
+def parse_addr(addr):
+    """("unix", path) or ("tcp", (host, port))."""
+    if addr.startswith("unix:"):
+        return "unix", addr[len("unix:"):]
+    host, sep, port = addr.rpartition(":")
+    if sep and port.isdigit():
+        return "tcp", (host or "127.0.0.1", int(port))
+    return "unix", addr
+
+
+class _Reader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def unpack(self, st):
+        out = st.unpack_from(self.data, self.pos)
+        self.pos += st.size
+        return out
+
+    def array(self, dtype, count):
+        dtype = np.dtype(dtype)
+        out = np.frombuffer(self.data, dtype=dtype, count=count, offset=self.pos)
+        self.pos += dtype.itemsize * count
+        return out
+
+    def str(self):
+        (n,) = self.unpack(_U32)
+        out = bytes(self.data[self.pos:self.pos + n]).decode("utf-8")
+        self.pos += n
+        return out
+
+
+def _str(s):
+    data = s.encode("utf-8")
+    return _U32.pack(len(data)) + data
+
+
+def encode_search(queries, top_k, selections):
+    queries = np.ascontiguousarray(queries, dtype="<f4")
+    parts = [_SEARCH.pack(queries.shape[0], queries.shape[1], top_k), queries.tobytes()]
+    for ids in selections:
+        if ids is None:
+            parts.append(_I32.pack(-1))
+        else:
+            parts += [_I32.pack(len(ids)), np.asarray(ids, dtype="<i8").tobytes()]
+    return b"".join(parts)
+
+
+def decode_search(payload):
+    r = _Reader(payload)
+    n, dim, top_k = r.unpack(_SEARCH)
+    queries = r.array("<f4", n * dim).reshape(n, dim).astype("float32")
+    selections = []
+    for _ in range(n):
+        (count,) = r.unpack(_I32)
+        selections.append(None if count < 0 else r.array("<i8", count).astype("int64"))
+    return queries, top_k, selections
+
+
+def encode_search_result(type, sims):
+    parts = [_SEARCH_RESULT.pack(INDEX_TYPES.index(type))]
+    for rows in sims:
+        parts += [_U32.pack(len(rows)),
+                  np.array([cid for cid, _ in rows], dtype="<i8").tobytes(),
+                  np.array([s for _, s in rows], dtype="<f4").tobytes()]
+    return b"".join(parts)
+
+
+def decode_search_result(payload, n):
+    r = _Reader(payload)
+    (type,) = r.unpack(_SEARCH_RESULT)
+    sims = []
+    for _ in range(n):
+        (count,) = r.unpack(_U32)
+        ids, scores = r.array("<i8", count), r.array("<f4", count)
+        sims.append([(int(i), float(s)) for i, s in zip(ids, scores)])
+    return INDEX_TYPES[type], sims
+
+
+def encode_keyword(fts_query, top_k, document_ids):
+    parts = [_KEYWORD.pack(top_k), _str(fts_query)]
+    if document_ids is None:
+        parts.append(_I32.pack(-1))
+    else:
+        parts += [_I32.pack(len(document_ids))] + [_str(d) for d in document_ids]
+    return b"".join(parts)
+
+
+def decode_keyword(payload):
+    r = _Reader(payload)
+    (top_k,) = r.unpack(_KEYWORD)
+    fts_query = r.str()
+    (n,) = r.unpack(_I32)
+    document_ids = None if n < 0 else [r.str() for _ in range(n)]
+    return fts_query, top_k, document_ids
+
+
+def encode_keyword_result(rows):
+    return (_U32.pack(len(rows)) + np.array([cid for cid, _ in rows], dtype="<i8").tobytes()
+            + np.array([s for _, s in rows], dtype="<f8").tobytes())
+
+
+def decode_keyword_result(payload):
+    r = _Reader(payload)
+    (count,) = r.unpack(_U32)
+    ids, scores = r.array("<i8", count), r.array("<f8", count)
+    return [(int(i), float(s)) for i, s in zip(ids, scores)]
+
+
+class IndexServer:
+    def __init__(self, batch_ms=INDEX_SERVER_BATCH_MS, max_batch=INDEX_SERVER_MAX_BATCH):
+        # Index loading and the search itself are the retriever's, only the transport differs
+        from rag.retriever import Retriever
+
+        self.retriever = Retriever()
+        self.batch_window = batch_ms / 1000.0
+        self.max_batch = max_batch
+        self._pending = []      # (index, queries, top_k, future)
+        self._flusher = None
+        self.stats = {"searches": 0, "batches": 0, "keyword": 0}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                op, length = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+                payload = await reader.readexactly(length)
+                try:
+                    status, body = STATUS_OK, await self._dispatch(op, payload)
+                except Exception as e:
+                    status, body = STATUS_ERROR, f"{type(e).__name__}: {e}".encode("utf-8")
+                writer.write(_FRAME.pack(status, len(body)) + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, op, payload):
+        if op == OP_SEARCH:
+            return await self._search(*decode_search(payload))
+        if op == OP_KEYWORD:
+            self.stats["keyword"] += 1
+            rows = await asyncio.to_thread(match_fts_query, *decode_keyword(payload))
+            return encode_keyword_result(rows)
+        raise ValueError(f"Unknown op {op}")
+
+    async def _search(self, queries, top_k, selections):
+        self.stats["searches"] += 1
+        index, type, _ = await asyncio.to_thread(self.retriever._load_generation, queries.shape[1])
+        sims = [None] * len(selections)
+        if index is not None:
+            unrouted = [i for i, ids in enumerate(selections) if ids is None]
+            if unrouted:
+                for i, rows in zip(unrouted, await self._batched(index, queries[unrouted], top_k)):
+                    sims[i] = rows
+            for i, ids in enumerate(selections):
+                if ids is not None:
+                    sims[i] = await asyncio.to_thread(
+                        self.retriever._semantic_search_within, index, queries[i:i + 1], top_k, ids)
+        return encode_search_result(type, [rows or [] for rows in sims])
+
+    async def _batched(self, index, queries, top_k):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((index, queries, top_k, future))
+        if sum(p[1].shape[0] for p in self._pending) >= self.max_batch:
+            await self._flush()
+        elif self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.batch_window)
+        await self._flush()
+
+    async def _flush(self):
+        pending, self._pending = self._pending, []
+        # one matrix search per loaded index, i.e. per generation and dimension
+        groups = {}
+        for item in pending:
+            groups.setdefault(id(item[0]), []).append(item)
+        for items in groups.values():
+            index = items[0][0]
+            matrix = np.vstack([queries for _, queries, _, _ in items])
+            k = max(top_k for _, _, top_k, _ in items)
+            self.stats["batches"] += 1
+            try:
+                found = await asyncio.to_thread(self.retriever._semantic_search_many, index, matrix, k)
+            except Exception as e:
+                for *_, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            start = 0
+            for _, queries, top_k, future in items:
+                rows = [r[:top_k] for r in found[start:start + queries.shape[0]]]
+                start += queries.shape[0]
+                if not future.done():
+                    future.set_result(rows)
+
+
+async def serve(addr, server=None):
+    server = server or IndexServer()
+    kind, target = parse_addr(addr)
+    if kind == "unix":
+        if os.path.exists(target):
+            os.unlink(target)     # left over by a previous run
+        listener = await asyncio.start_unix_server(server.handle, path=target)
+    else:
+        listener = await asyncio.start_server(server.handle, *target)
+    print(f"Index server listening on {addr}")
+    async with listener:
+        await listener.serve_forever()
+
+
+class IndexServerError(ConnectionError):
+    """The server answered a request with an error status."""
+
+
+class IndexClient:
+    """
+    Blocking client, one connection per calling thread. Once the server cannot be reached or
+    answers with an error, calls raise ConnectionError without connecting until `retry_s` have passed.
+    """
+    def __init__(self, addr, timeout=INDEX_SERVER_TIMEOUT, retry_s=INDEX_SERVER_RETRY_S):
+        self.addr = addr
+        self.timeout = timeout
+        self.retry_s = retry_s
+        self._local = threading.local()
+        self._down_until = None     # monotonic time of the next attempt while the server is down
+
+    def _connect(self):
+        kind, target = parse_addr(self.addr)
+        if kind == "unix":
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.timeout)
+        sock.connect(target)
+        return sock
+
+    def _recv(self, sock, n):
+        buf = bytearray(n)
+        view, got = memoryview(buf), 0
+        while got < n:
+            k = sock.recv_into(view[got:])
+            if k == 0:
+                raise ConnectionError("Index server closed the connection.")
+            got += k
+        return bytes(buf)
+
+    def _mark_down(self, was_down, error):
+        if not was_down:
+            logger.warning("Index server %s unavailable (%s), retrying every %gs.", self.addr, error, self.retry_s)
+        self._down_until = time.monotonic() + self.retry_s
+
+    def _call(self, op, payload):
+        down_until = self._down_until
+        if down_until is not None and time.monotonic() < down_until:
+            raise ConnectionError(f"Index server {self.addr} unavailable.")
+        for attempt in range(2):
+            sock = getattr(self._local, "sock", None)
+            try:
+                if sock is None:
+                    sock = self._local.sock = self._connect()
+                sock.sendall(_FRAME.pack(op, len(payload)) + payload)
+                status, length = _FRAME.unpack(self._recv(sock, _FRAME.size))
+                body = self._recv(sock, length)
+                break
+            except OSError as e:
+                # a stale connection (server restarted) is retried once on a new one
+                if sock is not None:
+                    sock.close()
+                self._local.sock = None
+                if attempt:
+                    self._mark_down(down_until is not None, e)
+                    raise
+        if status != STATUS_OK:
+            # e.g. the server cannot load the indexes: callers fall back as if it was unreachable
+            error = IndexServerError(f"Index server error: {body.decode('utf-8', 'replace')}")
+            self._mark_down(down_until is not None, error)
+            raise error
+        if down_until is not None:
+            self._down_until = None
+            logger.warning("Index server %s reachable again.", self.addr)
+        return body
+
+    def search(self, queries, top_k, selections):
+        """(index type, [(chunk_id, score)] per query)."""
+        body = self._call(OP_SEARCH, encode_search(queries, top_k, selections))
+        return decode_search_result(body, len(selections))
+
+    def keyword(self, fts_query, top_k, document_ids=None):
+        body = self._call(OP_KEYWORD, encode_keyword(fts_query, top_k, document_ids))
+        return decode_keyword_result(body)
+
+
+def get_index_client():
+    if not INDEX_SERVER_ADDR:
+        return None
+    return shared("index_client", lambda: IndexClient(INDEX_SERVER_ADDR))
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Serve the active index set to the API workers of this host")
+    p.add_argument("--addr", default=INDEX_SERVER_ADDR or "unix:data/index.sock",
+                   help="unix:<path> or <host>:<port>")
+    p.add_argument("--batch-ms", type=float, default=INDEX_SERVER_BATCH_MS)
+    p.add_argument("--max-batch", type=int, default=INDEX_SERVER_MAX_BATCH)
+    args = p.parse_args(argv)
+
+    from rag.db import init_schema
+    init_schema()
+    try:
+        asyncio.run(serve(args.addr, IndexServer(args.batch_ms, args.max_batch)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,95 @@
-from pathlib import Path
 from rag.db import get_total_chunks
-import faiss, math
+from rag.registry import lazy_module
+from rag.active_index import INDEX_FILES, index_file, stage_file, stage_path
+from pathlib import Path
+import math, os
 import numpy as np
 
+faiss = lazy_module("faiss")
 
-INDEX_DIR = Path("./data/index")
-INDEX_DIR.mkdir(parents=True, exist_ok=True)
 
-FLAT_INDEX_PATH = INDEX_DIR / "faiss_flat.index"
-IVFPQ_INDEX_PATH = INDEX_DIR / "faiss_ivfpq.index"
+FLAT_INDEX_NAME = INDEX_FILES["flat"]
+IVFPQ_INDEX_NAME = INDEX_FILES["ivfpq"]
+# Inverted lists of the IVFPQ index in `ondisk` storage mode, memory mapped by readers
+IVF_DATA_NAME = INDEX_FILES["ivfdata"]
+# memory: the whole IVFPQ index is loaded into RAM
+# ondisk: only the coarse quantizer, PQ tables and list offsets are loaded, posting lists are paged in
+IVF_STORAGE = os.getenv("IVF_STORAGE", "memory")
+# Vector storage of the flat index: float32 is exact, fp16 halves the memory at practically no cost
+# to recall, sq8 (8-bit scalar quantization) quarters it at ~98% recall@8 (benchmarks/flat_recall.py).
+# auto: the least compressed type whose vectors fit into FLAT_MEMORY_BUDGET_MB
+FLAT_INDEX_TYPE = os.getenv("FLAT_INDEX_TYPE", "auto")
+FLAT_MEMORY_BUDGET_MB = float(os.getenv("FLAT_MEMORY_BUDGET_MB", "512"))
+FLAT_INDEX_TYPES = {"float32": 4, "fp16": 2, "sq8": 1}   # bytes per dimension
+# The sq8 value range is fitted on the vectors (widened by the margin); smaller indexes use fp16 meanwhile
+SQ8_MIN_TRAIN = 1000
+SQ8_RANGE_MARGIN = 0.1
 MIN_TRAIN_SIZE = 5000
 TRAIN_SIZE_CAP = 100000
 BACKFILL_BATCH_SIZE = 50000
 
+def index_paths(index_dir=None):
+    """
+    (flat, ivfpq) paths of the current generation inside `index_dir`, the active index set by
+    default. Files staged by this process but not yet published take precedence.
+    """
+    return index_file("flat", index_dir), index_file("ivfpq", index_dir)
+
 # Flat Index
-def _load_or_create_flat_index(dim):
-    if FLAT_INDEX_PATH.exists():
-        return faiss.read_index(str(FLAT_INDEX_PATH))
-    
-    index = faiss.IndexFlatIP(dim)
-    return faiss.IndexIDMap2(index)
+def flat_index_type(index):
+    core = faiss.downcast_index(faiss.downcast_index(index).index)
+    if isinstance(core, faiss.IndexScalarQuantizer):
+        return "fp16" if core.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    return "float32"
+
+def flat_type_for(ntotal, dim):
+    """The storage type FLAT_INDEX_TYPE asks for at `ntotal` vectors."""
+    kind = FLAT_INDEX_TYPE
+    if kind == "auto":
+        budget = FLAT_MEMORY_BUDGET_MB * 1024 * 1024
+        kind = next((k for k, size in FLAT_INDEX_TYPES.items() if ntotal * dim * size <= budget), "sq8")
+    elif kind not in FLAT_INDEX_TYPES:
+        raise ValueError(f"Unknown FLAT_INDEX_TYPE {kind!r}, expected auto or one of {', '.join(FLAT_INDEX_TYPES)}")
+    if kind == "sq8" and ntotal < SQ8_MIN_TRAIN:
+        kind = "fp16"
+    return kind
+
+def _new_flat_index(dim, kind="float32", train=None):
+    if kind == "float32":
+        core = faiss.IndexFlatIP(dim)
+    elif kind == "fp16":
+        core = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    else:
+        # one value range for all dimensions, fitted on the vectors: new vectors of the same model
+        # fall into it, and unlike a fixed [-1, 1] range all 256 levels are used
+        core = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit_uniform, faiss.METRIC_INNER_PRODUCT)
+        core.sq.rangestat = faiss.ScalarQuantizer.RS_minmax
+        core.sq.rangestat_arg = SQ8_RANGE_MARGIN
+        core.train(_sample_training_vectors(train))
+    return faiss.IndexIDMap2(core)
+
+def _load_or_create_flat_index(dim, index_dir=None):
+    flat_path, _ = index_paths(index_dir)
+    if flat_path.exists():
+        return faiss.read_index(str(flat_path))
+    return _new_flat_index(dim, flat_type_for(0, dim))
+
+def _compress_flat_index(index, n_new):
+    """
+    Re-encodes the flat index with a more compact type once it would outgrow its budget (or once
+    FLAT_INDEX_TYPE asks for one). Only ever compresses: decoded vectors are not more exact.
+    """
+    kind, current = flat_type_for(index.ntotal + n_new, index.d), flat_index_type(index)
+    if FLAT_INDEX_TYPES[kind] >= FLAT_INDEX_TYPES[current] or index.ntotal == 0:
+        return index
+    data = _get_all_ids_and_vectors_from_flat_index(index)
+    if data is None:
+        return index
+    ids, vecs = data
+    compressed = _new_flat_index(index.d, kind, vecs)
+    compressed.add_with_ids(vecs, ids)
+    print(f"Flat index re-encoded from {current} to {kind} ({index.ntotal} vectors).")
+    return compressed
 
 def _get_all_ids_and_vectors_from_flat_index(flat_index):
     idmap = faiss.downcast_index(flat_index)
@@ -34,13 +104,87 @@ def _get_all_ids_and_vectors_from_flat_index(flat_index):
         pass
     return None
 
-def add_to_flat_index(vecs, ids, dim):
-    index = _load_or_create_flat_index(dim)
+def _remove_ids(index, ids):
+    # Makes re-adding the same ids (e.g. a resumed job) idempotent; costs a scan of the index
+    index.remove_ids(faiss.IDSelectorBatch(ids.astype("int64")))
+
+def add_to_flat_index(vecs, ids, dim, replace=False, index_dir=None):
+    flat_path, _ = index_paths(index_dir)
+    index = _load_or_create_flat_index(dim, flat_path.parent)
+    if replace:
+        _remove_ids(index, ids)
+    index = _compress_flat_index(index, len(ids))
     index.add_with_ids(vecs.astype("float32"), ids.astype("int64"))
-    faiss.write_index(index, str(FLAT_INDEX_PATH))
+    stage_file("flat", lambda path: faiss.write_index(index, str(path)), flat_path.parent)
+    return index
 
 
 # IVFPQ Index
+def ivf_data_path(index_dir=None):
+    return index_file("ivfdata", index_dir)
+
+def is_ondisk(index):
+    invlists = getattr(index, "invlists", None)
+    return invlists is not None and isinstance(faiss.downcast_InvertedLists(invlists), faiss.OnDiskInvertedLists)
+
+def load_ivfpq_index(path, read_only=True):
+    # On-disk lists are looked up next to the index file, so an index set can be moved or renamed
+    flags = faiss.IO_FLAG_ONDISK_SAME_DIR | (faiss.IO_FLAG_READ_ONLY if read_only else 0)
+    return faiss.read_index(str(path), flags)
+
+def _write_ivfpq_index(index, index_dir):
+    stage_file("ivfpq", lambda path: faiss.write_index(index, str(path)), index_dir)
+
+def _to_ondisk_lists(index, index_dir):
+    """
+    Moves the posting lists of `index` into an mmap'd file. Later adds go straight to the file;
+    the lists grow by doubling their capacity and freed slots are reused.
+    """
+    invlists = faiss.OnDiskInvertedLists(index.nlist, index.code_size, str(stage_path("ivfdata", index_dir)))
+    # Copied list by list: lists laid out by merge_from are packed without spare slots and get
+    # corrupted by later adds
+    src = index.invlists
+    for list_no in range(index.nlist):
+        n = src.list_size(list_no)
+        if n:
+            invlists.add_entries(list_no, n, src.get_ids(list_no), src.get_codes(list_no))
+    index.replace_invlists(invlists, True)
+    # the index owns the lists from now on
+    invlists.this.disown()
+    return index
+
+def _list_ids(invlists, list_no):
+    return faiss.rev_swig_ptr(invlists.get_ids(list_no), invlists.list_size(list_no)).copy()
+
+def _remove_ondisk_ids(index, ids, index_dir):
+    """
+    `_remove_ids` for on-disk lists. Removing compacts the lists in place, under the published
+    generations that still map the file, so the lists are copied into the next generation's file
+    without these ids instead. Lists created for the unpublished generation are changed in place.
+    """
+    src = faiss.downcast_InvertedLists(index.invlists)
+    ids = ids.astype("int64")
+    if not any(src.list_size(l) and np.isin(_list_ids(src, l), ids).any() for l in range(index.nlist)):
+        return index
+    path = stage_path("ivfdata", index_dir)
+    if Path(src.filename).name == path.name:
+        _remove_ids(index, ids)
+        return index
+    invlists = faiss.OnDiskInvertedLists(index.nlist, index.code_size, str(path))
+    for list_no in range(index.nlist):
+        n = src.list_size(list_no)
+        if n:
+            list_ids = _list_ids(src, list_no)
+            codes = faiss.rev_swig_ptr(src.get_codes(list_no), n * index.code_size).reshape(n, -1)
+            keep = ~np.isin(list_ids, ids)
+            list_ids, codes = list_ids[keep], np.ascontiguousarray(codes[keep])
+            if len(list_ids):
+                invlists.add_entries(list_no, len(list_ids), faiss.swig_ptr(list_ids), faiss.swig_ptr(codes))
+    index.replace_invlists(invlists, True)
+    invlists.this.disown()
+    index.ntotal = invlists.compute_ntotal()
+    return index
+
 def _get_m(dim): 
     # Choose m that divides the dim  
     for m in range(64, 7, -1):
@@ -68,12 +212,12 @@ def _build_ivfpq_index(dim, nlist, m, nbits=8, nprobe = 16):
     return index
 
 
-def _load_or_create_ivfpq(dim):
-    if IVFPQ_INDEX_PATH.exists():
-        # This does not handle model change right now in a case where the new model embeddings 
-        # are of different dimension. Need to re-index everything if that happens but keeping it
-        # simple for now
-        return faiss.read_index(str(IVFPQ_INDEX_PATH))
+def _load_or_create_ivfpq(dim, index_dir):
+    _, ivfpq_path = index_paths(index_dir)
+    if ivfpq_path.exists():
+        # A model change never touches these files: re-embedding migrations (rag/migrations.py)
+        # build a separate index set and switch to it once it is complete
+        return load_ivfpq_index(ivfpq_path, read_only=False)
 
     nlist = _get_nlist(get_total_chunks() or TRAIN_SIZE_CAP)  # number of clusters 
     m = _get_m(dim)  
@@ -85,59 +229,74 @@ def _sample_training_vectors(vecs):
         return vecs
     return vecs[np.random.choice(vecs.shape[0], TRAIN_SIZE_CAP, replace=False)]
 
-def _train_ivfpq_index_from_flat(flat_index, dim):
+def _train_ivfpq_index_from_flat(flat_index, dim, index_dir):
     idmap = faiss.downcast_index(flat_index)
     core = faiss.downcast_index(idmap.index)
     if core.ntotal == 0:
         return None
-    index = _load_or_create_ivfpq(dim)
+    index = _load_or_create_ivfpq(dim, index_dir)
     _, vecs = _get_all_ids_and_vectors_from_flat_index(flat_index)
     train = _sample_training_vectors(vecs)
     index.train(train)
-    faiss.write_index(index, str(IVFPQ_INDEX_PATH))
+    if IVF_STORAGE == "ondisk":
+        # before the backfill, so that it never holds all posting lists in memory
+        index = _to_ondisk_lists(index, index_dir)
+    _write_ivfpq_index(index, index_dir)
     return index
 
-def _backfill_ivfpq_index(flat_index, ivfpq_index):
+def _backfill_ivfpq_index(flat_index, ivfpq_index, index_dir):
     ids, vecs = _get_all_ids_and_vectors_from_flat_index(flat_index)
     for i in range(0, vecs.shape[0], BACKFILL_BATCH_SIZE):
         ivfpq_index.add_with_ids(vecs[i:i+BACKFILL_BATCH_SIZE], ids[i:i+BACKFILL_BATCH_SIZE])
-    faiss.write_index(ivfpq_index, str(IVFPQ_INDEX_PATH))
+    _write_ivfpq_index(ivfpq_index, index_dir)
     return ivfpq_index
 
-def _try_load_trained_ivfpq_index(dim: int):
-    if not IVFPQ_INDEX_PATH.exists():
+def _try_load_trained_ivfpq_index(dim: int, index_dir):
+    _, ivfpq_path = index_paths(index_dir)
+    if not ivfpq_path.exists():
         return None
-    index = faiss.read_index(str(IVFPQ_INDEX_PATH))
-    if getattr(index, "is_trained", False) and index.d == dim:
+    index = load_ivfpq_index(ivfpq_path, read_only=False)
+    if getattr(index, "is_trained", False) and index.d != dim:
+        # Vectors of a different model never go into an existing index set
+        raise RuntimeError(
+            f"IVFPQ index in {ivfpq_path.parent} has dimension {index.d}, got {dim}. "
+            "Use a re-embedding migration (python -m rag.migrations start <model>) to change models.")
+    if getattr(index, "is_trained", False):
+        if IVF_STORAGE == "ondisk" and not is_ondisk(index):
+            # an index built in memory is converted once, on its next update
+            index = _to_ondisk_lists(index, index_dir)
+            _write_ivfpq_index(index, index_dir)
         return index
-
-    try: 
-        IVFPQ_INDEX_PATH.unlink(missing_ok=True)
-    except Exception: 
-        pass
+    # an untrained index is never published, a stale one is replaced by the next training run
     return None
 
-def add_to_ivfpq_index(dim, ids, vecs):
-    index = _try_load_trained_ivfpq_index(dim)
+def add_to_ivfpq_index(dim, ids, vecs, replace=False, index_dir=None):
+    flat_path, ivfpq_path = index_paths(index_dir)
+    index_dir = flat_path.parent
+    index = _try_load_trained_ivfpq_index(dim, index_dir)
     if index is not None:
         if ids is not None and vecs is not None and len(ids) > 0:
+            if replace and is_ondisk(index):
+                index = _remove_ondisk_ids(index, ids, index_dir)
+            elif replace:
+                _remove_ids(index, ids)
             index.add_with_ids(vecs.astype("float32"), ids.astype("int64"))
-            faiss.write_index(index, str(IVFPQ_INDEX_PATH))
+            _write_ivfpq_index(index, index_dir)
         return index
     
-    if not FLAT_INDEX_PATH.exists():
+    if not flat_path.exists():
         return None
     
-    flat_index = faiss.read_index(str(FLAT_INDEX_PATH))
+    flat_index = faiss.read_index(str(flat_path))
     idmap = faiss.downcast_index(flat_index)
     core = faiss.downcast_index(idmap.index)
 
     if core.ntotal == 0 or core.ntotal < MIN_TRAIN_SIZE:
         return None
     
-    index = _train_ivfpq_index_from_flat(flat_index, dim)
+    index = _train_ivfpq_index_from_flat(flat_index, dim, index_dir)
     if index is None:
         return None
     
-    index = _backfill_ivfpq_index(flat_index, index)
+    index = _backfill_ivfpq_index(flat_index, index, index_dir)
     return index
\ No newline at end of file
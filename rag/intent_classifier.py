@@ -0,0 +1,157 @@
+"""
+Local fast path in front of the LLM intent analysis.
+
+Obvious cases are decided without an LLM round trip: greetings, thanks and other small talk, input
+without words, and queries whose embedding is clearly closer to the labelled document questions than
+to the small-talk examples. Question form alone decides nothing: "who is the president of France?"
+or "can you tell me a joke?" look like questions about the documents but are not. Anything in
+between returns None and goes to the LLM.
+"""
+from rag.db import match_fts_query
+from rag.embedders import get_embedder, get_embed_model_name
+from rag.registry import shared
+
+import os, re, threading
+import numpy as np
+
+FAST_INTENT_ENABLED = os.getenv("FAST_INTENT_ENABLED", "True") == "True"
+# Difference of the cosine similarities to the search and small-talk centroids needed to decide
+# on the embedding alone
+FAST_INTENT_MARGIN = float(os.getenv("FAST_INTENT_MARGIN", "0.08"))
+
+SEARCH_EXAMPLES = [
+    "What does the contract say about termination?",
+    "Summarize the main findings of the report",
+    "What is the deadline for submitting the application?",
+    "List the requirements described in section 3",
+    "How is the annual budget allocated?",
+    "Which risks are mentioned in the document?",
+    "Explain the methodology used in the study",
+    "What are the payment terms?",
+    "Compare the results of 2022 and 2023",
+    "Who is responsible for data protection?",
+    "What does the policy say about remote work?",
+    "Find the definition of net revenue",
+]
+SMALLTALK_EXAMPLES = [
+    "hi", "hello there", "good morning", "how are you?", "thanks a lot", "thank you!",
+    "ok cool", "bye", "see you later", "who are you?", "what can you do?", "nice, that helps",
+]
+
+_SMALLTALK_RE = re.compile(
+    r"^(hi+|hey+|hello+|yo|hiya|good (morning|afternoon|evening|night)|thanks?( you)?( so much| a lot)?|"
+    r"thx|ty|cheers|ok(ay)?|k|cool|great|nice|awesome|perfect|got it|sounds good|bye|goodbye|"
+    r"see (you|ya)( later)?|how are you( doing)?|how's it going|what's up|sup|lol|haha+)"
+    r"( (there|again|bot|assistant|mate))?[\s!.,?:)]*$", re.IGNORECASE)
+_QUESTION_RE = re.compile(
+    r"^(what|which|who|whom|whose|when|where|why|how|is|are|does|do|did|can|could|should|"
+    r"explain|summari[sz]e|list|describe|compare|find|show|define|give|tell me about)\b", re.IGNORECASE)
+_WORD_RE = re.compile(r"[^\W_]+")
+_PHRASE_RE = re.compile(r'"[^"]+"')
+_STOPWORDS = set("""
+a an the and or but if of to in on at by for with about from into over under as is are was were be been
+being do does did done have has had can could should would will shall may might must this that these those
+it its i me my we our you your he she they them their what which who whom whose when where why how
+there here please tell show give find list explain describe summarize summarise compare define any some all
+one ones thing things also just more other else like get know say said not no yes then than so too very
+""".split())
+
+
+def content_terms(query):
+    """Quoted phrases and non-stopword terms, in order; safe to OR together in an FTS5 query."""
+    phrases = _PHRASE_RE.findall(query)
+    rest = _PHRASE_RE.sub(" ", query)
+    terms = [w for w in _WORD_RE.findall(rest.lower()) if w not in _STOPWORDS and (len(w) > 2 or any(ch.isdigit() for ch in w))]
+    out = []
+    for t in phrases + terms:
+        if t not in out:
+            out.append(t)
+    return out
+
+
+def _normalized(vecs):
+    vecs = np.asarray(vecs, dtype="float32")
+    return vecs / np.clip(np.linalg.norm(vecs, axis=-1, keepdims=True), 1e-12, None)
+
+
+class FastIntentClassifier:
+    def __init__(self, margin=FAST_INTENT_MARGIN):
+        self.margin = margin
+        self._centroids = (None, None)    # (embedding model, [search, smalltalk])
+        self._lock = threading.Lock()
+
+    def _get_centroids(self):
+        model = get_embed_model_name()
+        with self._lock:
+            if self._centroids[0] != model:
+                # one embedding call per model, the examples are embedded together
+                vecs = _normalized(get_embedder().embed(SEARCH_EXAMPLES + SMALLTALK_EXAMPLES))
+                n = len(SEARCH_EXAMPLES)
+                self._centroids = (model, _normalized(np.stack([vecs[:n].mean(axis=0), vecs[n:].mean(axis=0)])))
+            return self._centroids[1]
+
+    def _margin(self, query, query_vec):
+        centroids = self._get_centroids()
+        vec = get_embedder().embed([query]) if query_vec is None else query_vec
+        vec = _normalized(np.asarray(vec).reshape(1, -1))
+        if vec.shape[1] != centroids.shape[1]:
+            return 0.0
+        search, smalltalk = (centroids @ vec[0]).tolist()
+        return search - smalltalk
+
+    def classify(self, query, query_vec=None):
+        """
+        A QueryResponse-shaped dict when the intent is obvious, None when the LLM has to decide.
+        `query_vec` is the query's embedding if the caller already has it.
+        """
+        text = (query or "").strip()
+        if not _WORD_RE.search(text):
+            return self._response(False, "nonsense", "no words")
+        if _SMALLTALK_RE.match(text):
+            return self._response(False, "smalltalk", "small-talk phrase")
+
+        terms = content_terms(text)
+        if len(terms) == 1:
+            # a single term may be a keyword lookup or a reply, the LLM decides
+            return None
+
+        # the embedding decides, if it is clear enough
+        try:
+            margin = self._margin(text, query_vec)
+        except Exception as e:
+            print("Fast intent embedding failed:", e)
+            return None
+        if terms and margin >= self.margin:
+            if not self._in_corpus(terms):
+                # e.g. a general-knowledge question: the LLM decides whether to search anyway
+                return None
+            return self._response(True, "kb_search", f"close to search examples (margin {margin:.2f})", text, terms)
+        question = bool(_QUESTION_RE.match(text)) or text.endswith("?")
+        if not terms and not question and margin <= -self.margin:
+            return self._response(False, "smalltalk", f"close to small talk (margin {margin:.2f})")
+        return None
+
+    def _in_corpus(self, terms):
+        # some content term occurs in the indexed chunks
+        try:
+            return bool(match_fts_query(" OR ".join(terms), 1))
+        except Exception as e:
+            print("Fast intent keyword check failed:", e)
+            return False
+
+    def _response(self, trigger, intent, reason, query="", terms=()):
+        return {
+            "trigger": trigger,
+            "intent": intent,
+            "reason": f"fast_path: {reason}",
+            "semantic_query": query,
+            "keyword_query": " OR ".join(terms),
+            "must_terms": [],
+            "should_terms": [],
+        }
+
+
+def get_fast_intent_classifier():
+    if not FAST_INTENT_ENABLED:
+        return None
+    return shared("fast_intent_classifier", FastIntentClassifier)
@@ -1,11 +1,12 @@
+from rag.intent_classifier import get_fast_intent_classifier
 from rag.llm_client import get_llm_client
+from rag.metrics import INTENT_DECISIONS
+from rag.registry import shared
 from pydantic import BaseModel, ValidationError
 from typing import List
 
 import json, re
 
-LLM_CLIENT = get_llm_client()
-
 _SYSTEM = """You are an intent and query-rewriting assistant for a RAG system.
 Decide if the user's message should trigger a knowledge-base search (documents).
 Ensure that small talks do not trigger a knowledge-base search, but specific questions do.
@@ -37,8 +38,12 @@ class QueryResponse(BaseModel):
     should_terms: List[str] = []
     
 class IntentService:
-    def __init__(self):
-        self.client = LLM_CLIENT
+    # Schema of the structured LLM response
+    response_model = QueryResponse
+
+    @property
+    def client(self):
+        return get_llm_client()
 
     def _strip_code_fences(self, s):
         m = _JSON_FENCE_RE.match(s)
@@ -61,7 +66,7 @@ class IntentService:
 
     def _parse_query_response_from_completion(self, txt):
         try:
-            return QueryResponse.model_validate_json(txt)
+            return self.response_model.model_validate_json(txt)
         except Exception:
             pass
 
@@ -69,21 +74,36 @@ class IntentService:
         txt = self._strip_code_fences(txt)
         jtxt = self._extract_first_json_object(txt)
         if jtxt:
-            return QueryResponse.model_validate_json(jtxt)
+            return self.response_model.model_validate_json(jtxt)
 
         # Parse to dict then validate
         try:
             data = json.loads(txt)
-            return QueryResponse.model_validate(data)
+            return self.response_model.model_validate(data)
         except (json.JSONDecodeError, ValidationError) as e:
             # Safe fallback
-            return QueryResponse(
+            return self.response_model(
                 trigger=False, intent="other", reason=f"llm_failed: {str(e)}",
                 semantic_query="", keyword_query="",
                 must_terms=[], should_terms=[],
             )
 
-    def analyze(self, query):
+    def analyze(self, query, query_vec=None):
+        """
+        Obvious cases are decided locally (rag/intent_classifier.py), the rest by the LLM.
+        `query_vec` is the query's embedding if the caller already has one.
+        """
+        fast = get_fast_intent_classifier()
+        if fast is not None:
+            response = fast.classify(query, query_vec)
+            if response is not None:
+                INTENT_DECISIONS.inc(path="fast", intent=response["intent"])
+                return response
+        response = self._analyze_llm(query)
+        INTENT_DECISIONS.inc(path="llm", intent=response["intent"])
+        return response
+
+    def _analyze_llm(self, query):
         msgs = [
             {"role": "system", "content": _SYSTEM},
             {"role": "user", "content": f"User query:\n{query}\nAgain it is imperative that you respond with STRICT JSON only as provided."}
@@ -102,8 +122,8 @@ class IntentService:
                 keyword_query=query,
                 must_terms=[],
                 should_terms=[],
-            )
+            ).model_dump()
         
 
 def get_intent_service():
-    return IntentService()
\ No newline at end of file
+    return shared("intent_service", IntentService)
\ No newline at end of file
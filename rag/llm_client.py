@@ -1,15 +1,20 @@
 import os
 from dotenv import load_dotenv, find_dotenv
-from mistralai import Mistral
 from typing import Protocol, List, Dict, Any
+from rag.metrics import span
+from rag.registry import shared
+from rag.scheduler import get_scheduler, estimate_tokens
 
 load_dotenv(find_dotenv(), override=True)
 
 API_KEY = os.getenv("MISTRAL_API_KEY")
+# Alternative API endpoint, e.g. the local stand-in used by load tests (benchmarks/fake_mistral.py)
+SERVER_URL = os.getenv("MISTRAL_SERVER_URL") or None
 CHAT_MODEL = os.getenv("MISTRAL_CHAT_MODEL")
 
 class LLMClient(Protocol):
     def chat_query(self, messages: List[Dict[str, str]], **kwargs) -> str: ...
+    async def achat_query(self, messages: List[Dict[str, str]], **kwargs) -> str: ...
 
 class MistralChatClient:
     def __init__(self):
@@ -18,9 +23,11 @@ class MistralChatClient:
         if not API_KEY:
             raise RuntimeError("MISTRAL_API_KEY not set; cannot use Mistral embeddings.")
 
+        from mistralai import Mistral
+
         self.api_key = API_KEY
         self.chat_model = CHAT_MODEL
-        self.client = Mistral(api_key=self.api_key)
+        self.client = Mistral(api_key=self.api_key, server_url=SERVER_URL)
     
     def _content_to_text(self, content: Any) -> str:
         # Mistral may return a string OR a list of chunk objects
@@ -37,12 +44,26 @@ class MistralChatClient:
             return "\n".join(texts)
         return str(content)
 
+    def _estimate_tokens(self, messages, kwargs):
+        # prompt plus the completion budget, if one was given
+        return estimate_tokens([m.get("content") for m in messages]) + int(kwargs.get("max_tokens") or 0)
+
     def chat_query(self, messages, structured=False, **kwargs) -> str:
-        if structured:
-            response = self.client.chat.parse(model=self.chat_model, messages=messages, **kwargs)
-        else:
-            response = self.client.chat.complete(model=self.chat_model, messages=messages, **kwargs)
+        fn = self.client.chat.parse if structured else self.client.chat.complete
+        with span("llm_chat"):
+            response = get_scheduler().call(
+                fn, model=self.chat_model, messages=messages,
+                tokens=self._estimate_tokens(messages, kwargs), **kwargs)
+        return self._content_to_text(response.choices[0].message.content)
+
+    async def achat_query(self, messages, structured=False, **kwargs) -> str:
+        # Same underlying client (and connection pool config) as the sync path
+        fn = self.client.chat.parse_async if structured else self.client.chat.complete_async
+        with span("llm_chat"):
+            response = await get_scheduler().acall(
+                fn, model=self.chat_model, messages=messages,
+                tokens=self._estimate_tokens(messages, kwargs), **kwargs)
         return self._content_to_text(response.choices[0].message.content)
     
 def get_llm_client() -> LLMClient:
-    return MistralChatClient()
\ No newline at end of file
+    return shared("llm_client", MistralChatClient)
\ No newline at end of file
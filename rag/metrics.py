@@ -0,0 +1,193 @@
+"""
+Small in-process metrics registry (counters, gauges, histograms) rendered in the Prometheus text
+format, plus `span` to time pipeline stages. Kept dependency free on purpose; if the project ever
+moves to prometheus_client, the metric names can stay the same.
+"""
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import contextvars, threading, time
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _fmt_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    inner = ",".join(f'{k}="{str(v)}"' for k, v in items)
+    return "{" + inner + "}"
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1.0, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self):
+        with self.lock:
+            return self._header() + [f"{self.name}{_fmt_labels(k)} {v}" for k, v in self.values.items()]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_label_key(labels)] = float(value)
+
+    def render(self):
+        with self.lock:
+            return self._header() + [f"{self.name}{_fmt_labels(k)} {v}" for k, v in self.values.items()]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=_DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), [0, 0.0]))
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    counts[i] += 1
+            total[0] += 1
+            total[1] += value
+            self.values[key] = (counts, total)
+
+    def render(self):
+        lines = self._header()
+        with self.lock:
+            for key, (counts, (n, s)) in self.values.items():
+                for b, c in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_fmt_labels(key, [('le', b)])} {c}")
+                lines.append(f"{self.name}_bucket{_fmt_labels(key, [('le', '+Inf')])} {n}")
+                lines.append(f"{self.name}_sum{_fmt_labels(key)} {s}")
+                lines.append(f"{self.name}_count{_fmt_labels(key)} {n}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help, **kwargs):
+        return self._get(Histogram, name, help, **kwargs)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for m in metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("rag_stage_seconds", "Time spent in each pipeline stage / external call")
+STAGE_ERRORS = REGISTRY.counter("rag_stage_errors_total", "Pipeline stages that raised")
+CACHE_REQUESTS = REGISTRY.counter("rag_answer_cache_requests_total", "Answer cache lookups by result (hit|miss)")
+INTENT_DECISIONS = REGISTRY.counter("rag_intent_decisions_total", "Intent decisions by path (fast|llm|combined) and intent")
+FTS_CACHE_REQUESTS = REGISTRY.counter("rag_fts_cache_requests_total", "Keyword MATCH cache lookups by result (hit|miss)")
+JOBS = REGISTRY.gauge("rag_jobs", "Jobs in the queue by status")
+CHUNKS_INDEXED = REGISTRY.counter("rag_chunks_indexed_total", "Chunks embedded and added to the indexes")
+CHUNKS_DEDUPLICATED = REGISTRY.counter("rag_chunks_deduplicated_total", "Near-duplicate chunks stored without embedding or indexing")
+CHUNKS_PER_SECOND = REGISTRY.gauge("rag_chunks_indexed_per_second", "Indexing throughput of the last job")
+INDEX_SIZE = REGISTRY.gauge("rag_index_size", "Size of the indexes (chunks, vectors, bytes, published generation)")
+
+# Per-request list of (stage, seconds) when timings are being collected
+_TIMINGS = contextvars.ContextVar("rag_stage_timings", default=None)
+
+
+@contextmanager
+def span(stage):
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = _TIMINGS.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+@contextmanager
+def collect_timings():
+    """Collects the spans of the current request/context; yields a list of (stage, seconds)."""
+    timings = []
+    token = _TIMINGS.set(timings)
+    try:
+        yield timings
+    finally:
+        _TIMINGS.reset(token)
+
+
+def timings_ms(timings):
+    out = {}
+    for stage, seconds in timings:
+        out[stage] = round(out.get(stage, 0.0) + seconds * 1000.0, 3)
+    return out
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """Serves /metrics from a daemon thread, for processes without a web app (the worker)."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
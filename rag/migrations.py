@@ -0,0 +1,131 @@
+"""
+Re-embedding migrations: move the corpus to a new embedding model without downtime.
+
+    python -m rag.migrations start <model>     # e.g. mistral-embed-2 or hashing-512
+    python -m rag.migrations status
+    python -m rag.migrations cancel
+
+The worker re-embeds chunks in small throttled batches whenever its job queue is empty and adds them
+to a new index set next to the active one. Queries keep using the active set until every chunk is
+migrated; then the active pointer is switched atomically and the old set is removed.
+"""
+from rag.active_index import INDEX_DIR, read_active, write_active, publish, remove_index_files
+from rag.db import (init_schema, create_migration, get_running_migration, get_last_migration,
+                    advance_migration, finish_migration, get_chunks_after, set_chunks_embed_model,
+                    MigrationStatus)
+from rag.embedders import get_embedder, get_embed_model_name
+from rag.indexer import add_to_flat_index, add_to_ivfpq_index, index_paths, ivf_data_path
+from rag.metrics import span
+from rag.registry import lazy_module
+from rag.routing import rebuild_document_routes
+from dotenv import load_dotenv, find_dotenv
+
+import os, re, shutil, sys, time
+import numpy as np
+
+faiss = lazy_module("faiss")
+
+load_dotenv(find_dotenv(), override=True)
+
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "256"))
+# Pause after every batch so a migration never saturates the worker or the provider quota
+MIGRATION_PAUSE_SECONDS = float(os.getenv("MIGRATION_PAUSE_SECONDS", "0.5"))
+
+# Migrations that already did a step in this process; the first step after a (re)start may repeat
+# a batch whose cursor update was lost, so it replaces ids instead of adding duplicates
+_STEPPED = set()
+
+
+def start_migration(target_model):
+    if get_running_migration():
+        raise RuntimeError("A migration is already running.")
+    if target_model == get_embed_model_name():
+        raise RuntimeError(f"{target_model} is already the active embedding model.")
+    slug = re.sub(r"[^\w.-]", "_", target_model)
+    index_dir = INDEX_DIR / f"gen-{slug}-{int(time.time())}"
+    index_dir.mkdir(parents=True, exist_ok=False)
+    return create_migration(target_model, str(index_dir))
+
+
+def _remove_index_set(index_dir):
+    if index_dir.resolve() == INDEX_DIR.resolve():
+        # the original layout keeps its indexes directly in INDEX_DIR, next to the other sets
+        remove_index_files(index_dir)
+        ivf_data_path(index_dir).unlink(missing_ok=True)
+    else:
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+
+def _cutover(migration):
+    old_dir = read_active()["dir"]
+    new_dir = migration["index_dir"]
+    flat_path, _ = index_paths(new_dir)
+    if flat_path.exists():
+        # document centroids for routing, in the new model's space
+        rebuild_document_routes(new_dir, faiss.read_index(str(flat_path)))
+        publish(new_dir, embed_model=migration["target_model"])
+    set_chunks_embed_model(migration["target_model"])
+    write_active(new_dir, migration["target_model"])
+    finish_migration(migration["id"], MigrationStatus.DONE)
+    # readers hold a loaded copy of the old index, removing the files does not affect them
+    _remove_index_set(old_dir)
+    print(f"Migration {migration['id']} done, now serving {migration['target_model']} from {new_dir}")
+
+
+def step_migration():
+    """Migrates one batch of the running migration (or cuts over). Returns False if idle."""
+    migration = get_running_migration()
+    if not migration:
+        return False
+
+    rows = get_chunks_after(migration["cursor"], MIGRATION_BATCH_SIZE)
+    if not rows:
+        _cutover(migration)
+        return True
+
+    with span("migration_embed"):
+        vecs = get_embedder(migration["target_model"]).embed([text for _, text in rows])
+    ids = np.array([cid for cid, _ in rows], dtype="int64")
+    dim = vecs.shape[1]
+    replace = migration["id"] not in _STEPPED
+
+    with span("migration_index"):
+        add_to_flat_index(vecs, ids, dim, replace=replace, index_dir=migration["index_dir"])
+        add_to_ivfpq_index(dim, ids, vecs, replace=replace, index_dir=migration["index_dir"])
+        publish(migration["index_dir"], chunk_hwm=int(ids[-1]), embed_model=migration["target_model"])
+    advance_migration(migration["id"], int(ids[-1]), len(ids))
+    _STEPPED.add(migration["id"])
+
+    time.sleep(MIGRATION_PAUSE_SECONDS)
+    return True
+
+
+def cancel_migration():
+    migration = get_running_migration()
+    if not migration:
+        return None
+    finish_migration(migration["id"], MigrationStatus.CANCELLED)
+    shutil.rmtree(migration["index_dir"], ignore_errors=True)
+    return migration["id"]
+
+
+def main(argv):
+    init_schema()
+    cmd = argv[0] if argv else "status"
+    if cmd == "start" and len(argv) == 2:
+        print(f"Started migration {start_migration(argv[1])} to {argv[1]}")
+    elif cmd == "cancel":
+        print(f"Cancelled migration {cancel_migration()}")
+    elif cmd == "status":
+        m = get_last_migration()
+        print(f"Active: {get_embed_model_name()} in {read_active()['dir']}")
+        if m:
+            print(f"Last migration {m['id']}: {m['status']} -> {m['target_model']}, "
+                  f"{m['migrated']} chunks migrated (cursor {m['cursor']})")
+    else:
+        print(__doc__)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
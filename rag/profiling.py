@@ -0,0 +1,154 @@
+"""
+Opt-in profiling of single queries and worker jobs.
+
+A profiled unit of work either gets a sampling profiler (a background thread snapshots the stack of
+the profiled thread every PROFILE_INTERVAL seconds and writes collapsed stacks, the input format of
+flamegraph.pl and speedscope) or cProfile (a `.pstats` file for snakeviz / pstats). Native code such
+as FAISS searches, SQLite queries or socket reads shows up as the Python frame that called it.
+
+Nothing is started unless a unit is selected, by request (header or flag) or by PROFILE_SAMPLE_RATE,
+so the cost when off is one comparison per request.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import cProfile, os, random, re, sys, threading, uuid
+
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", "data/profiles"))
+# Share of queries / jobs profiled without being asked to, 0 disables sampling
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# sampling | cprofile
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sampling")
+# Seconds between two stack samples of the sampling profiler
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.002"))
+# Only the most recent profiles are kept
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "200"))
+
+PROFILE_SUFFIXES = (".collapsed", ".pstats")
+_NAME_RE = re.compile(r"^[\w.-]+$")
+
+
+def should_profile(requested=False):
+    return requested or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    path = Path(code.co_filename)
+    return f"{code.co_name} ({path.parent.name}/{path.name}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Samples the call stack of one thread from a background thread."""
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, n in self.stacks.most_common():
+                f.write(f"{stack} {n}\n")
+
+
+def _prune():
+    if PROFILE_KEEP <= 0:
+        return
+    files = sorted((p for p in PROFILE_DIR.iterdir() if p.suffix in PROFILE_SUFFIXES), key=lambda p: p.stat().st_mtime)
+    for p in files[:-PROFILE_KEEP]:
+        p.unlink(missing_ok=True)
+
+
+class ProfileHandle:
+    def __init__(self):
+        self.name = None
+
+
+@contextmanager
+def profile(label, enabled, mode=None):
+    """
+    Profiles the calling thread for the duration of the block when `enabled`. The handle's `name`
+    is the file name of the written profile afterwards.
+    """
+    handle = ProfileHandle()
+    if not enabled:
+        yield handle
+        return
+
+    mode = mode or PROFILE_MODE
+    profiler = None
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is already active on this interpreter
+            profiler, mode = None, "sampling"
+    if profiler is None:
+        profiler = SamplingProfiler(threading.get_ident())
+        profiler.start()
+
+    try:
+        yield handle
+    finally:
+        if mode == "cprofile":
+            profiler.disable()
+        else:
+            profiler.stop()
+        try:
+            handle.name = _write(profiler, label, mode)
+        except OSError as e:
+            # a profile must never fail the request or job it belongs to
+            print("Writing profile failed:", e)
+
+
+def _write(profiler, label, mode):
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    safe_label = re.sub(r"[^\w.-]", "_", label)[:60]
+    stem = f"{datetime.now():%Y%m%d-%H%M%S}-{safe_label}-{uuid.uuid4().hex[:6]}"
+    if mode == "cprofile":
+        path = PROFILE_DIR / f"{stem}.pstats"
+        profiler.dump_stats(str(path))
+    else:
+        path = PROFILE_DIR / f"{stem}.collapsed"
+        profiler.write(path)
+    _prune()
+    return path.name
+
+
+def list_profiles():
+    if not PROFILE_DIR.exists():
+        return []
+    files = [p for p in PROFILE_DIR.iterdir() if p.suffix in PROFILE_SUFFIXES]
+    files.sort(key=lambda p: p.stat().st_mtime, reverse=True)
+    return [{"name": p.name, "bytes": p.stat().st_size,
+             "created_at": datetime.fromtimestamp(p.stat().st_mtime).isoformat(timespec="seconds")} for p in files]
+
+
+def profile_path(name):
+    """Path of a stored profile, None for unknown or unsafe names."""
+    if not _NAME_RE.match(name) or Path(name).suffix not in PROFILE_SUFFIXES:
+        return None
+    path = PROFILE_DIR / name
+    return path if path.is_file() else None
@@ -1,14 +1,14 @@
 from __future__ import annotations
 from rag.llm_client import get_llm_client
+from rag.registry import shared
 
 import json
 
-LLM_CLIENT = get_llm_client()
-
 SYSTEM = (
   """You refine user queries for a RAG system using history. Use recent dialogue to 
   resolve pronouns and references and add context to the queries for better results; 
-  keep the user's intent unchanged. Return the refined query.
+  keep the user's intent unchanged. A conversation_summary, if given, covers the dialogue
+  before the recent turns. Return the refined query.
 """
 )
 
@@ -37,16 +37,23 @@ def _trim_history(history):
 
 
 class QueryRefinerClient:
-    def __init__(self):
-        self._client = LLM_CLIENT
+    @property
+    def _client(self):
+        return get_llm_client()
 
-    def refine(self, query, history):
-        hist = _trim_history(history or [])
+    def refine(self, query, history, summary=""):
+        """`summary` is a server-side session's summary of the dialogue before `history`."""
+        if not history and not summary:
+            # nothing to resolve references against
+            return query
+        hist = _trim_history(history)
 
         payload = {
             "recent_dialogue": hist,
             "current_query": query
         }
+        if summary:
+            payload = {"conversation_summary": summary, **payload}
         msgs = [
             {"role": "system", "content": SYSTEM},
             {"role": "user", "content": json.dumps(payload, ensure_ascii=False)}
@@ -61,4 +68,4 @@ class QueryRefinerClient:
     
 
 def get_refiner():
-    return QueryRefinerClient()
\ No newline at end of file
+    return shared("refiner", QueryRefinerClient)
\ No newline at end of file
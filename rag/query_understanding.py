@@ -0,0 +1,88 @@
+"""
+Query refinement and intent analysis in one structured LLM call.
+
+The two-call pipeline first rewrites the query against the dialogue (rag/query_refiner.py), then
+classifies the rewritten query (rag/intent_service.py). The combined pipeline asks for both in a
+single response whose schema extends QueryResponse with the refined query. QUERY_PIPELINE picks the
+default, a request can override it to compare the two.
+"""
+from rag.intent_service import IntentService, QueryResponse
+from rag.metrics import INTENT_DECISIONS
+from rag.query_refiner import _trim_history
+from rag.registry import shared
+
+import json, os
+
+PIPELINES = ("two_call", "combined")
+QUERY_PIPELINE = os.getenv("QUERY_PIPELINE", "two_call")
+
+_SYSTEM = """You refine and analyze user queries for a RAG system in one step.
+First rewrite the current query using the recent dialogue (and the conversation_summary of the
+dialogue before it, if given): resolve pronouns and references and add context for better results;
+keep the user's intent unchanged. Without dialogue, or when nothing needs resolving, refined_query
+is the current query.
+Then decide if the refined query should trigger a knowledge-base search (documents).
+Ensure that small talks do not trigger a knowledge-base search, but specific questions do.
+If the query is supposed to trigger a knowledge-base search, output high-quality rewrites:
+- semantic_query: best semantic form (natural language) for semantic similarity checks
+- keyword_query: FTS-friendly string; OR terms; keep quotes together
+- must_terms: []  (exact terms that must appear; else empty)
+- should_terms: [] (optional helpful terms; do not force any keyword here just to fill this)
+Return STRICT JSON only:
+{
+  "refined_query": string,
+  "trigger": boolean,
+  "intent": "kb_search" | "smalltalk" | "nonsense" | "other",
+  "reason": string,
+  "semantic_query": string,
+  "keyword_query": string,
+  "must_terms": string[],
+  "should_terms": string[]
+}"""
+
+
+class QueryUnderstanding(QueryResponse):
+    refined_query: str = ""
+
+
+class QueryUnderstandingService(IntentService):
+    response_model = QueryUnderstanding
+
+    def understand(self, query, history, summary=""):
+        """(refined query, QueryResponse-shaped dict) from one LLM call."""
+        payload = {
+            "recent_dialogue": _trim_history(history),
+            "current_query": query
+        }
+        if summary:
+            payload = {"conversation_summary": summary, **payload}
+        msgs = [
+            {"role": "system", "content": _SYSTEM},
+            {"role": "user", "content": json.dumps(payload, ensure_ascii=False) + "\nAgain it is imperative that you respond with STRICT JSON only as provided."}
+        ]
+
+        try:
+            text = self.client.chat_query(msgs, structured = True, temperature = 0.0, response_format=QueryUnderstanding)
+            response = self._parse_query_response_from_completion(text).model_dump()
+        except Exception as e:
+            response = QueryUnderstanding(
+                trigger=False,
+                intent="other",
+                reason=f"llm_failed: {str(e)}",
+                semantic_query=query,
+                keyword_query=query,
+            ).model_dump()
+        refined_query = (response.pop("refined_query") or "").strip() or query
+        INTENT_DECISIONS.inc(path="combined", intent=response["intent"])
+        return refined_query, response
+
+
+def resolve_pipeline(requested=None):
+    pipeline = requested or QUERY_PIPELINE
+    if pipeline not in PIPELINES:
+        raise ValueError(f"Unknown query pipeline {pipeline!r}, expected one of {', '.join(PIPELINES)}")
+    return pipeline
+
+
+def get_query_understanding():
+    return shared("query_understanding", QueryUnderstandingService)
@@ -0,0 +1,54 @@
+"""
+Process-wide registry of lazily created, shared objects: LLM/embedding clients, services and heavy
+modules (faiss, fitz). Nothing is built at import time; the first caller creates the instance and
+every later caller (sync or async, any thread) gets the same one, so the API and the worker keep a
+single HTTP client per upstream.
+"""
+import importlib, threading
+
+_INSTANCES = {}
+_LOCK = threading.RLock()
+
+
+def shared(key, factory):
+    inst = _INSTANCES.get(key)
+    if inst is None:
+        with _LOCK:
+            inst = _INSTANCES.get(key)
+            if inst is None:
+                inst = factory()
+                _INSTANCES[key] = inst
+    return inst
+
+
+def override(key, instance):
+    """Replace a shared instance, e.g. with a stub in benchmarks or load tests."""
+    with _LOCK:
+        _INSTANCES[key] = instance
+
+
+def reset(key=None):
+    with _LOCK:
+        if key is None:
+            _INSTANCES.clear()
+        else:
+            _INSTANCES.pop(key, None)
+
+
+class _LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = shared(f"module:{self._name}", lambda: importlib.import_module(self._name))
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+def lazy_module(name):
+    """Module proxy that only imports `name` on first attribute access."""
+    return _LazyModule(name)
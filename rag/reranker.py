@@ -1,8 +1,8 @@
 from rag.llm_client import get_llm_client
+from rag.registry import shared
 from pydantic import BaseModel
 from typing import Optional, List
 
-LLM_CLIENT = get_llm_client()
 BATCH_SIZE = 16
 MAX_CANDIDATE_CHARS = 1000
 
@@ -34,8 +34,9 @@ class LLMReranker(_BaseReranker):
         "Return STRICT JSON as: {\"scores\": [s0, s1, ...], \"reasons\": [\"...\", ...]} only."
     )
 
-    def __init__(self):
-        self.client = LLM_CLIENT
+    @property
+    def client(self):
+        return get_llm_client()
 
     def score(self, query: str, candidates: List[str]) -> List[RerankResult]:
         # Batch if many candidates to keep context small
@@ -68,4 +69,4 @@ class LLMReranker(_BaseReranker):
         return results
     
 def build_reranker() -> _BaseReranker:
-    return LLMReranker()
\ No newline at end of file
+    return shared("reranker", LLMReranker)
\ No newline at end of file
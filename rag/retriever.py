@@ -1,22 +1,43 @@
-from rag.intent_service import get_intent_service
+from rag.active_index import read_manifest
 from rag.embedders import get_embedder
-from rag.indexer import IVFPQ_INDEX_PATH, FLAT_INDEX_PATH
+from rag.indexer import load_ivfpq_index
+from rag.index_server import INDEX_SERVER_FALLBACK, get_index_client
 from rag.db import match_fts_query, get_chunk_meta
 from rag.reranker import build_reranker
+from rag.metrics import span
+from rag.routing import get_router
+from rag.registry import shared, lazy_module
 from dotenv import load_dotenv, find_dotenv
 
-import re, faiss
+from concurrent.futures import ThreadPoolExecutor
+
+import os, re, threading
 import numpy as np
 
+faiss = lazy_module("faiss")
+
 load_dotenv(find_dotenv(), override=True)
-EMBED_MODEL = get_embedder()
-INTENT_SERVICE = get_intent_service()
+
+# Keyword searches and reranks of a batch run on this many threads (SQLite and the LLM calls release the GIL)
+BATCH_SEARCH_WORKERS = int(os.getenv("BATCH_SEARCH_WORKERS", "8"))
+# Routed queries probe this many times the IVF index's nprobe lists
+ROUTED_NPROBE_FACTOR = int(os.getenv("ROUTED_NPROBE_FACTOR", "4"))
 
 _WS_RE = re.compile(r"\s+")
 
 class Retriever:
     def __init__(self):
-        self.embed_model = EMBED_MODEL
+        # Published index files never change, so a loaded generation stays valid until the next one
+        self._loaded = (None, None)   # ((dir, generation, dim), (index, type))
+        self._load_lock = threading.Lock()
+
+    @property
+    def embed_model(self):
+        return get_embedder()
+
+    @property
+    def router(self):
+        return get_router()
 
     def _normalize(self, query):
         return _WS_RE.sub(" ", (query or "").strip())
@@ -77,14 +98,45 @@ class Retriever:
         return " OR ".join(groups)
     
     def _load_index(self, dim):
-        if IVFPQ_INDEX_PATH.exists():
-            index = faiss.read_index(str(IVFPQ_INDEX_PATH))
+        index, type, _ = self._load_generation(dim)
+        return index, type
+
+    def _load_generation(self, dim):
+        """(index, type, manifest) of the published generation of the active index set."""
+        for attempt in range(2):
+            manifest = read_manifest()
+            key = (manifest["dir"], manifest["generation"], dim)
+            with self._load_lock:
+                if self._loaded[0] == key:
+                    return (*self._loaded[1], manifest)
+                try:
+                    loaded = self._read_index_files(manifest, dim)
+                except (FileNotFoundError, RuntimeError):
+                    # the generation was collected between reading the manifest and its files
+                    # (FAISS reports a missing file as RuntimeError)
+                    if attempt:
+                        raise
+                    continue
+                self._loaded = (key, loaded)
+                return (*loaded, manifest)
+
+    def _release_loaded(self):
+        # the local copy loaded while the index server was unreachable is not needed anymore
+        if self._loaded[0] is not None:
+            with self._load_lock:
+                self._loaded = (None, None)
+
+    def _read_index_files(self, manifest, dim):
+        flat_path, ivfpq_path = (manifest["dir"] / manifest["files"][kind] for kind in ("flat", "ivfpq"))
+        if ivfpq_path.exists():
+            index = load_ivfpq_index(ivfpq_path)
             if getattr(index, "is_trained", False) and getattr(index, "d", dim) == dim and index.ntotal > 0:
                 return index, "ivfpq"
             
-        if FLAT_INDEX_PATH.exists():
-            index = faiss.read_index(str(FLAT_INDEX_PATH))
-            if index.ntotal > 0:
+        if flat_path.exists():
+            index = faiss.read_index(str(flat_path))
+            # the dimension only differs for a moment around a migration cutover
+            if index.ntotal > 0 and index.d == dim:
                 return index, "flat"
             
         return None, ""
@@ -93,16 +145,79 @@ class Retriever:
         if index is None:
             return []
         
-        distances, labels = index.search(embedded_query.astype("float32"), top_k)
-        ids = labels[0]
-        scores = distances[0]
+        return self._semantic_search_many(index, embedded_query[:1], top_k)[0]
+
+    def _semantic_search_many(self, index, embedded_queries, top_k):
+        if index is None:
+            return [[] for _ in range(embedded_queries.shape[0])]
+
+        # One search over the whole query matrix instead of one call per query
+        distances, labels = index.search(np.ascontiguousarray(embedded_queries, dtype="float32"), top_k)
 
         # by default, these scores are between -1 and 1. We change them to be between 0 and 1.
-        simple_score = np.clip(scores, -1.0, 1.0)
-        simple_score = (simple_score + 1.0) / 2.0
+        simple_scores = np.clip(distances, -1.0, 1.0)
+        simple_scores = (simple_scores + 1.0) / 2.0
+
+        return [
+            [(int(i), float(s)) for i, s in zip(ids, scores) if i != -1]
+            for ids, scores in zip(labels, simple_scores)
+        ]
+
+    def _semantic_search_within(self, index, embedded_query, top_k, chunk_ids):
+        # Only the routed chunks are scored, behind a selector; the shared index itself is never
+        # modified. IVF indexes probe ROUTED_NPROBE_FACTOR times their usual lists, since fewer
+        # entries of each list pass the selector
+        if index is None or len(chunk_ids) == 0:
+            return []
+        sel = faiss.IDSelectorBatch(np.asarray(chunk_ids, dtype="int64"))
+        if hasattr(index, "nlist"):
+            params = faiss.SearchParametersIVF(sel=sel, nprobe=min(index.nlist, index.nprobe * ROUTED_NPROBE_FACTOR))
+        else:
+            params = faiss.SearchParameters(sel=sel)
+        distances, labels = index.search(np.ascontiguousarray(embedded_query[:1], dtype="float32"),
+                                         top_k, params=params)
+        simple_scores = (np.clip(distances[0], -1.0, 1.0) + 1.0) / 2.0
+        return [(int(i), float(s)) for i, s in zip(labels[0], simple_scores) if i != -1]
+
+    def _search_loaded(self, index, embedded_queries, top_k, routes):
+        # unrouted queries share one matrix search, routed ones have their own selector
+        semantic_similarities = [[] for _ in routes]
+        if index is None:
+            return semantic_similarities
+        unrouted = [i for i, r in enumerate(routes) if r is None]
+        if unrouted:
+            found = self._semantic_search_many(index, embedded_queries[unrouted], top_k)
+            for i, sims in zip(unrouted, found):
+                semantic_similarities[i] = sims
+        for i, r in enumerate(routes):
+            if r is not None:
+                semantic_similarities[i] = self._semantic_search_within(
+                    index, embedded_queries[i:i + 1], top_k, r.chunk_ids)
+        return semantic_similarities
+
+    def _vector_search(self, embedded_queries, dim, routes, top_k):
+        """
+        (index type, [(chunk_id, score)] per query), from the index server
+        when one is configured (rag/index_server.py), else from the indexes loaded in this process.
+        """
+        client = get_index_client()
+        if client is not None:
+            try:
+                with span("faiss_search"):
+                    result = client.search(embedded_queries, top_k, [r.chunk_ids if r else None for r in routes])
+            except OSError:
+                if not INDEX_SERVER_FALLBACK:
+                    raise
+            else:
+                self._release_loaded()
+                return result
+
+        with span("index_load"):
+            index, type, _ = self._load_generation(dim)
+        with span("faiss_search"):
+            sims = self._search_loaded(index, embedded_queries, top_k, routes)
+        return type, sims
 
-        return [(int(i), float(s)) for i,s in zip(ids, simple_score) if i != -1]
-    
     def _normalize_bm25_score(self, rows):
         if not rows:
             return []
@@ -119,8 +234,16 @@ class Retriever:
         return [(int(rows[i][0]), (inv[i] - imin) / (imax - imin + 1e-12)) for i in range(len(rows))]
 
     
-    def _keyword_search(self, query, top_k):
-        rows = match_fts_query(query, top_k)
+    def _keyword_search(self, query, top_k, document_ids=None):
+        rows = None
+        client = get_index_client()
+        if client is not None:
+            try:
+                rows = client.keyword(query, top_k, document_ids)
+            except OSError:
+                pass
+        if rows is None:
+            rows = match_fts_query(query, top_k, document_ids)
         if not rows:
             return []
         
@@ -152,8 +275,16 @@ class Retriever:
         by_id = {r["chunk_id"]: r for r in res}
         return [by_id[i] for i in ids if i in by_id]
 
-    def _embed_query(self, query):
-        embeddings = self.embed_model.embed(query)
+    def _embed_query(self, query, query_vecs=None):
+        return self._embed_queries([query], query_vecs)
+
+    def _embed_queries(self, queries, query_vecs=None):
+        # `query_vecs`: {text: embedding} of texts the caller already embedded
+        known = dict(query_vecs or {})
+        missing = [q for q in dict.fromkeys(queries) if q not in known]
+        if missing:
+            known.update(zip(missing, self.embed_model.embed(missing)))
+        embeddings = np.vstack([np.asarray(known[q], dtype="float32").reshape(1, -1) for q in queries])
         return embeddings, embeddings.shape[1]
     
     def _final_score(self, h):
@@ -162,23 +293,20 @@ class Retriever:
         return 0.85 * r + 0.15 * f
 
     
-    def search(self, query, query_meta, rerank = False, top_k = 8, rrf_k = 60):
+    def _prepare_queries(self, query, query_meta):
         semantic_query = self._normalize(query_meta.get("semantic_query", "") or query)
         keyword_query = self._get_fts_query(
             query_meta.get("keyword_query", "") or query,
             query_meta.get("must_terms", []),
             query_meta.get("should_terms", []))
+        return semantic_query, keyword_query
 
-        embedded_query, dim = self._embed_query(semantic_query)
-
-        index, type = self._load_index(dim)
-        retrieval_top_k = top_k * 2         # Retrieve twice from the index search
-        semantic_similarity = self._semantic_search(index, embedded_query, retrieval_top_k) if index is not None else []
-        keyword_similairty = self._keyword_search(keyword_query, retrieval_top_k)
-
+    def _merge_results(self, query, semantic_query, keyword_query, type,
+                       semantic_similarity, keyword_similairty, rerank, top_k, rrf_k, route=None):
         if not semantic_similarity and not keyword_similairty:
             return {
                 "index_type": type,
+                "routed_documents": len(route.document_ids) if route else None,
                 "query": {"original": query, "semantic": semantic_query, "keyword": keyword_query},
                 "results": []
             }
@@ -186,7 +314,8 @@ class Retriever:
         merged_similarity = self._rrf(semantic_similarity, keyword_similairty, rrf_k)
         top_ids = [cid for cid, _ in sorted(merged_similarity.items(), key=lambda x: x[1], reverse=True)][:top_k]
 
-        matches = self._get_full_chunk_info(top_ids)
+        with span("hydrate"):
+            matches = self._get_full_chunk_info(top_ids)
         semantic_map = {cid: s for cid, s in semantic_similarity}
         keywords_map = {cid: s for cid, s in keyword_similairty}
         merged_map = {cid: s for cid, s in merged_similarity.items()}
@@ -202,20 +331,71 @@ class Retriever:
         if rerank and matches:
             reranker = build_reranker()
             passages = [m["text"] for m in matches]
-            rr = reranker.score(query, passages)
+            with span("rerank"):
+                rr = reranker.score(query, passages)
 
             for r in rr:
                 matches[r.index]["scores"]["rerank"] = r.score
 
             matches.sort(key=self._final_score, reverse=True)
 
-        matches[:top_k]
         return {
             "index_type": type,
+            "routed_documents": len(route.document_ids) if route else None,
             "query": {"original": query, "semantic": semantic_query, "keyword": keyword_query},
-            "results": matches
+            "results": matches[:top_k]
         }
     
+    def search(self, query, query_meta, rerank = False, top_k = 8, rrf_k = 60, query_vecs=None):
+        """Semantic queries found in `query_vecs` ({text: embedding}) are not embedded again."""
+        semantic_query, keyword_query = self._prepare_queries(query, query_meta)
+
+        with span("embed_query"):
+            embedded_query, dim = self._embed_query(semantic_query, query_vecs)
+
+        # Large corpora are first narrowed down to the most relevant documents
+        with span("route"):
+            route = self.router.route(embedded_query, [keyword_query])[0]
+        retrieval_top_k = top_k * 2         # Retrieve twice from the index search
+        type, (semantic_similarity,) = self._vector_search(embedded_query[:1], dim, [route], retrieval_top_k)
+        with span("fts_search"):
+            keyword_similairty = self._keyword_search(keyword_query, retrieval_top_k,
+                                                      route.document_ids if route else None)
+
+        return self._merge_results(query, semantic_query, keyword_query, type,
+                                   semantic_similarity, keyword_similairty, rerank, top_k, rrf_k, route)
+
+    def search_many(self, queries, query_metas, rerank = False, top_k = 8, rrf_k = 60, query_vecs=None):
+        """
+        Batched version of `search`: one embedding call and one index search for all the queries,
+        keyword searches run concurrently. Results are returned in the same order as `queries`.
+        Semantic queries found in `query_vecs` ({text: embedding}) are not embedded again.
+        """
+        if not queries:
+            return []
+
+        prepared = [self._prepare_queries(q, m) for q, m in zip(queries, query_metas)]
+        with span("embed_query"):
+            embedded_queries, dim = self._embed_queries([semantic for semantic, _ in prepared], query_vecs)
+
+        with span("route"):
+            routes = self.router.route(embedded_queries, [keyword for _, keyword in prepared])
+        retrieval_top_k = top_k * 2
+        type, semantic_similarities = self._vector_search(embedded_queries, dim, routes, retrieval_top_k)
+
+        with ThreadPoolExecutor(max_workers=BATCH_SEARCH_WORKERS) as pool:
+            with span("fts_search"):
+                keyword_similarities = list(pool.map(
+                    lambda i: self._keyword_search(prepared[i][1], retrieval_top_k,
+                                                   routes[i].document_ids if routes[i] else None),
+                    range(len(queries))))
+
+            return list(pool.map(
+                lambda i: self._merge_results(
+                    queries[i], prepared[i][0], prepared[i][1], type,
+                    semantic_similarities[i], keyword_similarities[i], rerank, top_k, rrf_k, routes[i]),
+                range(len(queries))))
+    
 
 def get_retriever():
-    return Retriever()
\ No newline at end of file
+    return shared("retriever", Retriever)
\ No newline at end of file
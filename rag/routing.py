@@ -0,0 +1,193 @@
+"""
+Two-tier retrieval: route a query to its most relevant documents first, then search only their chunks.
+
+The document tier is small next to the chunk indexes: one centroid vector per document (the
+normalized mean of its chunk embeddings) in a flat FAISS index inside the index set, and the most
+frequent terms of every document in the `doc_fts` table. Both are scored per query and fused with
+RRF. The chunk-level FAISS and FTS searches are then restricted to the chunks of the top
+ROUTING_TOP_DOCUMENTS documents. Small corpora (below ROUTING_MIN_DOCUMENTS documents) are
+searched whole, as before, and so is a corpus whose document tier does not cover every indexed
+document yet (documents indexed before routing existed, until the worker backfilled them).
+"""
+from collections import Counter
+from dataclasses import dataclass
+from typing import List, Optional
+
+import os, re, sqlite3, threading, time
+import numpy as np
+
+from rag.active_index import INDEX_FILES, index_file, stage_file
+from rag.db import (get_document_rowid, get_document_ids_by_rowid, get_document_chunk_ids,
+                    get_chunk_document_rowids, set_document_terms, match_document_terms,
+                    count_routable_documents, get_documents_without_terms, get_document_chunks)
+from rag.registry import shared, lazy_module
+
+faiss = lazy_module("faiss")
+
+ROUTING_ENABLED = os.getenv("ROUTING_ENABLED", "True") == "True"
+# Routing only starts paying off once the corpus has this many documents
+ROUTING_MIN_DOCUMENTS = int(os.getenv("ROUTING_MIN_DOCUMENTS", "200"))
+# Documents whose chunks are searched for a routed query
+ROUTING_TOP_DOCUMENTS = int(os.getenv("ROUTING_TOP_DOCUMENTS", "20"))
+# Most frequent terms of a document kept for document-level keyword matching
+ROUTING_DOC_TERMS = int(os.getenv("ROUTING_DOC_TERMS", "300"))
+
+DOC_INDEX_NAME = INDEX_FILES["docs"]
+_TERM_RE = re.compile(r"[^\W\d_]{3,}")
+# Seconds the router trusts its count of indexed documents
+_COVERAGE_TTL = 10.0
+
+
+def doc_index_path(index_dir=None):
+    return index_file("docs", index_dir)
+
+
+def document_terms(texts, n=ROUTING_DOC_TERMS):
+    counts = Counter(t for text in texts for t in _TERM_RE.findall(text.lower()))
+    return " ".join(t for t, _ in counts.most_common(n))
+
+
+def _centroid(vecs):
+    c = np.asarray(vecs, dtype="float32").mean(axis=0, keepdims=True)
+    return c / max(float(np.linalg.norm(c)), 1e-12)
+
+
+def _load_doc_index(dim, index_dir=None):
+    path = doc_index_path(index_dir)
+    if path.exists():
+        index = faiss.read_index(str(path))
+        if index.d == dim:
+            return index
+    return faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+
+
+def update_document_route(document_id, vecs, texts=None, index_dir=None):
+    """Adds (or replaces) the document's centroid and, given its chunk texts, its terms."""
+    rowid = get_document_rowid(document_id)
+    if rowid is None or len(vecs) == 0:
+        return
+    ids = np.array([rowid], dtype="int64")
+    index = _load_doc_index(vecs.shape[1], index_dir)
+    index.remove_ids(faiss.IDSelectorBatch(ids))
+    index.add_with_ids(_centroid(vecs), ids)
+    stage_file("docs", lambda path: faiss.write_index(index, str(path)), index_dir)
+    if texts is not None:
+        set_document_terms(rowid, document_terms(texts))
+
+
+def rebuild_document_routes(index_dir, flat_index):
+    """
+    Recomputes every centroid from the chunk vectors of `flat_index`, e.g. for an index set built by
+    a re-embedding migration. Document terms do not depend on the model and are kept.
+    """
+    from rag.indexer import _get_all_ids_and_vectors_from_flat_index
+
+    data = _get_all_ids_and_vectors_from_flat_index(flat_index)
+    if data is None:
+        return
+    chunk_ids, vecs = data
+    doc_of = dict(get_chunk_document_rowids())
+    docs = np.array([doc_of.get(int(c), -1) for c in chunk_ids], dtype="int64")
+    keep = docs >= 0
+    docs, vecs = docs[keep], vecs[keep]
+
+    index = faiss.IndexIDMap2(faiss.IndexFlatIP(flat_index.d))
+    if len(docs):
+        # sum the vectors of every document in one pass, then normalize the sums
+        unique, inverse = np.unique(docs, return_inverse=True)
+        sums = np.zeros((len(unique), vecs.shape[1]), dtype="float32")
+        np.add.at(sums, inverse, vecs)
+        sums /= np.clip(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12, None)
+        index.add_with_ids(sums, unique)
+    stage_file("docs", lambda path: faiss.write_index(index, str(path)), index_dir)
+
+
+def backfill_document_routes(index_dir=None, max_documents=100):
+    """
+    Completes the document tier for documents indexed before it existed: recomputes all centroids
+    when the document index has fewer than the routable documents, and adds the terms of up to
+    `max_documents` documents without any. Returns (centroids rebuilt, documents given terms);
+    rebuilt centroids are staged and still have to be published.
+    """
+    from rag.indexer import index_paths
+
+    rebuilt, termed = False, 0
+    docs_path = doc_index_path(index_dir)
+    ntotal = faiss.read_index(str(docs_path)).ntotal if docs_path.exists() else 0
+    flat_path, _ = index_paths(index_dir)
+    if ntotal < count_routable_documents() and flat_path.exists():
+        rebuild_document_routes(flat_path.parent, faiss.read_index(str(flat_path)))
+        rebuilt = True
+    for rowid, document_id in get_documents_without_terms(max_documents):
+        set_document_terms(rowid, document_terms([text for _, text in get_document_chunks(document_id)]))
+        termed += 1
+    return rebuilt, termed
+
+
+@dataclass
+class Route:
+    document_ids: List[str]
+    chunk_ids: np.ndarray
+
+
+class DocumentRouter:
+    def __init__(self, min_documents=ROUTING_MIN_DOCUMENTS, top_documents=ROUTING_TOP_DOCUMENTS, rrf_k=60):
+        self.min_documents = min_documents
+        self.top_documents = top_documents
+        self.rrf_k = rrf_k
+        self._cached = (None, None)   # (path, index); published files never change
+        self._coverage = (0.0, 0)     # (time, routable documents)
+        self._lock = threading.Lock()
+
+    def _index(self):
+        path = doc_index_path()
+        with self._lock:
+            if self._cached[0] != path:
+                if not path.exists():
+                    return None
+                self._cached = (path, faiss.read_index(str(path)))
+            return self._cached[1]
+
+    def _routable_documents(self):
+        checked, n = self._coverage
+        if time.monotonic() - checked > _COVERAGE_TTL:
+            n = count_routable_documents()
+            self._coverage = (time.monotonic(), n)
+        return n
+
+    def _keyword_ranks(self, fts_query):
+        try:
+            rows = match_document_terms(fts_query, self.top_documents * 2)
+        except sqlite3.OperationalError:
+            # document terms have no positions, some phrase queries cannot be evaluated on them
+            return []
+        return [rowid for rowid, _ in rows]
+
+    def route(self, query_vecs, fts_queries) -> List[Optional[Route]]:
+        """
+        One route per query; None means the query searches the whole corpus (routing off, too few
+        documents, or a document index of another model during a migration cutover).
+        """
+        index = self._index() if ROUTING_ENABLED else None
+        if index is None or index.ntotal < self.min_documents or index.d != query_vecs.shape[1]:
+            return [None] * len(fts_queries)
+        if index.ntotal < self._routable_documents():
+            # documents missing from the tier would never be searched
+            return [None] * len(fts_queries)
+
+        _, labels = index.search(np.ascontiguousarray(query_vecs, dtype="float32"), self.top_documents * 2)
+        routes = []
+        for semantic, fts_query in zip(labels, fts_queries):
+            scores = {}
+            for ranked in ([int(r) for r in semantic if r != -1], self._keyword_ranks(fts_query)):
+                for rank, rowid in enumerate(ranked, start=1):
+                    scores[rowid] = scores.get(rowid, 0.0) + 1.0 / (self.rrf_k + rank)
+            top = sorted(scores, key=scores.get, reverse=True)[:self.top_documents]
+            document_ids = get_document_ids_by_rowid(top)
+            chunk_ids = np.array(get_document_chunk_ids(document_ids), dtype="int64")
+            routes.append(Route(document_ids, chunk_ids) if len(chunk_ids) else None)
+        return routes
+
+
+def get_router():
+    return shared("document_router", DocumentRouter)
@@ -0,0 +1,261 @@
+"""
+Global scheduler for upstream (LLM / embedding) calls.
+
+Every `chat_query` and `embed` call goes through `get_scheduler().call(...)`, which
+  1. takes request and token budget from token buckets stored in a small SQLite file, so that the
+     API process(es) and the worker share one provider quota,
+  2. lets interactive calls dig into the whole bucket while background calls (the worker) have to
+     leave `INTERACTIVE_RESERVE` of it untouched,
+  3. limits in-flight calls per process with an adaptive (AIMD) concurrency limit that is halved on
+     429s / latency spikes and slowly grows back on success; interactive waiters go first,
+  4. retries 429s with exponential backoff.
+"""
+from contextlib import contextmanager
+from enum import IntEnum
+from pathlib import Path
+from dotenv import load_dotenv, find_dotenv
+from rag.metrics import REGISTRY
+from rag.registry import shared
+
+import asyncio, contextvars, os, random, sqlite3, threading, time
+
+load_dotenv(find_dotenv(), override=True)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "True") == "True"
+RATE_LIMIT_DB_PATH = os.getenv("RATE_LIMIT_DB_PATH", "data/ratelimit.sqlite3")
+# Provider quota shared by all processes
+UPSTREAM_REQUESTS_PER_SECOND = float(os.getenv("UPSTREAM_REQUESTS_PER_SECOND", "5"))
+UPSTREAM_TOKENS_PER_MINUTE = float(os.getenv("UPSTREAM_TOKENS_PER_MINUTE", "500000"))
+# Fraction of each bucket only interactive calls may use
+INTERACTIVE_RESERVE = float(os.getenv("INTERACTIVE_RESERVE", "0.3"))
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "8"))
+MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "4"))
+# A call slower than this multiple of the moving average counts as a latency spike
+LATENCY_SPIKE_FACTOR = 3.0
+
+THROTTLED = REGISTRY.counter("rag_upstream_throttled_total", "Upstream calls that hit a 429")
+WAIT_SECONDS = REGISTRY.histogram("rag_upstream_wait_seconds", "Time spent waiting for the rate limiter")
+CONCURRENCY = REGISTRY.gauge("rag_upstream_concurrency_limit", "Current adaptive concurrency limit")
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+_PRIORITY = contextvars.ContextVar("upstream_priority", default=Priority.INTERACTIVE)
+
+@contextmanager
+def priority(p):
+    """All upstream calls made inside this block use priority `p`."""
+    token = _PRIORITY.set(p)
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(token)
+
+
+def estimate_tokens(texts):
+    # ~4 characters per token is close enough for budgeting
+    return max(1, sum(len(t or "") for t in texts) // 4)
+
+def is_rate_limited(e):
+    status = getattr(e, "status_code", None) or getattr(getattr(e, "response", None), "status_code", None)
+    return status == 429
+
+
+class SQLiteTokenBuckets:
+    """Token buckets persisted in SQLite; `BEGIN IMMEDIATE` makes take() atomic across processes."""
+    SCHEMA = "CREATE TABLE IF NOT EXISTS buckets(name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+
+    def __init__(self, path=RATE_LIMIT_DB_PATH):
+        self.path = str(path)
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as con:
+            con.execute(self.SCHEMA)
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, isolation_level=None, timeout=5)
+        con.execute("PRAGMA journal_mode=WAL;")
+        return con
+
+    def take(self, name, amount, capacity, rate, reserve=0.0):
+        """Takes `amount` if at least `reserve` stays in the bucket. Returns 0 or the seconds to wait."""
+        return self.take_all([(name, amount, capacity, rate, reserve)])
+
+    def take_all(self, requests):
+        """
+        Takes from several buckets at once, given as (name, amount, capacity, rate, reserve): from
+        all of them if every one has enough, otherwise from none. Returns 0 or the seconds to wait.
+        """
+        con = self._connect()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            levels, wait = [], 0.0
+            for name, amount, capacity, rate, reserve in requests:
+                amount = min(amount, capacity - reserve)
+                row = con.execute("SELECT tokens, updated FROM buckets WHERE name=?", (name,)).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+                levels.append((name, tokens, amount))
+                if tokens - amount < reserve:
+                    wait = max(wait, (amount + reserve - tokens) / rate)
+            for name, tokens, amount in levels:
+                con.execute("INSERT OR REPLACE INTO buckets(name, tokens, updated) VALUES(?,?,?)",
+                            (name, tokens if wait > 0 else tokens - amount, now))
+            con.execute("COMMIT")
+            return wait
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        finally:
+            con.close()
+
+    def penalize(self, name, seconds, rate):
+        """Empties the bucket for `seconds` (e.g. after a 429) so every process backs off."""
+        con = self._connect()
+        try:
+            con.execute("INSERT OR REPLACE INTO buckets(name, tokens, updated) VALUES(?,?,?)",
+                        (name, -seconds * rate, time.time()))
+        finally:
+            con.close()
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on in-flight calls in this process, with interactive waiters served first."""
+    def __init__(self, max_limit=UPSTREAM_MAX_CONCURRENCY):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.waiting = {p: 0 for p in Priority}
+        self.avg_latency = None
+        self.cond = threading.Condition()
+        CONCURRENCY.set(self.limit)
+
+    def _can_enter(self, p):
+        if self.in_flight >= int(self.limit):
+            return False
+        return p == Priority.INTERACTIVE or self.waiting[Priority.INTERACTIVE] == 0
+
+    def try_acquire(self, p):
+        with self.cond:
+            if self._can_enter(p):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self, p):
+        with self.cond:
+            self.waiting[p] += 1
+            try:
+                while not self._can_enter(p):
+                    self.cond.wait(timeout=1.0)
+                self.in_flight += 1
+            finally:
+                self.waiting[p] -= 1
+
+    def release(self, latency=None, throttled=False):
+        with self.cond:
+            self.in_flight -= 1
+            spike = (latency is not None and self.avg_latency is not None
+                     and latency > LATENCY_SPIKE_FACTOR * self.avg_latency)
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+            elif spike:
+                self.limit = max(1.0, self.limit - 1)
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            if latency is not None and not throttled:
+                self.avg_latency = latency if self.avg_latency is None else 0.9 * self.avg_latency + 0.1 * latency
+            CONCURRENCY.set(self.limit)
+            self.cond.notify_all()
+
+
+class Scheduler:
+    def __init__(self, provider="mistral", buckets=None, requests_per_second=UPSTREAM_REQUESTS_PER_SECOND,
+                 tokens_per_minute=UPSTREAM_TOKENS_PER_MINUTE, max_concurrency=UPSTREAM_MAX_CONCURRENCY,
+                 max_retries=MAX_RETRIES, sleep=time.sleep):
+        self.provider = provider
+        self.buckets = buckets or SQLiteTokenBuckets()
+        self.rps = requests_per_second
+        self.tpm = tokens_per_minute
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.max_retries = max_retries
+        self.sleep = sleep
+
+    def _reserve(self, capacity, p):
+        return capacity * INTERACTIVE_RESERVE if p == Priority.BACKGROUND else 0.0
+
+    def _wait_time(self, tokens, p):
+        # one second of requests and one minute of tokens as burst capacity; nothing is taken from
+        # either bucket unless both have enough
+        return self.buckets.take_all([
+            (f"{self.provider}:requests", 1, self.rps, self.rps, self._reserve(self.rps, p)),
+            (f"{self.provider}:tokens", tokens, self.tpm, self.tpm / 60.0, self._reserve(self.tpm, p)),
+        ])
+
+    def _throttled(self, attempt):
+        THROTTLED.inc(provider=self.provider)
+        backoff = min(30.0, (2 ** attempt) * 0.5) * (1 + random.random() * 0.25)
+        self.buckets.penalize(f"{self.provider}:requests", backoff, self.rps)
+        return backoff
+
+    def call(self, fn, *args, tokens=1, **kwargs):
+        p = _PRIORITY.get()
+        for attempt in range(self.max_retries + 1):
+            t0 = time.perf_counter()
+            while (wait := self._wait_time(tokens, p)) > 0:
+                self.sleep(min(wait, 1.0))
+            self.concurrency.acquire(p)
+            WAIT_SECONDS.observe(time.perf_counter() - t0, priority=p.name.lower())
+
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                throttled = is_rate_limited(e)
+                self.concurrency.release(throttled=throttled)
+                if not throttled or attempt == self.max_retries:
+                    raise
+                self.sleep(self._throttled(attempt))
+                continue
+            self.concurrency.release(latency=time.perf_counter() - start)
+            return result
+
+    async def acall(self, fn, *args, tokens=1, **kwargs):
+        """
+        Same as `call` for coroutine functions; waits with asyncio.sleep instead of blocking. The
+        buckets live in SQLite (busy timeout included), so they are updated on a worker thread.
+        """
+        p = _PRIORITY.get()
+        for attempt in range(self.max_retries + 1):
+            t0 = time.perf_counter()
+            while (wait := await asyncio.to_thread(self._wait_time, tokens, p)) > 0:
+                await asyncio.sleep(min(wait, 1.0))
+            while not self.concurrency.try_acquire(p):
+                await asyncio.sleep(0.01)
+            WAIT_SECONDS.observe(time.perf_counter() - t0, priority=p.name.lower())
+
+            start = time.perf_counter()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                throttled = is_rate_limited(e)
+                self.concurrency.release(throttled=throttled)
+                if not throttled or attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(await asyncio.to_thread(self._throttled, attempt))
+                continue
+            self.concurrency.release(latency=time.perf_counter() - start)
+            return result
+
+
+class _Unlimited:
+    def call(self, fn, *args, tokens=1, **kwargs):
+        return fn(*args, **kwargs)
+
+    async def acall(self, fn, *args, tokens=1, **kwargs):
+        return await fn(*args, **kwargs)
+
+
+def get_scheduler():
+    return shared("scheduler", Scheduler if RATE_LIMIT_ENABLED else _Unlimited)
@@ -0,0 +1,83 @@
+"""
+Server-side conversation sessions.
+
+A session stores a rolling summary of the conversation and its last turn verbatim. Every answer
+makes its turn the session's last one right away; the turn it replaces is folded into the summary
+by one LLM call in the background, after the response was sent. The refiner gets the summary plus
+the turns not folded yet (normally just the last one), so requests and refiner prompts stay the
+same size however long the conversation gets, and old context is compressed instead of cut off.
+"""
+from rag.db import create_session, get_session, push_session_turn, fold_session_summary
+from rag.llm_client import get_llm_client
+from rag.query_refiner import PER_MSG_CAP
+from rag.registry import shared
+from rag.scheduler import priority, Priority
+
+import json, os, uuid
+
+# Upper bound of the rolling summary
+SESSION_SUMMARY_CHARS = int(os.getenv("SESSION_SUMMARY_CHARS", "1500"))
+# Sessions not used for this many days are deleted
+SESSION_TTL_DAYS = int(os.getenv("SESSION_TTL_DAYS", "30"))
+
+SYSTEM = f"""You maintain the running summary of a conversation between a user and a document Q&A assistant.
+Update the summary with the new turns. Keep the topics, documents, entities, numbers and open questions
+that later questions may refer to; drop greetings and details that no longer matter. Write plain text,
+at most {SESSION_SUMMARY_CHARS} characters. Return the updated summary only."""
+
+
+def new_session():
+    session_id = uuid.uuid4().hex
+    create_session(session_id, SESSION_TTL_DAYS)
+    return session_id
+
+
+def session_context(session):
+    """(summary, refiner history) of a session: the turns not in the summary yet, oldest first."""
+    turns = list(session["pending"])
+    if session["last_user"] is not None:
+        turns.append({"user": session["last_user"], "assistant": session["last_assistant"] or ""})
+    history = []
+    for t in turns:
+        history.append({"role": "user", "content": t["user"]})
+        history.append({"role": "assistant", "content": t["assistant"]})
+    return session["summary"], history
+
+
+class SessionSummarizer:
+    @property
+    def _client(self):
+        return get_llm_client()
+
+    def summarize(self, summary, turns):
+        turns = [{"user": t["user"][:PER_MSG_CAP], "assistant": t["assistant"][:PER_MSG_CAP]} for t in turns]
+        msgs = [
+            {"role": "system", "content": SYSTEM},
+            {"role": "user", "content": json.dumps({"summary": summary, "new_turns": turns}, ensure_ascii=False)}
+        ]
+        try:
+            txt = self._client.chat_query(msgs, temperature=0.0)
+        except Exception as e:
+            print("Session summary failed:", e)
+            txt = ""
+        if not txt:
+            # keep the newest part of the plain concatenation rather than losing the turns
+            txt = "\n".join([summary] + [f"User: {t['user']}\nAssistant: {t['assistant']}" for t in turns])
+        return txt.strip()[-SESSION_SUMMARY_CHARS:]
+
+    def record_turn(self, session_id, user, assistant):
+        """Makes this turn the session's last one; the caller runs `fold` afterwards, e.g. in the background."""
+        return push_session_turn(session_id, user, assistant or "")
+
+    def fold(self, session_id):
+        """Summarizes the session's pending turns into its summary."""
+        with priority(Priority.BACKGROUND):
+            session = get_session(session_id)
+            if session is None or not session["pending"]:
+                return False
+            summary = self.summarize(session["summary"], session["pending"])
+            return fold_session_summary(session_id, session["summary"], len(session["pending"]), summary)
+
+
+def get_session_summarizer():
+    return shared("session_summarizer", SessionSummarizer)
@@ -0,0 +1,40 @@
+from rag.chunker import PAGE_BREAK, count_tokens, make_chunks
+
+PAGE = (
+    "The annual report covers revenue, costs and the outlook for the next year. " * 3
+    + "This sentence runs on and on without any full stop, listing clauses, figures like 12.5% and 3,400 units, "
+      "names, dates, places and remarks, so that it alone is far longer than any reasonable token budget would be, "
+      "which is exactly the case the chunker has to split further " * 4
+    + ". Short closing sentence."
+)
+
+
+def test_chunks_respect_token_budget():
+    for max_tokens in (10, 50, 100):
+        chunks = make_chunks([PAGE], max_tokens=max_tokens)
+        assert chunks
+        for c in chunks:
+            assert count_tokens(c["text"]) <= max_tokens
+            assert PAGE[c["start"]:c["end"]] == c["text"]
+
+
+def test_chunks_cover_the_page():
+    chunks = make_chunks([PAGE], max_tokens=50, overlap=0)
+    covered = "".join(c["text"] for c in chunks)
+    assert "".join(covered.split()) == "".join(PAGE.split())
+
+
+def test_chunks_continue_onto_the_next_page():
+    pages = ["Intro sentence on page one. The table continues", "on the next page with more rows. End."]
+    chunks = make_chunks(pages, size=400, overlap=0)
+    assert len(chunks) == 1
+    c = chunks[0]
+    assert (c["page_num"], c["page_span"], c["start"], c["end"]) == (1, 2, 0, len(pages[1]))
+    assert c["text"] == pages[0] + PAGE_BREAK + pages[1]
+
+    for c in make_chunks(pages, size=40, overlap=0):
+        first, last = c["page_num"] - 1, c["page_num"] + c["page_span"] - 2
+        if first == last:
+            assert pages[first][c["start"]:c["end"]] == c["text"]
+        else:
+            assert c["text"] == PAGE_BREAK.join([pages[first][c["start"]:], *pages[first + 1:last], pages[last][:c["end"]]])
@@ -0,0 +1,59 @@
+import socket, threading
+
+import numpy as np
+import pytest
+
+from rag import retriever
+from rag.index_server import IndexClient, IndexServerError, _FRAME, STATUS_ERROR
+
+
+def _error_server(path, requests):
+    # answers every request with an error status, counting them
+    srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    srv.bind(str(path))
+    srv.listen()
+
+    def serve():
+        conn, _ = srv.accept()
+        with conn:
+            while True:
+                head = conn.recv(_FRAME.size, socket.MSG_WAITALL)
+                if not head:
+                    return
+                _, length = _FRAME.unpack(head)
+                conn.recv(length, socket.MSG_WAITALL)
+                requests.append(1)
+                msg = b"RuntimeError: cannot load index"
+                conn.sendall(_FRAME.pack(STATUS_ERROR, len(msg)) + msg)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return srv
+
+
+def test_error_response_backs_off_like_an_unreachable_server(tmp_path):
+    requests = []
+    srv = _error_server(tmp_path / "idx.sock", requests)
+    client = IndexClient(f"unix:{tmp_path / 'idx.sock'}", timeout=2, retry_s=60)
+    query = np.zeros((1, 4), dtype="float32")
+    try:
+        with pytest.raises(IndexServerError):
+            client.search(query, 3, [None])
+        # within the backoff the server is not asked again
+        with pytest.raises(ConnectionError):
+            client.search(query, 3, [None])
+        assert len(requests) == 1
+    finally:
+        srv.close()
+
+
+def test_vector_search_falls_back_on_server_errors(monkeypatch):
+    class FailingClient:
+        def search(self, *args):
+            raise IndexServerError("Index server error: boom")
+
+    monkeypatch.setattr(retriever, "get_index_client", lambda: FailingClient())
+    monkeypatch.setattr(retriever, "INDEX_SERVER_FALLBACK", True)
+    r = retriever.Retriever()
+    monkeypatch.setattr(r, "_load_generation", lambda dim: ("index", "flat", {}))
+    monkeypatch.setattr(r, "_search_loaded", lambda index, queries, top_k, routes: [[(1, 0.9)]])
+    assert r._vector_search(np.zeros((1, 4), dtype="float32"), 4, [None], 3) == ("flat", [[(1, 0.9)]])
@@ -0,0 +1,41 @@
+import pytest
+
+from rag.intent_classifier import FastIntentClassifier
+
+
+@pytest.fixture
+def classifier(monkeypatch):
+    c = FastIntentClassifier(margin=0.08)
+    margins = {}
+    monkeypatch.setattr(c, "_margin", lambda query, query_vec: margins.get(query, 0.0))
+    monkeypatch.setattr(c, "_in_corpus", lambda terms: "contract" in terms)
+    return c, margins
+
+
+def test_small_talk_and_no_words_are_decided_locally(classifier):
+    c, _ = classifier
+    assert c.classify("thanks a lot!")["intent"] == "smalltalk"
+    assert c.classify("???")["intent"] == "nonsense"
+
+
+@pytest.mark.parametrize("query", [
+    "how are you doing today?",
+    "Can you tell me a joke about cats?",
+    "What is the weather in Paris tomorrow?",
+    "who is the president of France?",
+])
+def test_question_form_alone_goes_to_the_llm(classifier, query):
+    c, margins = classifier
+    assert c.classify(query) is None
+    # a search-like embedding is not enough when no term occurs in the documents
+    margins[query] = 0.5
+    assert c.classify(query) is None
+
+
+def test_clear_margin_with_known_terms_searches(classifier):
+    c, margins = classifier
+    query = "What does the contract say about termination?"
+    assert c.classify(query) is None
+    margins[query] = 0.2
+    response = c.classify(query)
+    assert response["trigger"] and response["keyword_query"] == "contract OR termination"
@@ -1,5 +1,5 @@
 import streamlit as st
-import io,requests, os
+import io,requests, os, time
 from dotenv import load_dotenv, find_dotenv
 
 load_dotenv(find_dotenv(), override=True)
@@ -8,18 +8,18 @@ _DEBUG = os.getenv("DEBUG", "False")
 _API_BASE = "http://localhost:8000"
 _TOP_K = 8
 _RRF_K = 60
+# How long the upload panel follows the indexing progress of new documents
+_INDEX_WAIT_SECONDS = 300
+_STAGE_LABELS = {
+    "UPLOADED": "Queued",
+    "EXTRACTED": "Text extracted",
+    "CHUNKED": "Chunked",
+    "EMBEDDED": "Embedded",
+    "INDEXED": "Indexed",
+}
 
 # Utilities
 
-def _pack_history(max_history = 8):
-    if "chat_history" not in st.session_state:
-        return []
-    return [
-        {"role": m["role"], "content": (m["content"] or "")}
-        for m in st.session_state.chat_history[-max_history:]
-        if m["role"] in ("user","assistant")
-    ]
-
 def _post_ingest_PDFs(api_base, files):
     url = f"{api_base.rstrip('/')}/ingest/pdf_documents"
     mp = []
@@ -29,15 +29,60 @@ def _post_ingest_PDFs(api_base, files):
     response.raise_for_status()
     return response.json()
 
+def _get_document_events(api_base, document_id, after, wait=20):
+    url = f"{api_base.rstrip('/')}/documents/{document_id}/events"
+    response = requests.get(url, params={"after": after, "wait": wait}, timeout=wait + 10)
+    response.raise_for_status()
+    return response.json()
+
+def _follow_indexing(api_base, results):
+    """
+    Shows the progress of freshly uploaded documents until they are searchable, using the
+    long-polling events endpoint instead of guessing.
+    """
+    docs = [r for r in results if r.get("status") == "ok" and r.get("document_id")]
+    if not docs:
+        return
+    deadline = time.monotonic() + _INDEX_WAIT_SECONDS
+    for r in docs:
+        label = st.empty()
+        bar = st.progress(0.0)
+        after, status = 0, "UPLOADED"
+        while status not in ("INDEXED", "FAILED") and time.monotonic() < deadline:
+            res = _get_document_events(api_base, r["document_id"], after)
+            after, status = res["last_event_id"], res["status"]
+            for e in res["events"]:
+                if e["kind"] == "stage":
+                    label.write(f"**{r.get('filename')}**: {_STAGE_LABELS.get(e['name'], e['name'])}")
+                elif e["kind"] == "progress" and e.get("total"):
+                    bar.progress(min(e["done"] / e["total"], 1.0), text=e["name"].replace("_", " "))
+                elif e["kind"] == "retry":
+                    label.write(f"**{r.get('filename')}**: retrying ({e.get('message')})")
+        if status == "INDEXED":
+            bar.progress(1.0)
+            label.write(f"**{r.get('filename')}** is searchable.")
+        elif status == "FAILED":
+            label.write(f"**{r.get('filename')}** failed to index.")
+        else:
+            label.write(f"**{r.get('filename')}** is still being indexed.")
+
 def _post_query(api_base, query, top_k, rrf_k):
     url = f"{api_base.rstrip('/')}/query"
+    # The conversation is kept server-side; the first query starts it and later ones continue it
     payload = {
         "query": query, 
         "top_k": top_k, 
         "rrf_k": rrf_k,
-        "history": _pack_history()
     }
+    if st.session_state.get("session_id"):
+        payload["session_id"] = st.session_state.session_id
+    else:
+        payload["session"] = True
     response = requests.post(url, json=payload, timeout=60)
+    if response.status_code == 404 and "session_id" in payload:
+        # the session expired, start a new one
+        st.session_state.session_id = None
+        return _post_query(api_base, query, top_k, rrf_k)
 
     if not response.ok:
         try:
@@ -46,7 +91,9 @@ def _post_query(api_base, query, top_k, rrf_k):
             detail = response.text
         raise RuntimeError(f"/query failed: {detail}")
 
-    return response.json()
+    res = response.json()
+    st.session_state.session_id = res.get("session_id")
+    return res
 
 
 def _render_sources(sources, top_k = 3):
@@ -57,6 +104,11 @@ def _render_sources(sources, top_k = 3):
     for s in sources:
         with st.expander(f"[S{s.get('rank')}] {s.get('document_name')} {s.get('page_num')}"):
             st.write(s.get("text", ""))
+            also_in = s.get("also_in") or []
+            if also_in:
+                more = (s.get("also_in_count") or 0) - len(also_in)
+                st.caption("also in – " + ", ".join(f"{l.get('document_name')} {l.get('page_num')}" for l in also_in)
+                           + (f" and {more} more" if more > 0 else ""))
             score = s.get("scores", {})
             if score:
                 st.caption(
@@ -93,7 +145,7 @@ with st.container(border=True):
     with col1:
         ingest_button = st.button("Ingest", disabled=not files)
     with col2:
-        st.caption("After ingestion, a background worker will parse/chunk/emb/index. You can start chatting right away but it might take a few seconds for the process to finish.")
+        st.caption("After ingestion, a background worker will parse/chunk/emb/index. You can start chatting right away; the progress below shows when each document becomes searchable.")
 
     if ingest_button and files:
         try:
@@ -105,6 +157,7 @@ with st.container(border=True):
                 status = r.get("status", "unknown")
                 message = r.get("message", "")
                 st.write(f"- **{r.get('filename')}** → `{status}` ({r.get('pages',0)} pages, {r.get('bytes',0)} bytes) {message}")
+            _follow_indexing(API_BASE, results)
         except Exception as e:
             st.error(f"Ingest failed: {e}")
 
@@ -1,68 +1,321 @@
-import os, time, traceback
+import os, re, time, traceback, json, shutil
 import numpy as np
 
+from itertools import islice
+from pathlib import Path
+
 from dotenv import load_dotenv, find_dotenv
 
-from rag.chunker import extract_text_pages, make_chunks
+from rag.chunker import extract_text_pages, iter_chunks
+from rag.active_index import publish
 from rag.indexer import add_to_flat_index, add_to_ivfpq_index
-from rag.embedders import get_embedder
+from rag.embedders import get_embedder, get_embed_model_name
+from rag.migrations import step_migration
+from rag.routing import update_document_route, backfill_document_routes
 from rag.db import (init_schema, get_job, 
                     mark_job_done, mark_job_failed, update_document_status, 
-                    get_document, insert_chunks, DocumentStatus)
-from rag.llm_client import get_llm_client
+                    get_document, insert_chunks, count_jobs_by_status, DocumentStatus,
+                    DocumentStage, stage_reached, set_document_stage, delete_chunks,
+                    get_document_chunks, requeue_running_jobs, get_fts_pending,
+                    optimize_fts_step, add_document_event, prune_document_events)
+from rag.scheduler import priority, Priority
+from rag.profiling import profile, should_profile
+from rag.metrics import (span, start_metrics_server, timings_ms, collect_timings,
+                         JOBS, CHUNKS_INDEXED, CHUNKS_DEDUPLICATED, CHUNKS_PER_SECOND, INDEX_SIZE)
 
 load_dotenv(find_dotenv(), override=True)
 
-EMBEDDER = get_embedder()
-LLM_CLIENT = get_llm_client()
+# Chunks are stored and embedded in batches of this size as the chunker yields them
+CHUNK_BATCH_SIZE = int(os.getenv("CHUNK_BATCH_SIZE", "512"))
+# Port of the worker's own /metrics endpoint, 0 disables it
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9101"))
+# A failed job is retried (resuming from its last completed stage) until it has run this many times
+MAX_JOB_ATTEMPTS = int(os.getenv("MAX_JOB_ATTEMPTS", "3"))
+# Seconds before the first retry of a failed job, doubled for every further attempt
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", "30"))
+JOB_RETRY_BACKOFF_MAX = 3600
+
+# Once this many chunks were written to chunk_fts, the idle worker merges its segments back together
+FTS_OPTIMIZE_AFTER_CHUNKS = int(os.getenv("FTS_OPTIMIZE_AFTER_CHUNKS", "10000"))
+
+# Progress events of finished documents are deleted after this many hours
+# (pruning and the routing backfill run at most once per _MAINTENANCE_INTERVAL seconds)
+EVENTS_RETENTION_HOURS = int(os.getenv("EVENTS_RETENTION_HOURS", "24"))
+_MAINTENANCE_INTERVAL = 3600
+_last_events_prune = 0.0
+_last_route_backfill = 0.0
+
+# Per document intermediate results so that a retry does not redo extraction or paid embeddings
+CHECKPOINT_DIR = Path("data/checkpoints")
+
+def _get_embeddings(texts, model=None):
+    return get_embedder(model).embed(texts)
+
+def _batched(iterable, n):
+    it = iter(iterable)
+    while batch := list(islice(it, n)):
+        yield batch
+
+def _atomic_write(path, write):
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+# Stages
+def _extract(document_id, doc, ckpt):
+    with span("extract"):
+        pages = extract_text_pages(doc["storage_path"])
+    _atomic_write(ckpt / "pages.json", lambda f: f.write(json.dumps(pages).encode("utf-8")))
+    add_document_event(document_id, "progress", "pages_extracted", done=len(pages), total=len(pages))
+    set_document_stage(document_id, DocumentStage.EXTRACTED)
+    return pages
+
+def _chunk(document_id, pages, ckpt):
+    # Chunks (and their embeddings) of a previous, interrupted attempt are dropped first
+    delete_chunks(document_id)
+    for f in ckpt.glob("emb_*.npz"):
+        f.unlink()
+    stored = duplicates = 0
+    for chunks in _batched(iter_chunks(pages), CHUNK_BATCH_SIZE):
+        with span("store_chunks"):
+            insert_chunks(document_id, chunks)
+        stored += len(chunks)
+        # near-duplicates of stored chunks are neither embedded nor indexed
+        duplicates += sum(c["canonical_id"] is not None for c in chunks)
+        add_document_event(document_id, "progress", "chunks_stored", done=stored)
+    if duplicates:
+        add_document_event(document_id, "progress", "chunks_deduplicated", done=duplicates)
+        CHUNKS_DEDUPLICATED.inc(duplicates)
+    set_document_stage(document_id, DocumentStage.CHUNKED)
+
+def _embedding_prefix(model):
+    # Named after the model, so that batches embedded before a migration cutover are not reused
+    return "emb_" + re.sub(r"[^\w.-]", "_", model)
+
+def _embedding_files(ckpt, model):
+    return sorted(ckpt.glob(f"{_embedding_prefix(model)}_*.npz"))
+
+def _load_embeddings(ckpt, model):
+    ids, vecs = [], []
+    for f in _embedding_files(ckpt, model):
+        with np.load(f) as data:
+            ids.append(data["ids"])
+            vecs.append(data["vecs"])
+    if not ids:
+        return np.empty(0, dtype="int64"), None
+    return np.concatenate(ids), np.vstack(vecs).astype("float32")
+
+def _embed(document_id, ckpt, model):
+    """
+    Every embedded batch is saved right away (float16 halves the disk use), so a retry only embeds
+    the chunks that are not on disk yet. Returns (ids, float32 vectors) when this call embedded
+    all chunks, None when some came from the checkpoint.
+    """
+    done, _ = _load_embeddings(ckpt, model)
+    done = set(done.tolist())
+    todo = [(cid, text) for cid, text in get_document_chunks(document_id) if cid not in done]
+    next_file = len(_embedding_files(ckpt, model))
+    prefix = _embedding_prefix(model)
+    embedded, total = len(done), len(done) + len(todo)
+    all_ids, all_vecs = [], []
+
+    for i, batch in enumerate(_batched(todo, CHUNK_BATCH_SIZE), start=next_file):
+        with span("embed"):
+            vecs = _get_embeddings([text for _, text in batch], model)
+        ids = np.array([cid for cid, _ in batch], dtype="int64")
+        _atomic_write(ckpt / f"{prefix}_{i:06d}.npz", lambda f: np.savez(f, ids=ids, vecs=vecs.astype("float16")))
+        all_ids.append(ids)
+        all_vecs.append(np.asarray(vecs, dtype="float32"))
+        embedded += len(batch)
+        add_document_event(document_id, "progress", "chunks_embedded", done=embedded, total=total)
+    set_document_stage(document_id, DocumentStage.EMBEDDED)
+    if done or not all_ids:
+        return None
+    return np.concatenate(all_ids), np.vstack(all_vecs)
+
+def _index(document_id, ckpt, model, resumed, embedded=None):
+    # The float32 vectors when this attempt embedded every chunk; the float16 checkpoint only when
+    # an earlier attempt embedded some of them
+    if embedded is not None:
+        ids, vecs = embedded
+    else:
+        ids, vecs = _load_embeddings(ckpt, model)
+        if len(ids) == 0:
+            return 0
+        # Re-normalize after the float16 round trip
+        vecs /= np.clip(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12, None)
+    dim = vecs.shape[1]
+
+    # Use Flat Index (Exhasutive Search) if not a lot of data
+    with span("index_flat"):
+        flat = add_to_flat_index(vecs, ids, dim, replace=resumed)
+
+    # Start using IVFPQ Index once the data size increases for better speed and memory usage
+    with span("index_ivfpq"):
+        ivfpq = add_to_ivfpq_index(dim, ids, vecs, replace=resumed)
 
-def _get_embeddings(texts, ):
-    return EMBEDDER.embed(texts)
+    # Document tier of the two-tier retrieval: the document's centroid and most frequent terms
+    with span("index_route"):
+        update_document_route(document_id, vecs, [text for _, text in get_document_chunks(document_id)])
 
+    # Queries see the new vectors from here on, all indexes at once
+    with span("index_publish"):
+        publish(chunk_hwm=int(ids.max()), embed_model=model)
+    add_document_event(document_id, "progress", "vectors_indexed", done=len(ids), total=len(ids))
 
-def _process_index_document(document_id):
+    INDEX_SIZE.set(flat.ntotal, kind="vectors", index="flat")
+    if ivfpq is not None:
+        INDEX_SIZE.set(ivfpq.ntotal, kind="vectors", index="ivfpq")
+    return len(ids)
+
+
+def _process_index_document(document_id, resumed=False):
+    """
+    Runs extraction -> chunking -> embedding -> indexing, recording each completed stage on the
+    document. A retried or restarted job continues after the last completed stage.
+    """
     update_document_status(document_id=document_id, status=DocumentStatus.PROCESSING.value)
     doc = get_document(document_id)
     if not doc:
         raise RuntimeError(f"Document {document_id} not found.")
-    
-    pages = extract_text_pages(doc["storage_path"])
-    chunks = make_chunks(pages)
-    chunk_ids = insert_chunks(document_id, chunks)
 
-    texts = [c["text"] for c in chunks]
-    vecs = _get_embeddings(texts)
-    dim = vecs.shape[1]
+    stage = doc["stage"]
+    if stage_reached(stage, DocumentStage.INDEXED):
+        update_document_status(document_id, DocumentStatus.INDEXED.value)
+        return
 
-    # Use Flat Index (Exhasutive Search) if not a lot of data
-    add_to_flat_index(vecs, np.array(chunk_ids, dtype="int64"), dim)
+    ckpt = CHECKPOINT_DIR / document_id
+    ckpt.mkdir(parents=True, exist_ok=True)
+    t0 = time.perf_counter()
 
-    # Start using IVFPQ Index once the data size increases for better speed and memory usage
-    add_to_ivfpq_index(dim, np.array(chunk_ids, dtype="int64"), vecs)
+    pages_file = ckpt / "pages.json"
+    if not stage_reached(stage, DocumentStage.CHUNKED) and not (stage_reached(stage, DocumentStage.EXTRACTED) and pages_file.exists()):
+        stage = None
+        pages = _extract(document_id, doc, ckpt)
+    elif pages_file.exists():
+        pages = json.loads(pages_file.read_text())
+    else:
+        pages = None  # only needed for chunking, which is already done
+
+    if not stage_reached(stage, DocumentStage.CHUNKED):
+        _chunk(document_id, pages, ckpt)
+    # Always checked: after a migration cutover the stored batches may be for the old model
+    model = get_embed_model_name()
+    embedded = _embed(document_id, ckpt, model)
+
+    n = _index(document_id, ckpt, model, resumed, embedded)
+    set_document_stage(document_id, DocumentStage.INDEXED)
+
+    CHUNKS_INDEXED.inc(n)
+    CHUNKS_PER_SECOND.set(n / max(time.perf_counter() - t0, 1e-9))
+    update_document_status(document_id, DocumentStatus.INDEXED.value,
+                           pages=len(pages) if pages is not None else None)
+    shutil.rmtree(ckpt, ignore_errors=True)
+
+def _step_migration():
+    try:
+        return step_migration()
+    except Exception as e:
+        print("Migration step failed:", e, traceback.format_exc())
+        return False
+
+def _step_fts_optimize():
+    # After a bulk ingest keyword queries would otherwise visit many small segments; merging in
+    # short steps lets a new job interrupt the optimize between two of them
+    if get_fts_pending() < FTS_OPTIMIZE_AFTER_CHUNKS:
+        return False
+    with span("fts_optimize"):
+        if optimize_fts_step():
+            print("Keyword index optimized.")
+    return True
 
-    update_document_status(document_id, DocumentStatus.INDEXED.value, pages=len(pages))
+def _step_prune_events():
+    global _last_events_prune
+    if time.monotonic() - _last_events_prune < _MAINTENANCE_INTERVAL:
+        return False
+    _last_events_prune = time.monotonic()
+    deleted = prune_document_events(EVENTS_RETENTION_HOURS)
+    if deleted:
+        print(f"Pruned {deleted} document event(s).")
+    return deleted > 0
+
+def _step_route_backfill():
+    # Documents indexed before the routing tier existed get their centroids and terms; checked
+    # hourly, a corpus that is already covered costs two counts
+    global _last_route_backfill
+    if time.monotonic() - _last_route_backfill < _MAINTENANCE_INTERVAL:
+        return False
+    _last_route_backfill = time.monotonic()
+    with span("route_backfill"):
+        rebuilt, termed = backfill_document_routes()
+    if rebuilt:
+        publish()
+    if termed:
+        # more documents may be waiting for their terms
+        _last_route_backfill = 0.0
+    if rebuilt or termed:
+        print(f"Document routing tier backfilled (centroids rebuilt: {rebuilt}, terms: {termed} documents).")
+    return rebuilt or termed > 0
+
+def _refresh_queue_metrics():
+    for status, n in count_jobs_by_status().items():
+        JOBS.set(n, status=status)
+
+def _poll_once():
+    _refresh_queue_metrics()
+    job = get_job()
+    if not job:
+        # Index maintenance and re-embedding migrations only use the time the queue is empty
+        if _step_fts_optimize() or _step_prune_events() or _step_route_backfill():
+            return
+        with priority(Priority.BACKGROUND):
+            migrated = _step_migration()
+        if not migrated:
+            time.sleep(1)
+        return
+    try:
+        # Indexing must not starve interactive queries of the shared provider quota
+        with profile(f"job-{job['document_id']}", should_profile()) as prof, \
+                collect_timings() as timings, span("job"), priority(Priority.BACKGROUND):
+            if job["type"] == "INDEX_DOCUMENT":
+                _process_index_document(job["document_id"], resumed=job["attempts"] > 1)
+            else:
+                raise RuntimeError(f"Unknown job type: {job['type']}")
+        mark_job_done(job["id"])
+        print("Job done!", timings_ms(timings), f"profile: {prof.name}" if prof.name else "")
+    except Exception as e:
+        tb = traceback.format_exc()
+        retry = job["attempts"] < MAX_JOB_ATTEMPTS
+        # back off, so that a rate limit or an outage does not use up all attempts within seconds
+        delay = min(JOB_RETRY_BACKOFF * 2 ** (job["attempts"] - 1), JOB_RETRY_BACKOFF_MAX)
+        print("Job failed:", e, tb, f"(will retry in {delay:.0f}s)" if retry else "")
+        mark_job_failed(job["id"], f"{e}\n{tb}", retry=retry, delay=delay)
+        if retry and job["type"] == "INDEX_DOCUMENT":
+            add_document_event(job["document_id"], "retry", f"attempt_{job['attempts']}", message=str(e)[:2000])
+        if not retry and job["type"] == "INDEX_DOCUMENT":
+            update_document_status(job["document_id"], DocumentStatus.FAILED.value, error=str(e)[:2000])
 
 def main():
     init_schema()
+    # A job still RUNNING at start up belongs to a worker that crashed; it resumes from its checkpoint
+    requeued = requeue_running_jobs()
+    if requeued:
+        print(f"Requeued {requeued} interrupted job(s).")
+    if WORKER_METRICS_PORT:
+        start_metrics_server(WORKER_METRICS_PORT)
+        print(f"Worker metrics on http://127.0.0.1:{WORKER_METRICS_PORT}/metrics")
     print("Worker started! Polling for jobs...")
 
     while True:
-        job = get_job()
-        if not job:
-            time.sleep(1)
-            continue
         try:
-            if job["type"] == "INDEX_DOCUMENT":
-                _process_index_document(job["document_id"])
-            else:
-                raise RuntimeError(f"Unknown job type: {job["type"]}")
-            mark_job_done(job["id"])
-            print("Job done!")
+            _poll_once()
         except Exception as e:
-            tb = traceback.format_exc()
-            print("Job failed:", e, tb)
-            mark_job_failed(job["id"], f"{e}\n{tb}")
+            # e.g. "database is locked" while another process holds a long write; try again shortly
+            print("Worker loop error:", e, traceback.format_exc())
+            time.sleep(1)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()